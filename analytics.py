@@ -0,0 +1,187 @@
+"""Analyse du journal d'événements (segments gzip écrits par main.EventLog).
+
+Usage :
+  python analytics.py summary [--dir analytics] [--since 2024-05-01] [--until 2024-06-01]
+  python analytics.py funnel [shown:welcome click followup] [--window 604800]
+  python analytics.py funnel shown:dm_start "click:menu_*" followup:0 followup:1
+
+Une étape s'écrit `kind` ou `kind:step` (motif fnmatch sur step). Les segments
+sont lus en flux, fusionnés par ordre chronologique entre process (shards,
+redémarrages) : la mémoire ne dépend que du nombre d'users, pas du volume.
+"""
+import argparse
+import gzip
+import heapq
+import json
+import os
+import re
+import sys
+import time
+import zlib
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from fnmatch import fnmatchcase
+from statistics import median
+
+# Un événement = une ligne JSON [ts, kind, chat, user, step] (voir EventLog.record)
+SEGMENT_RE = re.compile(r"^events-(\d{8}-\d{6})-(.+)-(\d+)\.jsonl\.gz$")
+DEFAULT_FUNNEL = ("shown:welcome", "click", "followup")
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# LECTURE DES SEGMENTS
+# ═══════════════════════════════════════════════════════════════════════════════
+
+
+def list_writers(directory):
+    """Segments groupés par writer (tag-pid), dans l'ordre d'écriture."""
+    writers = defaultdict(list)
+    for name in os.listdir(directory):
+        match = SEGMENT_RE.match(name)
+        if match:
+            started, writer, seq = match.groups()
+            writers[writer].append((started, int(seq), os.path.join(directory, name)))
+    return [[path for *_, path in sorted(segments)] for segments in writers.values()]
+
+
+def read_segment(path):
+    """Événements d'un segment ; s'arrête proprement sur un lot tronqué (crash en écriture)."""
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                yield tuple(json.loads(line))
+    except (EOFError, gzip.BadGzipFile, zlib.error, json.JSONDecodeError) as e:
+        print(f"⚠️ {os.path.basename(path)} tronqué, fin ignorée ({e})", file=sys.stderr)
+
+
+def read_writer(paths):
+    for path in paths:
+        yield from read_segment(path)
+
+
+def iter_events(directory, since=None, until=None):
+    """Tous les événements, fusionnés par horodatage (un segment ouvert par writer)."""
+    streams = [read_writer(paths) for paths in list_writers(directory)]
+    for event in heapq.merge(*streams, key=lambda event: event[0]):
+        if since is not None and event[0] < since:
+            continue
+        if until is not None and event[0] >= until:
+            continue
+        yield event
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# RAPPORTS
+# ═══════════════════════════════════════════════════════════════════════════════
+
+
+def summary(events):
+    """Volume et users distincts par kind:step."""
+    counts = Counter()
+    users = defaultdict(set)
+    first = last = None
+    for ts, kind, chat, user, step in events:
+        key = f"{kind}:{step}" if step else kind
+        counts[key] += 1
+        users[key].add(user)
+        first = ts if first is None else first
+        last = ts
+    return counts, {key: len(ids) for key, ids in users.items()}, first, last
+
+
+def parse_stage(spec):
+    kind, _, pattern = spec.partition(":")
+    return kind, pattern or "*"
+
+
+def funnel(events, stages, window=None):
+    """Funnel ordonné par user : une étape ne compte qu'après la précédente.
+
+    `window` : délai max (s) entre deux étapes consécutives.
+    Renvoie [(étape, users, délais médians depuis l'étape précédente)].
+    """
+    parsed = [parse_stage(spec) for spec in stages]
+    progress = {}  # user → (dernière étape atteinte, ts)
+    reached = [0] * len(stages)
+    delays = [[] for _ in stages]
+    for ts, kind, chat, user, step in events:
+        done, since = progress.get(user, (-1, ts))
+        if done + 1 == len(parsed):
+            continue
+        next_kind, pattern = parsed[done + 1]
+        if kind != next_kind or not fnmatchcase(step, pattern):
+            continue
+        if done >= 0 and window is not None and ts - since > window:
+            continue
+        progress[user] = (done + 1, ts)
+        reached[done + 1] += 1
+        if done >= 0:
+            delays[done + 1].append(ts - since)
+    return [(stage, reached[i], median(delays[i]) if delays[i] else None) for i, stage in enumerate(stages)]
+
+
+def format_delay(seconds):
+    if seconds is None:
+        return "—"
+    for unit, size in (("j", 86400), ("h", 3600), ("min", 60)):
+        if seconds >= size:
+            return f"{seconds / size:.1f} {unit}"
+    return f"{seconds:.0f} s"
+
+
+def format_ts(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m-%d %H:%M UTC") if ts else "—"
+
+
+def parse_date(value):
+    """YYYY-MM-DD (UTC) ou timestamp epoch."""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp()
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# CLI
+# ═══════════════════════════════════════════════════════════════════════════════
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dir", default=os.environ.get("ANALYTICS_DIR", "analytics"), help="dossier des segments")
+    parser.add_argument("--since", type=parse_date, help="début inclus (YYYY-MM-DD UTC ou epoch)")
+    parser.add_argument("--until", type=parse_date, help="fin exclue (YYYY-MM-DD UTC ou epoch)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("summary", help="volume et users distincts par kind:step")
+    funnel_parser = commands.add_parser("funnel", help="funnel ordonné par user")
+    funnel_parser.add_argument("stages", nargs="*", default=list(DEFAULT_FUNNEL), help="étapes kind[:step]")
+    funnel_parser.add_argument("--window", type=float, help="délai max entre deux étapes (s)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not os.path.isdir(args.dir):
+        sys.exit(f"❌ Pas de segments dans {args.dir}")
+    started = time.monotonic()
+    events = iter_events(args.dir, args.since, args.until)
+
+    if args.command == "summary":
+        counts, users, first, last = summary(events)
+        print(f"📊 {sum(counts.values())} événements, {format_ts(first)} → {format_ts(last)}")
+        for key, count in counts.most_common():
+            print(f"  {key:<28} {count:>9}  ({users[key]} users)")
+    else:
+        rows = funnel(events, args.stages, args.window)
+        first = rows[0][1] if rows else 0
+        previous = first
+        print(f"🔻 Funnel {' → '.join(args.stages)}")
+        for stage, count, delay in rows:
+            print(f"  {stage:<28} {count:>9}  {count / max(previous, 1):>6.1%} de l'étape préc., "
+                  f"{count / max(first, 1):>6.1%} du début, délai médian {format_delay(delay)}")
+            previous = count
+    print(f"   (lu en {time.monotonic() - started:.1f}s)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,439 @@
+"""Micro-benchmarks hors ligne du bot (aucun appel Telegram / OpenAI).
+
+Usage : python bench.py [nom ...]    (sans argument : tous les benchmarks)
+"""
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+os.environ.setdefault("TELEGRAM_TOKEN", "0:bench")
+os.environ.setdefault("STATE_BACKEND", "memory")
+
+import main  # noqa: E402
+
+
+# Trafic groupe réaliste : surtout du bavardage, quelques présentations / keywords
+GROUP_TRAFFIC = [
+    "mdr",
+    "ok merci",
+    "Bonsoir",
+    "Quelqu'un a vu la vidéo d'hier soir ? C'est dingue ce qui se passe en ce moment",
+    "Tout à fait d'accord avec toi, il faut rester éveillés et solidaires 💪",
+    "Quelqu'un connaît un bon naturopathe dans la région de Lyon ?",
+    "Je partage ce lien, à lire absolument avant que ce soit censuré",
+    "je me sens un peu seul en ce moment",
+    "Bonjour à tous, je m'appelle Julie, j'ai 45 ans et j'habite dans le 69. "
+    "Je cherche des personnes alignées pour échanger et pourquoi pas plus ✨",
+    "Salut à tous ! Nouveau ici, moi c'est Marc, 52 ans, département 33",
+    "Célibataire depuis 3 ans, pas facile de trouver quelqu’un qui partage nos valeurs",
+    "👍👍",
+]
+
+
+def _legacy_keyword_check(text):
+    """Ancienne implémentation de group_message_handler (deux listes, N scans)."""
+    text_lower = text.lower()
+    keyword_count = sum(1 for k in main.KEYWORDS_PRESENTATION if k in text_lower)
+    presentation = keyword_count >= 2 or (keyword_count >= 1 and len(text) > 80)
+    text_lower = text.lower()
+    return presentation, any(k in text_lower for k in main.KEYWORDS_RENCONTRE)
+
+
+def _matcher_check(text):
+    presentation_hits, rencontre_hits = main.KEYWORD_MATCHER.count(text)
+    return main.is_presentation(text, presentation_hits), bool(rencontre_hits)
+
+
+def _per_call_us(func, messages, number=100, repeat=7):
+    best = min(timeit.repeat(lambda: [func(m) for m in messages], number=number, repeat=repeat))
+    return best / (number * len(messages)) * 1e6
+
+
+def bench_keywords():
+    """KeywordMatcher vs scans `in` successifs sur du trafic groupe."""
+    random.seed(42)
+    messages = [random.choice(GROUP_TRAFFIC) for _ in range(500)]
+
+    for message in messages:
+        if message.isascii():
+            assert _matcher_check(message) == _legacy_keyword_check(message), message
+
+    # Bavardage sans keyword : l'essentiel du trafic, rejeté sans tenter de match à chaque position
+    chatter = [m for m in messages if main.KEYWORD_MATCHER.count(m) == (0, 0)]
+    results = [
+        ("legacy (sans accents)", _per_call_us(_legacy_keyword_check, messages)),
+        ("KeywordMatcher", _per_call_us(_matcher_check, messages)),
+        ("legacy, bavardage seul", _per_call_us(_legacy_keyword_check, chatter)),
+        ("KeywordMatcher, bavardage seul", _per_call_us(_matcher_check, chatter)),
+    ]
+
+    # Croissance des listes : le coût du matcher ne dépend pas du nombre de keywords
+    extra = [f"{k} {suffix}" for k in main.KEYWORDS_PRESENTATION for suffix in ("bis", "ter", "quater")]
+    big_presentation = main.KEYWORDS_PRESENTATION + extra
+    big_matcher = main.KeywordMatcher(big_presentation, main.KEYWORDS_RENCONTRE)
+
+    def legacy_big(text):
+        text_lower = text.lower()
+        return sum(1 for k in big_presentation if k in text_lower), any(k in text_lower for k in main.KEYWORDS_RENCONTRE)
+
+    results += [
+        (f"legacy ({len(big_presentation)} kw)", _per_call_us(legacy_big, messages)),
+        (f"KeywordMatcher ({len(big_presentation)} kw)", _per_call_us(big_matcher.count, messages)),
+    ]
+
+    print(f"keywords — {len(messages)} messages groupe")
+    for label, per_call in results:
+        print(f"  {label:<32} {per_call:7.2f} µs/message")
+
+
+def bench_state():
+    """Coût write-behind par update (mark) et débit des flush SQLite."""
+    users = 10_000
+    for user_id in range(users):
+        main.user_conversations.append(user_id, main.ROLE_USER, "je me sens seul en ce moment")
+        main.user_conversations.append(user_id, main.ROLE_ASSISTANT, "Je comprends, tu n'es pas seul. " * 8)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        state = main.WriteBehind(
+            lambda: main.SQLiteStore(os.path.join(tmp, "state.db")),
+            interval=3600,
+            getters={"conversations": main.user_conversations.messages},
+        )
+        user_ids = list(range(users))
+        number = 20
+        mark_us = min(timeit.repeat(
+            lambda: [state.mark("conversations", u) for u in user_ids], number=number, repeat=5,
+        )) / (number * users) * 1e6
+
+        started = time.perf_counter()
+        state.flush()
+        flush_s = time.perf_counter() - started
+        state.stop()
+
+    for user_id in range(users):
+        main.user_conversations.reset(user_id)
+    print(f"state — {users} conversations")
+    print(f"  {'mark() par update':<32} {mark_us:7.2f} µs")
+    print(f"  {'flush SQLite (1 transaction)':<32} {flush_s * 1000:7.1f} ms ({users / flush_s:,.0f} lignes/s)")
+
+
+def _legacy_rate_limited(user_last_messages, user_id, now):
+    """Ancien is_rate_limited (liste de timestamps reconstruite à chaque message)."""
+    user_last_messages[user_id] = [t for t in user_last_messages[user_id] if now - t < main.RATE_LIMIT_WINDOW]
+    if len(user_last_messages[user_id]) >= main.RATE_LIMIT_MESSAGES:
+        return True
+    user_last_messages[user_id].append(now)
+    main.STATE.mark("rate", user_id)
+    return False
+
+
+def _legacy_sweep(user_last_messages, now):
+    """Équivalent du sweep pour l'ancien état : oublie les users sans timestamp dans la fenêtre."""
+    idle = [user_id for user_id, times in user_last_messages.items()
+            if all(now - t >= main.RATE_LIMIT_WINDOW for t in times)]
+    for user_id in idle:
+        del user_last_messages[user_id]
+    return len(idle)
+
+
+def bench_ratelimit():
+    """Rate limit : ancien (listes) vs seaux à jetons, 100k users simulés."""
+    users = 100_000
+    random.seed(7)
+    # 1 h de trafic DM : la plupart des users envoient 1-3 messages, quelques bavards en rafale
+    events = []
+    for user_id in range(users):
+        start = random.uniform(0, 3600)
+        burst = 12 if user_id % 50 == 0 else random.randint(1, 3)
+        events += [(start + i * random.uniform(1, 20), user_id) for i in range(burst)]
+    events.sort()
+
+    def run_legacy():
+        state = main.defaultdict(list)
+        limited = sum(_legacy_rate_limited(state, user_id, now) for now, user_id in events)
+        return state, limited
+
+    def run_buckets():
+        limiter = main.UserRateLimiter(main.RATE_LIMIT_MESSAGES, main.RATE_LIMIT_WINDOW)
+        limited = sum(not limiter.allow(user_id, now) for now, user_id in events)
+        return limiter, limited
+
+    print(f"ratelimit — {users:,} users, {len(events):,} messages")
+    for label, run in (("legacy (listes)", run_legacy), ("UserRateLimiter", run_buckets)):
+        started = time.perf_counter()
+        _, limited = run()
+        per_check = (time.perf_counter() - started) / len(events) * 1e6
+        tracemalloc.start()
+        kept, _ = run()
+        resident, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        # Même instant de GC pour les deux : une fenêtre après le dernier message
+        gc_at = events[-1][0] + main.RATE_LIMIT_WINDOW
+        if isinstance(kept, main.UserRateLimiter):
+            kept.sweep(gc_at)
+        else:
+            _legacy_sweep(kept, gc_at)
+        after_gc = len(kept)
+        print(f"  {label:<32} {per_check:7.2f} µs/check  {resident / 1024 / 1024:6.1f} Mo  "
+              f"limités: {limited:,}  users gardés après GC: {after_gc:,}")
+
+
+def bench_metrics():
+    """Coût par appel de Histogram.observe / CounterVec.inc (agrégation comprise)."""
+    histogram = main.Histogram("bench_seconds", "bench", ("handler",))
+    counter = main.CounterVec("bench_total", "bench", ("type",))
+    labels = ("private_ai_chat",)
+    number = 200_000
+    observe_us = min(timeit.repeat(
+        lambda: histogram.observe(0.012, labels), number=number, repeat=5,
+    )) / number * 1e6
+    inc_us = min(timeit.repeat(lambda: counter.inc(labels), number=number, repeat=5)) / number * 1e6
+    started = time.perf_counter()
+    histogram.render()
+    render_ms = (time.perf_counter() - started) * 1000
+
+    print("metrics")
+    print(f"  {'Histogram.observe':<32} {observe_us:7.3f} µs")
+    print(f"  {'CounterVec.inc':<32} {inc_us:7.3f} µs")
+    print(f"  {'render (scrape)':<32} {render_ms:7.2f} ms")
+
+
+# DM étiquetés : intent attendu (None = part à OpenAI)
+DM_INTENTS = [
+    ("salut", "salut"),
+    ("Bonsoir !", "salut"),
+    ("c'est gratuit ?", "gratuit"),
+    ("Bonjour, c'est payant ?", "gratuit"),
+    ("combien ça coûte ?", "gratuit"),
+    ("comment je fais pour m'inscrire ?", "inscription"),
+    ("le lien du site stp", "inscription"),
+    ("c'est quoi Mad2Moi exactement ?", "about"),
+    ("tu es qui ?", "about"),
+    ("je me sens un peu seul en ce moment, pas facile de trouver quelqu'un", None),
+    ("je suis seule, c'est gratuit pour parler à quelqu'un ?", None),
+    ("Il y a des gens près de Bordeaux sur le site ?", None),
+    ("merci pour ta réponse !", None),
+]
+
+
+def bench_intents():
+    """IntentRouter : coût par DM et part des DM servis sans OpenAI."""
+    router = main.INTENT_ROUTER
+    for text, expected in DM_INTENTS:
+        assert router.classify(text)[0] == expected, text
+    texts = [text for text, _ in DM_INTENTS] + GROUP_TRAFFIC
+    per_call = _per_call_us(router.classify, texts)
+    deflected = sum(router.classify(text)[0] is not None for text, _ in DM_INTENTS)
+
+    print(f"intents — {len(texts)} messages, seuil {router.threshold}")
+    print(f"  {'IntentRouter.classify':<32} {per_call:7.2f} µs/message")
+    print(f"  {'DM servis sans OpenAI':<32} {deflected}/{len(DM_INTENTS)}")
+
+
+def _queued_log_us(number, repeat=5):
+    """Meilleur coût d'un log en file ; la file est vidée entre deux mesures."""
+    log_queue = main.LOG_QUEUE_HANDLER.queue
+    best = float("inf")
+    for _ in range(repeat):
+        while not log_queue.empty():
+            time.sleep(0.01)
+        best = min(best, timeit.timeit(
+            lambda: main.logger.info("[%s] user=%s chat=%s", "group_message_handler", 123456789, "supergroup",
+                                     extra=main.LOG_HANDLER_EVENT),
+            number=number,
+        ))
+    return best / number * 1e6
+
+
+def bench_counters():
+    """StatsCounters.inc vs dict += ; total exact sous 8 threads, mémoire fixe."""
+    number = 200_000
+    legacy = main.defaultdict(int)
+
+    def legacy_inc():
+        legacy["total_private_messages"] += 1
+
+    counters = main.StatsCounters()
+    legacy_us = min(timeit.repeat(legacy_inc, number=number, repeat=5)) / number * 1e6
+    inc_us = min(timeit.repeat(lambda: counters.inc("total_private_messages"), number=number, repeat=5)) / number * 1e6
+
+    threads, per_thread = 8, 50_000
+    counters = main.StatsCounters()
+    workers = [
+        main.threading.Thread(target=lambda: [counters.inc("total_private_messages") for _ in range(per_thread)])
+        for _ in range(threads)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    # 30 jours simulés minute par minute : les anneaux ne grandissent pas
+    series = main.RollingCount()
+    for minute in range(30 * 24 * 60):
+        series.add(1, minute)
+    sizes = len(series.minutes.values) + len(series.hours.values)
+
+    print("counters")
+    print(f"  {'dict += (legacy, non thread-safe)':<32} {legacy_us:7.2f} µs")
+    print(f"  {'StatsCounters.inc':<32} {inc_us:7.2f} µs")
+    print(f"  {f'{threads} threads x {per_thread:,}':<32} {counters.total('total_private_messages'):,} comptés")
+    print(f"  {'seaux après 30 jours':<32} {sizes:7d} (total {series.total:,}, 24 h: "
+          f"{series.hours.sum(series.hours.last - 23, series.hours.last):,})")
+
+
+def bench_logging():
+    """Coût d'un log de handler côté dispatcher : direct (f-string) vs file + listener."""
+    number = 5_000  # sous LOG_QUEUE_SIZE : aucune perte pendant une mesure
+    user_id, handler_name = 123456789, "group_message_handler"
+    with open(os.devnull, "w") as devnull:
+        direct = logging.getLogger("bench.direct")
+        direct.propagate = False
+        direct_handler = logging.StreamHandler(devnull)
+        direct_handler.setFormatter(logging.Formatter("%(asctime)s | %(levelname)s | %(message)s"))
+        direct.addHandler(direct_handler)
+        direct_us = min(timeit.repeat(
+            lambda: direct.info(f"[{handler_name}] user={user_id} chat=supergroup"), number=number, repeat=5,
+        )) / number * 1e6
+
+        # Le listener écrit dans /dev/null pendant la mesure
+        output = main.LOG_LISTENER.handlers[0]
+        stream = output.setStream(devnull)
+        try:
+            queued_us = _queued_log_us(number)
+            main.LOG_SAMPLER.rates["handler"] = 0.1
+            sampled_us = _queued_log_us(number)
+        finally:
+            main.LOG_SAMPLER.rates.pop("handler", None)
+            main.LOG_LISTENER.stop()
+            output.setStream(stream)
+            main.LOG_LISTENER.start()
+
+    print("logging — logs info d'un handler, coût sur le thread appelant (sortie /dev/null)")
+    print(f"  {'StreamHandler direct (f-string)':<32} {direct_us:7.2f} µs")
+    print(f"  {'QueueHandler (lazy %)':<32} {queued_us:7.2f} µs")
+    print(f"  {'QueueHandler, sampling 10 %':<32} {sampled_us:7.2f} µs")
+    print(f"  {'perdus (file pleine)':<32} {main.LOG_QUEUE_HANDLER.dropped:7d}")
+
+
+def bench_startup():
+    """Profil d'import de main (python -X importtime) : coût du démarrage à froid."""
+    env = dict(os.environ, METRICS_PORT="0", LOG_LEVEL="WARNING")
+    code = "import sys, main; print('openai' in sys.modules, f'{main.IMPORTS_SECONDS:.3f}')"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        env=env, capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    # "import time: self [us] | cumulative | module" ; les imports directs de main ont 2 espaces d'indentation
+    direct = []
+    main_ms = 0.0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0 and name.strip() == "main":
+            main_ms = int(cumulative) / 1000
+        elif depth == 1:
+            direct.append((int(cumulative) / 1000, name.strip()))
+    openai_loaded, imports = result.stdout.split()
+
+    print(f"startup — import de main (openai chargé : {openai_loaded})")
+    print(f"  {'import main (total)':<32} {main_ms:7.0f} ms")
+    print(f"  {'imports (BOOT_STARTED → fin)':<32} {float(imports) * 1000:7.0f} ms")
+    for cumulative_ms, name in sorted(direct, reverse=True)[:8]:
+        print(f"  {name:<32} {cumulative_ms:7.0f} ms")
+
+
+def bench_events():
+    """EventLog : coût de record côté handler, débit du flush gzip, octets par événement."""
+    number = 200_000
+    with tempfile.TemporaryDirectory() as directory:
+        events = main.EventLog(directory, 3600, number * 10, 8 * 1024 * 1024, 3600)
+        record_us = min(timeit.repeat(
+            lambda: events.record("shown", -1001234567890, 123456789, "welcome"), number=number, repeat=5,
+        )) / number * 1e6
+        events._buffer = [
+            (time.time() + i / 100, "click" if i % 3 else "shown", i % 5000, i % 5000, f"menu_{i % 3}")
+            for i in range(number)
+        ]
+        started = time.perf_counter()
+        events.flush()
+        flush_s = time.perf_counter() - started
+        size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+    print("events")
+    print(f"  {'EventLog.record':<32} {record_us:7.2f} µs")
+    print(f"  {f'flush {number:,} événements':<32} {flush_s * 1000:7.0f} ms ({number / flush_s:,.0f}/s)")
+    print(f"  {'segment gzip':<32} {size / number:7.1f} o/événement")
+
+
+def bench_welcomed():
+    """Users accueillis : set vs SortedIdSet vs BloomFilter (mémoire, lookup, faux positifs)."""
+    members = 100_000
+    random.seed(11)
+    ids = random.sample(range(10**9, 8 * 10**9), members)
+    absent = random.sample(range(8 * 10**9, 9 * 10**9), 10_000)
+    probes = ids[:5_000] + absent[:5_000]
+    builders = {
+        "set (actuel)": lambda: {member + 0 for member in ids},  # ints neufs, comme ceux des updates
+        "SortedIdSet": lambda: main.SortedIdSet(ids),
+        "BloomFilter 0,1 %": lambda: bloom_of(ids, members, 0.001),
+        "BloomFilter 1 %": lambda: bloom_of(ids, members, 0.01),
+    }
+
+    print(f"welcomed — {members:,} users dans un groupe")
+    for name, build in builders.items():
+        tracemalloc.start()
+        seen = build()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        lookup_us = min(timeit.repeat(lambda: [member in seen for member in probes], number=1, repeat=5)) / len(probes) * 1e6
+        false_positives = sum(member in seen for member in absent) / len(absent)
+        print(f"  {name:<20} {size / 1024:8.0f} Ko ({size / members:5.1f} o/user)  "
+              f"lookup {lookup_us:5.2f} µs  faux positifs {false_positives:.2%}")
+
+    registry = main.SeenRegistry(main.SortedIdSet)
+    for i, member in enumerate(ids):
+        registry.add(-(i % 20) - 1, member)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "welcomed.bin")
+        registry.dump(path)
+        started = time.perf_counter()
+        loaded = main.SeenRegistry(main.SortedIdSet)
+        loaded.load(path)
+        load_ms = (time.perf_counter() - started) * 1000
+        print(f"  {'fichier (20 groupes)':<20} {os.path.getsize(path) / 1024:8.0f} Ko, rechargé (mmap) en {load_ms:.1f} ms")
+
+
+def bloom_of(ids, capacity, fp_rate):
+    bloom = main.BloomFilter(capacity, fp_rate)
+    for member in ids:
+        bloom.add(member)
+    return bloom
+
+
+BENCHMARKS = {
+    "keywords": bench_keywords,
+    "state": bench_state,
+    "ratelimit": bench_ratelimit,
+    "metrics": bench_metrics,
+    "intents": bench_intents,
+    "counters": bench_counters,
+    "logging": bench_logging,
+    "startup": bench_startup,
+    "events": bench_events,
+    "welcomed": bench_welcomed,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
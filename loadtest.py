@@ -0,0 +1,461 @@
+"""Banc de charge hors ligne : faux Bot API + faux OpenAI, vrais handlers de main.py.
+
+Usage :
+  python loadtest.py [--rate 50] [--duration 30] [--ai-latency 1.5] [--ai-errors 0.02]
+  python loadtest.py --replay updates.jsonl [--rate 0]
+  python loadtest.py --mix dm --rate 0 --count 600 --shards 2
+
+Le bot tourne en polling sur le faux Bot API (base_url local) : dispatcher,
+file sortante, pool IA et job queue sont ceux de la prod.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TOKEN = "123456:LOADTEST"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Mad2Moi", "username": "mad2moi_bot"}
+GROUP_CHAT = {"id": -1001234567890, "type": "supergroup", "title": "Non Vax Rencontres"}
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# FAUX BOT API
+# ═══════════════════════════════════════════════════════════════════════════════
+
+
+class FakeBotAPI:
+    """Bot API minimale : getUpdates (long polling), envois, edits, callbacks."""
+
+    def __init__(self, latency=0.03, flood_rate=0.0):
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.calls = Counter()
+        self.flooded = 0
+        self._updates = deque()
+        self._cond = threading.Condition()
+        self._next_update_id = 1
+        self._next_message_id = 1
+        self._random = random.Random(1)
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _handler(self))
+        self.server.daemon_threads = True
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_port}/bot"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="fake-bot-api", daemon=True).start()
+
+    def push(self, update):
+        with self._cond:
+            update["update_id"] = self._next_update_id
+            self._next_update_id += 1
+            self._updates.append(update)
+            self._cond.notify_all()
+
+    def pending(self):
+        with self._cond:
+            return len(self._updates)
+
+    def call(self, method, params):
+        """(code HTTP, réponse JSON) pour un appel Bot API."""
+        with self._cond:
+            self.calls[method] += 1
+        if method == "getUpdates":
+            return 200, {"ok": True, "result": self._get_updates(params)}
+        if method == "getMe":
+            return 200, {"ok": True, "result": BOT_USER}
+
+        time.sleep(self.latency)
+        if method in ("sendMessage", "editMessageText") and self._random.random() < self.flood_rate:
+            with self._cond:
+                self.flooded += 1
+            return 429, {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                         "parameters": {"retry_after": 1}}
+        if method in ("sendMessage", "editMessageText"):
+            return 200, {"ok": True, "result": self._message(params)}
+        return 200, {"ok": True, "result": True}
+
+    def _get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        deadline = time.monotonic() + float(params.get("timeout") or 0)
+        with self._cond:
+            while self._updates and self._updates[0]["update_id"] < offset:
+                self._updates.popleft()
+            while not self._updates and time.monotonic() < deadline:
+                self._cond.wait(deadline - time.monotonic())
+            return list(self._updates)[:int(params.get("limit") or 100)]
+
+    def _message(self, params):
+        chat_id = int(params.get("chat_id", 0))
+        with self._cond:
+            message_id = params.get("message_id") or self._next_message_id
+            self._next_message_id += 1
+        chat = GROUP_CHAT if chat_id < 0 else {"id": chat_id, "type": "private", "first_name": "User"}
+        return {"message_id": message_id, "date": int(time.time()), "chat": chat,
+                "from": BOT_USER, "text": params.get("text", "")}
+
+
+def _handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            params = json.loads(self.rfile.read(length) or b"{}")
+            code, payload = api.call(self.path.rsplit("/", 1)[-1], params)
+            _write_json(self, code, payload)
+
+        def log_message(self, format, *args):
+            pass
+    return Handler
+
+
+def _write_json(handler, code, payload, headers=None):
+    body = json.dumps(payload).encode()
+    handler.send_response(code)
+    for name, value in (headers or {}).items():
+        handler.send_header(name, value)
+    handler.send_header("Content-Type", "application/json")
+    handler.send_header("Content-Length", str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# FAUX OPENAI
+# ═══════════════════════════════════════════════════════════════════════════════
+
+FAKE_ANSWER = ("Je comprends tout à fait ce que tu ressens. Tu n'es pas seul(e) ici, "
+               "beaucoup de membres partagent tes valeurs. Sur Mad2Moi tu peux rencontrer "
+               "des personnes alignées, près de chez toi. 💚")
+
+
+class FakeOpenAI:
+    """/v1/chat/completions : latence log-normale, erreurs 429/500 injectées, stream SSE."""
+
+    def __init__(self, latency=1.5, sigma=0.5, error_rate=0.0):
+        self.latency = latency
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._random = random.Random(2)
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                api.handle(self, json.loads(self.rfile.read(length) or b"{}"))
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_port}/v1"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="fake-openai", daemon=True).start()
+
+    def handle(self, handler, body):
+        with self._lock:
+            latency = self._random.lognormvariate(math.log(self.latency), self.sigma)
+            failure = self._random.random() < self.error_rate and self._random.choice((429, 500))
+            self.calls[failure or ("stream" if body.get("stream") else "blocking")] += 1
+        if failure:
+            time.sleep(min(latency, 0.2))
+            return _write_json(handler, failure, {"error": {
+                "message": "fake failure", "type": "rate_limit" if failure == 429 else "server_error"}},
+                {"Retry-After": "1"} if failure == 429 else None)
+        try:
+            if body.get("stream"):
+                self._stream(handler, latency)
+            else:
+                time.sleep(latency)
+                _write_json(handler, 200, {"id": "fake", "object": "chat.completion", "choices": [
+                    {"index": 0, "message": {"role": "assistant", "content": FAKE_ANSWER},
+                     "finish_reason": "stop"}]})
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # timeout côté client
+
+    @staticmethod
+    def _stream(handler, latency):
+        """TTFT ≈ 30 % de la latence, puis un mot par intervalle régulier."""
+        words = FAKE_ANSWER.split(" ")
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.end_headers()
+        time.sleep(latency * 0.3)
+        for index, word in enumerate(words):
+            chunk = {"id": "fake", "object": "chat.completion.chunk", "choices": [
+                {"index": 0, "delta": {"content": word if index == 0 else " " + word}, "finish_reason": None}]}
+            handler.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            handler.wfile.flush()
+            time.sleep(latency * 0.7 / len(words))
+        handler.wfile.write(b"data: [DONE]\n\n")
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# TRAFIC
+# ═══════════════════════════════════════════════════════════════════════════════
+
+PRESENTATIONS = [
+    "Bonjour à tous, je m'appelle Julie, j'ai 45 ans et j'habite dans le 69. "
+    "Je cherche des personnes alignées pour échanger et pourquoi pas plus ✨",
+    "Salut à tous ! Nouveau ici, moi c'est Marc, 52 ans, département 33",
+    "Hello, je me présente : Sophie, 38 ans, maman de 2 enfants, célibataire, région Bretagne",
+]
+
+DM_TRAFFIC = [
+    "Bonjour",
+    "c'est quoi Mad2Moi exactement ?",
+    "comment je fais pour m'inscrire ?",
+    "c'est gratuit ?",
+    "je me sens un peu seul en ce moment, pas facile de trouver quelqu'un",
+    "Il y a des gens près de Bordeaux sur le site ?",
+    "merci pour ta réponse !",
+]
+
+# (type d'update, poids) : surtout du bavardage groupe
+TRAFFIC_MIX = (
+    ("chatter", 55),
+    ("dm", 18),
+    ("join", 10),
+    ("presentation", 6),
+    ("callback", 6),
+    ("start", 5),
+)
+TRAFFIC_MIXES = {"default": TRAFFIC_MIX, "dm": (("dm", 1),)}
+
+
+class TrafficGenerator:
+    """Updates Telegram synthétiques (dict JSON, sans update_id)."""
+
+    def __init__(self, seed=42, users=20_000, mix=TRAFFIC_MIX):
+        from bench import GROUP_TRAFFIC
+
+        self.chatter = GROUP_TRAFFIC
+        self.users = users
+        self._random = random.Random(seed)
+        self._message_id = 0
+        self._kinds, weights = zip(*mix)
+        self._weights = list(weights)
+
+    def next(self):
+        kind = self._random.choices(self._kinds, self._weights)[0]
+        user = self._user()
+        if kind == "chatter":
+            return self._message(GROUP_CHAT, user, self._random.choice(self.chatter))
+        if kind == "presentation":
+            return self._message(GROUP_CHAT, user, self._random.choice(PRESENTATIONS))
+        if kind == "join":
+            members = [user] + [self._user() for _ in range(self._random.choice((0, 0, 0, 1, 3)))]
+            return self._message(GROUP_CHAT, user, None, new_chat_members=members)
+        if kind == "start":
+            return self._message(self._private(user), user, "/start",
+                                 entities=[{"type": "bot_command", "offset": 0, "length": 6}])
+        if kind == "callback":
+            return {"callback_query": {
+                "id": str(self._random.getrandbits(48)),
+                "from": user,
+                "chat_instance": "loadtest",
+                "data": self._random.choice(("menu_rencontres", "menu_amitie", "menu_decouverte")),
+                "message": self._message(self._private(user), BOT_USER, "menu")["message"],
+            }}
+        return self._message(self._private(user), user, self._random.choice(DM_TRAFFIC))
+
+    def _user(self):
+        user_id = self._random.randint(1, self.users)
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+    @staticmethod
+    def _private(user):
+        return {"id": user["id"], "type": "private", "first_name": user["first_name"]}
+
+    def _message(self, chat, user, text, **extra):
+        self._message_id += 1
+        message = {"message_id": self._message_id, "date": int(time.time()), "chat": chat, "from": user, **extra}
+        if text is not None:
+            message["text"] = text
+        return {"message": message}
+
+
+def replay(path):
+    """Updates d'un JSONL enregistré.
+
+    Une ligne est soit une update Telegram, soit un objet avec `text` ou
+    `body` (ex. requests.jsonl), rejoué comme DM d'un user stable par ligne.
+    """
+    with open(path, encoding="utf-8") as f:
+        for index, line in enumerate(f):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            record.pop("update_id", None)
+            if any(key in record for key in ("message", "callback_query", "edited_message")):
+                yield record
+                continue
+            text = record.get("text") or record.get("body")
+            if not text:
+                continue
+            user = {"id": 900_000 + index, "is_bot": False, "first_name": f"Replay{index}"}
+            yield {"message": {"message_id": index + 1, "date": int(time.time()), "from": user,
+                               "chat": {"id": user["id"], "type": "private"}, "text": text}}
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# RUN
+# ═══════════════════════════════════════════════════════════════════════════════
+
+
+def inject(api, updates, rate):
+    """Pousse les updates au débit visé (0 = d'un coup) ; retourne le nombre envoyé."""
+    started = time.monotonic()
+    count = 0
+    for count, update in enumerate(updates, 1):
+        if rate:
+            delay = started + (count - 1) / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        api.push(update)
+    return count
+
+
+def wait_drained(main, api, supervisor, expected, deadline, quiet=2.0):
+    """Attend la fin du traitement : updates lues, handlers passés, rafales DM, IA et envois terminés.
+
+    Une update sans handler ne compte jamais : on s'arrête aussi après `quiet` s sans
+    nouveau handler. Retourne (tout est vidé ?, instant du dernier handler).
+    """
+    last_handled, last_change = -1, time.monotonic()
+    while time.monotonic() < deadline:
+        handled = sum(main.HANDLER_LATENCY.counts())
+        if handled != last_handled:
+            last_handled, last_change = handled, time.monotonic()
+        gauges = main.stats_gauges()  # tous shards confondus
+        busy = (api.pending() or gauges["ai_in_flight"] or gauges["dm_pending"] or main.CHAT_MAILBOXES.in_flight
+                or sum(main.OUTBOX.depths().values()))
+        if not busy and (handled >= expected or handled and time.monotonic() - last_change > quiet):
+            return True, last_change
+        time.sleep(0.05)
+    return False, last_change
+
+
+def report(main, api, ai, supervisor, injected, handling, drained):
+    handled = sum(main.HANDLER_LATENCY.counts())
+    outbox = main.OUTBOX
+    queued = sum(outbox.depths().values())
+    gauges = main.stats_gauges()  # tous shards confondus
+    print()
+    print(f"loadtest — {injected} updates injectées, handlers terminés en {handling:.1f} s"
+          + ("" if drained else " (drain incomplet)"))
+    if supervisor:
+        print(f"  {'shards':<18} {supervisor.count} process, updates routées {supervisor.routed}")
+    print(f"  {'débit':<18} {handled / handling:8.1f} updates/s ({handled} handlers)")
+    print(f"  {'handlers':<18} {main.HANDLER_LATENCY.summary()}")
+    for labels in main.HANDLER_LATENCY.labels():
+        print(f"    • {labels[0]:<20} {main.HANDLER_LATENCY.summary(labels)}")
+    print(f"  {'OpenAI':<18} {main.OPENAI_LATENCY.summary()}  faux serveur: {dict(ai.calls)}")
+    print(f"  {'Bot API sortant':<18} {main.SEND_LATENCY.summary()}")
+    print(f"  {'envois':<18} {outbox.sent} ok, {outbox.retried} retry, "
+          f"{outbox.dropped + outbox.failed} perdus ({outbox.dropped} après 429, {outbox.failed} erreurs), "
+          f"{queued} encore en file {outbox.depths()}, {outbox.abandoned} abandonnés à l'arrêt")
+    print(f"  {'IA refusée':<18} pool plein {main.STATS.total('total_ai_busy')}, "
+          f"budget {gauges['budget_rejected']}")
+    if not supervisor:
+        client = main.LLM_CLIENT
+        print(f"  {'client IA':<18} {client.retries} retries, hedging {client.hedge_wins}/{client.hedges}, "
+              f"disjoncteur {client.breaker.state} (ouvert {client.breaker.opened}x, "
+              f"{main.STATS.total('total_ai_fallback')} réponses de secours)")
+        routes = main.INTENT_ROUTES.values()
+        print(f"  {'intents locaux':<18} {sum(routes.values()) - routes.get(main.LLM_ROUTE, 0)}/{sum(routes.values())} "
+              f"tours DM sans OpenAI {dict((name, count) for (name,), count in routes.items())}")
+        debouncer = main.DM_DEBOUNCER
+        print(f"  {'rafales DM':<18} {debouncer.merged} messages regroupés, "
+              f"{debouncer.superseded} réponses remplacées")
+        print(f"  {'keywords groupe':<18} {main.STATS.total('total_keyword_replies')} réponses, "
+              f"{main.STATS.total('total_keyword_suppressed')} évitées (cooldown {dict(main.KEYWORD_COOLDOWN.suppressed)})")
+        for pool in (main.CHAT_MAILBOXES, main.AI_POOL):
+            print(f"  {f'mailboxes {pool.name}':<18} attente {main.MAILBOX_WAIT.summary(pool.labels)}, "
+                  f"profondeur p99 {main.MAILBOX_DEPTH.quantile(0.99, pool.labels) or 0:.0f}, refus {pool.rejected}")
+    print(f"  {'erreurs':<18} {main.ERRORS.values() or '—'}")
+    print(f"  {'faux Bot API':<18} {dict(api.calls)} (429 injectés: {api.flooded})")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rate", type=float, default=50, help="updates/s injectées (0 = sans pause)")
+    parser.add_argument("--duration", type=float, default=30, help="durée du trafic synthétique (s)")
+    parser.add_argument("--count", type=int, help="nombre d'updates synthétiques (défaut : rate × duration)")
+    parser.add_argument("--replay", help="JSONL d'updates (ou de textes) à rejouer")
+    parser.add_argument("--mix", choices=TRAFFIC_MIXES, default="default", help="répartition du trafic synthétique")
+    parser.add_argument("--users", type=int, default=20_000, help="users synthétiques distincts")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--api-latency", type=float, default=0.03, help="latence du faux Bot API (s)")
+    parser.add_argument("--api-flood", type=float, default=0.0, help="part des envois refusés en 429")
+    parser.add_argument("--ai-latency", type=float, default=1.5, help="latence médiane OpenAI (s)")
+    parser.add_argument("--ai-sigma", type=float, default=0.5, help="dispersion log-normale OpenAI")
+    parser.add_argument("--ai-errors", type=float, default=0.0, help="part des appels OpenAI en 429/500")
+    parser.add_argument("--shards", type=int, default=0, help="process workers (0 = process unique)")
+    parser.add_argument("--drain", type=float, default=60, help="attente max de fin de traitement (s)")
+    parser.add_argument("--verbose", action="store_true", help="garde les logs INFO du bot")
+    return parser.parse_args(argv)
+
+
+def run(args):
+    api = FakeBotAPI(args.api_latency, args.api_flood)
+    ai = FakeOpenAI(args.ai_latency, args.ai_sigma, args.ai_errors)
+    api.start()
+    ai.start()
+
+    # Hérité par les shards (process spawn)
+    os.environ.update(TELEGRAM_TOKEN=TOKEN, OPENAI_API_KEY="sk-loadtest", OPENAI_API_BASE=ai.base_url)
+    os.environ.setdefault("STATE_BACKEND", "memory")
+    os.environ.setdefault("METRICS_PORT", "0")
+    os.environ.setdefault("ANALYTICS_DIR", "")
+    os.environ.setdefault("WELCOMED_PATH", "")
+    if not args.verbose:
+        os.environ["LOG_LEVEL"] = "WARNING"
+    import main
+
+    main.OUTBOX.start()
+    if args.shards:
+        updater, supervisor = main.build_router(args.shards, base_url=api.base_url)
+    else:
+        updater, supervisor = main.build_updater(base_url=api.base_url), None
+    updater.start_polling(poll_interval=0, timeout=1)
+    while supervisor and not supervisor.ready():
+        time.sleep(0.1)
+
+    if args.replay:
+        updates = replay(args.replay)
+    else:
+        generator = TrafficGenerator(args.seed, args.users, TRAFFIC_MIXES[args.mix])
+        count = args.count or int(args.rate * args.duration)
+        updates = (generator.next() for _ in range(count))
+
+    started = time.monotonic()
+    injected = inject(api, updates, args.rate)
+    drained, handlers_done = wait_drained(main, api, supervisor, injected, time.monotonic() + args.drain)
+
+    updater.stop()
+    if supervisor:
+        supervisor.stop()
+    else:
+        main.CHAT_MAILBOXES.shutdown()
+        main.flush_dm_bursts(updater.dispatcher)
+    main.AI_POOL.shutdown()
+    main.OUTBOX.stop(timeout=1)
+    report(main, api, ai, supervisor, injected, handlers_done - started, drained)
+
+
+if __name__ == "__main__":
+    run(parse_args(sys.argv[1:]))
@@ -1,10 +1,42 @@
+import abc
+import atexit
 import os
+import gzip
+import re
+import json
+import hashlib
+import heapq
+import hmac
+import html
+import itertools
+import math
+import mmap
+import multiprocessing
+import pickle
+import queue
+import random
+import secrets
+import signal
+import sqlite3
+import struct
 import logging
 import time
-from collections import defaultdict
+import threading
+import sys
+import unicodedata
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, deque, OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging.handlers import QueueHandler, QueueListener
+
+BOOT_STARTED = time.monotonic()  # avant les imports lourds : mesure du démarrage à froid
+
 from telegram import (
     Update,
+    Message,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     ChatAction,
@@ -16,19 +48,122 @@ from telegram.ext import (
     CallbackContext,
     CommandHandler,
     CallbackQueryHandler,
+    TypeHandler,
 )
-import openai
+from telegram.error import RetryAfter, TelegramError
+from telegram.utils.helpers import escape_markdown
+import requests
+from requests.adapters import HTTPAdapter
+
+IMPORTS_SECONDS = time.monotonic() - BOOT_STARTED
+openai = None  # importé au 1er appel IA (load_openai) : l'import le plus lourd du boot
 
 # ═══════════════════════════════════════════════════════════════════════════════
 # CONFIG / LOGS
 # ═══════════════════════════════════════════════════════════════════════════════
 
-logging.basicConfig(
-    format="%(asctime)s | %(levelname)s | %(message)s",
-    level=logging.INFO,
-)
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")  # text | json
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+# Échantillonnage par événement, ex. "handler=0.1,keyword=0.05" (warnings et erreurs jamais filtrés)
+LOG_SAMPLING = {
+    event.strip(): float(rate)
+    for event, _, rate in (item.partition("=") for item in os.environ.get("LOG_SAMPLING", "").split(","))
+    if event.strip()
+}
+
+
+class JsonFormatter(logging.Formatter):
+    """Une ligne JSON par log (ts, level, event, msg, exc)."""
+
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, "event", None):
+            entry["event"] = record.event
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class LogSampler(logging.Filter):
+    """Ne garde qu'une fraction des logs d'un événement (extra={"event": ...})."""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self.sampled_out = 0
+
+    def filter(self, record):
+        rate = self.rates.get(getattr(record, "event", None))
+        if rate is None or record.levelno >= logging.WARNING or random.random() < rate:
+            return True
+        self.sampled_out += 1
+        return False
+
+
+class LogQueueHandler(QueueHandler):
+    """Côté threads du bot : le record part tel quel dans la file, sans formatage.
+
+    Message et arguments sont formatés par le thread du QueueListener. File
+    pleine : les logs info/debug sont perdus (comptés), les warnings et
+    erreurs attendent leur place.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if record.levelno < logging.WARNING:
+                self.dropped += 1
+                return
+            self.queue.put(record)
+
+
+def setup_logging(sampler):
+    """Logs via file + thread d'écriture ; renvoie (handler de file, listener)."""
+    output = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter("%(asctime)s | %(levelname)s | %(message)s"))
+    # Champs jamais affichés : pas de lookup process (ni thread en texte) par log, via les
+    # drapeaux publics ; pathname/lineno restent calculés mais aucun format ne les affiche
+    logging.logThreads = LOG_FORMAT == "json"
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+    handler = LogQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    handler.addFilter(sampler)
+    listener = QueueListener(handler.queue, output)
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL)
+    listener.start()
+    atexit.register(listener.stop)  # vide la file à la sortie
+    return handler, listener
+
+
+LOG_SAMPLER = LogSampler(LOG_SAMPLING)
+LOG_QUEUE_HANDLER, LOG_LISTENER = setup_logging(LOG_SAMPLER)
 logger = logging.getLogger("Mad2MoiBot")
 
+# Événements échantillonnables (LOG_SAMPLING)
+LOG_HANDLER_EVENT = {"event": "handler"}
+LOG_KEYWORD_EVENT = {"event": "keyword"}
+LOG_AI_EVENT = {"event": "ai"}
+
 # Tokens / clés
 TELEGRAM_TOKEN = os.environ["TELEGRAM_TOKEN"]
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
@@ -36,9 +171,134 @@ OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 if not OPENAI_API_KEY:
     logger.warning("⚠️  OPENAI_API_KEY non défini — IA désactivée")
 else:
-    openai.api_key = OPENAI_API_KEY
     logger.info("✅ OPENAI_API_KEY chargée")
 
+# Pool IA : threads dédiés, file bornée, timeout par requête
+AI_WORKERS = int(os.environ.get("AI_WORKERS", "4"))
+AI_QUEUE_SIZE = int(os.environ.get("AI_QUEUE_SIZE", "16"))
+AI_MAILBOX_SIZE = int(os.environ.get("AI_MAILBOX_SIZE", "2"))  # tours IA en attente par user, en plus du tour en cours
+AI_TIMEOUT = float(os.environ.get("AI_TIMEOUT", "20"))
+
+# Streaming IA : 1er message dès la 1re phrase, puis edits espacés (limites Telegram)
+AI_STREAMING = os.environ.get("AI_STREAMING", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", "1.5"))
+
+# Cache réponses IA : questions fréquentes, servies jusqu'à AI_CACHE_MAX_HISTORY tours d'historique,
+# mais mises en cache seulement depuis une conversation vide (aucun contexte d'un user chez un autre)
+AI_CACHE_SIZE = int(os.environ.get("AI_CACHE_SIZE", "512"))
+AI_CACHE_MAX_BYTES = int(os.environ.get("AI_CACHE_MAX_BYTES", str(1024 * 1024)))
+AI_CACHE_TTL = int(os.environ.get("AI_CACHE_TTL", str(6 * 60 * 60)))
+AI_CACHE_MAX_HISTORY = int(os.environ.get("AI_CACHE_MAX_HISTORY", "2"))
+
+# Persistance de l'état : "sqlite" (WAL, écritures différées) ou "memory"
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "sqlite")
+STATE_DB_PATH = os.environ.get("STATE_DB_PATH", "mad2moi_state.db")
+STATE_FLUSH_INTERVAL = float(os.environ.get("STATE_FLUSH_INTERVAL", "2"))
+
+# Snapshot d'arrêt (SIGTERM) rechargé au boot suivant ; "" = désactivé
+SNAPSHOT_PATH = os.environ.get("SNAPSHOT_PATH", "mad2moi_snapshot.pickle")
+SNAPSHOT_MAX_AGE = int(os.environ.get("SNAPSHOT_MAX_AGE", str(60 * 60)))
+SNAPSHOT_VERSION = 2
+
+# Users déjà accueillis (présentations), par groupe : "exact" (ids triés, 8 o/user) ou "bloom"
+# (faux positifs = quelques welcomes manqués) ; fichier mmap rechargé au boot, "" = non persisté
+WELCOMED_FILTER = os.environ.get("WELCOMED_FILTER", "exact")
+WELCOMED_FP_RATE = float(os.environ.get("WELCOMED_FP_RATE", "0.001"))
+WELCOMED_BLOOM_CAPACITY = int(os.environ.get("WELCOMED_BLOOM_CAPACITY", "10000"))
+WELCOMED_PATH = os.environ.get("WELCOMED_PATH", "mad2moi_welcomed.bin")
+# Réécriture du fichier au plus toutes les N s (le fichier entier est réécrit) ; toujours à l'arrêt
+WELCOMED_SAVE_INTERVAL = float(os.environ.get("WELCOMED_SAVE_INTERVAL", "60"))
+
+# Journal analytics : événements append-only, segments gzip tournants (analytics.py) ; "" = désactivé
+ANALYTICS_DIR = os.environ.get("ANALYTICS_DIR", "analytics")
+ANALYTICS_FLUSH_INTERVAL = float(os.environ.get("ANALYTICS_FLUSH_INTERVAL", "5"))
+ANALYTICS_BUFFER = int(os.environ.get("ANALYTICS_BUFFER", "50000"))
+ANALYTICS_SEGMENT_BYTES = int(os.environ.get("ANALYTICS_SEGMENT_BYTES", str(8 * 1024 * 1024)))
+ANALYTICS_SEGMENT_SECONDS = int(os.environ.get("ANALYTICS_SEGMENT_SECONDS", str(60 * 60)))
+
+# Relances DM : délais après /start, dépilées par lots
+FOLLOWUP_DELAYS = [24 * 60 * 60, 72 * 60 * 60, 7 * 24 * 60 * 60]
+FOLLOWUP_TICK = int(os.environ.get("FOLLOWUP_TICK", "30"))
+FOLLOWUP_BATCH = int(os.environ.get("FOLLOWUP_BATCH", "200"))
+
+# File d'envoi : limites Telegram (30 msg/s global, 20 msg/min par groupe, ~1 msg/s par DM)
+OUTBOUND_GLOBAL_RATE = float(os.environ.get("OUTBOUND_GLOBAL_RATE", "30"))
+OUTBOUND_GROUP_RATE = float(os.environ.get("OUTBOUND_GROUP_RATE", str(20 / 60)))
+OUTBOUND_GROUP_BURST = int(os.environ.get("OUTBOUND_GROUP_BURST", "5"))
+OUTBOUND_PRIVATE_RATE = float(os.environ.get("OUTBOUND_PRIVATE_RATE", "1"))
+OUTBOUND_PRIVATE_BURST = int(os.environ.get("OUTBOUND_PRIVATE_BURST", "3"))
+OUTBOUND_MAX_QUEUE = int(os.environ.get("OUTBOUND_MAX_QUEUE", "5000"))
+OUTBOUND_MAX_RETRIES = int(os.environ.get("OUTBOUND_MAX_RETRIES", "3"))
+OUTBOUND_WORKERS = int(os.environ.get("OUTBOUND_WORKERS", "8"))
+
+# Vagues d'arrivées : un welcome par fenêtre et par groupe
+WELCOME_COALESCE_WINDOW = float(os.environ.get("WELCOME_COALESCE_WINDOW", "15"))
+WELCOME_REPLACE_PREVIOUS = os.environ.get("WELCOME_REPLACE_PREVIOUS", "1") == "1"
+WELCOME_MAX_NAMES = 10
+
+# Réponses keyword en groupe : au plus une par groupe et une par user / groupe par fenêtre (s, 0 = sans limite)
+KEYWORD_CHAT_COOLDOWN = float(os.environ.get("KEYWORD_CHAT_COOLDOWN", "300"))
+KEYWORD_USER_COOLDOWN = float(os.environ.get("KEYWORD_USER_COOLDOWN", str(60 * 60)))
+KEYWORD_COOLDOWN_MAX_ENTRIES = int(os.environ.get("KEYWORD_COOLDOWN_MAX_ENTRIES", "100000"))
+
+# Mailboxes par chat : handlers en série par chat / user, chats en parallèle (0 = thread du dispatcher)
+CHAT_WORKERS = int(os.environ.get("CHAT_WORKERS", "8"))
+CHAT_QUEUE_SIZE = int(os.environ.get("CHAT_QUEUE_SIZE", "5000"))
+CHAT_MAILBOX_SIZE = int(os.environ.get("CHAT_MAILBOX_SIZE", "100"))  # au-delà, les updates du chat sont ignorées (sauf joins et commandes)
+
+# Rafales de DM : messages rapprochés d'un user regroupés en un seul tour IA (0 = désactivé)
+DM_DEBOUNCE_WINDOW = float(os.environ.get("DM_DEBOUNCE_WINDOW", "1.5"))
+DM_DEBOUNCE_MAX_WAIT = float(os.environ.get("DM_DEBOUNCE_MAX_WAIT", "6"))
+DM_DEBOUNCE_MAX_MESSAGES = int(os.environ.get("DM_DEBOUNCE_MAX_MESSAGES", "6"))
+
+# Routeur d'intents : réponses toutes faites aux DM FAQ, sans OpenAI
+INTENT_ROUTING = os.environ.get("INTENT_ROUTING", "1") == "1"
+INTENT_THRESHOLD = float(os.environ.get("INTENT_THRESHOLD", "0.8"))
+
+# Mémoire conversations : oubli après inactivité + plafond global (octets estimés)
+CONVERSATION_IDLE_TTL = int(os.environ.get("CONVERSATION_IDLE_TTL", str(72 * 60 * 60)))
+CONVERSATION_MAX_BYTES = int(os.environ.get("CONVERSATION_MAX_BYTES", str(64 * 1024 * 1024)))
+MEMORY_SWEEP_INTERVAL = int(os.environ.get("MEMORY_SWEEP_INTERVAL", "300"))
+
+# Prompt IA : budget en tokens (estimation locale), anciens tours résumés
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", "1600"))
+SUMMARY_MAX_TOKENS = int(os.environ.get("SUMMARY_MAX_TOKENS", "250"))
+
+# Client OpenAI : timeouts, retries (backoff + jitter), hedging optionnel, disjoncteur
+AI_CONNECT_TIMEOUT = float(os.environ.get("AI_CONNECT_TIMEOUT", "3"))
+AI_MAX_RETRIES = int(os.environ.get("AI_MAX_RETRIES", "2"))
+AI_BACKOFF_BASE = 0.5   # s, doublé à chaque essai
+AI_BACKOFF_MAX = 4.0
+AI_HEDGE = os.environ.get("AI_HEDGE", "0") == "1"
+AI_HEDGE_MIN_SAMPLES = 50  # mesures de 1er token avant d'estimer le p95
+AI_BREAKER_THRESHOLD = int(os.environ.get("AI_BREAKER_THRESHOLD", "5"))
+AI_BREAKER_COOLDOWN = float(os.environ.get("AI_BREAKER_COOLDOWN", "30"))
+
+# Budget global des appels OpenAI (tous users confondus)
+AI_RPM = int(os.environ.get("AI_RPM", "300"))
+AI_MAX_CONCURRENCY = int(os.environ.get("AI_MAX_CONCURRENCY", str(AI_WORKERS)))
+
+# Réception des updates : "polling" (défaut) ou "webhook" (serveur HTTP intégré)
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")  # URL publique ; absente = pas d'enregistrement (tests locaux)
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/webhook")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("PORT", os.environ.get("WEBHOOK_PORT", "8443")))
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+
+# Sharding : N process workers routés par hachage cohérent du chat / user (0 = un seul process)
+SHARD_WORKERS = int(os.environ.get("SHARD_WORKERS", "0"))
+SHARD_REPLICAS = 64              # points par shard sur l'anneau
+SHARD_REPORT_INTERVAL = 1.0      # s entre deux remontées de métriques d'un shard
+SHARD_NAME = None                # "i/N" dans un process shard
+
+# Métriques : /metrics Prometheus sur un port local (0 = désactivé)
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9108"))
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+DEPTH_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64)  # profondeur des mailboxes (tâches devant soi)
+METRICS_FOLD_AT = 4096  # mesures en attente avant agrégation sur le chemin d'écriture
+
 # URLs
 M2M_BASE_URL = "https://www.mad2moi.com/"
 FB_MAD2MOI_URL = "https://www.facebook.com/groups/1095227448813415/?ref=share"
@@ -48,23 +308,1053 @@ M2M_CAMPAIGN = "non_vax_groupe"
 # STOCKAGE EN MÉMOIRE
 # ═══════════════════════════════════════════════════════════════════════════════
 
-user_conversations = defaultdict(list)
+ROLE_USER = sys.intern("user")
+ROLE_ASSISTANT = sys.intern("assistant")
+
+
+class Conversation:
+    __slots__ = ("turns", "summary", "last_seen", "size")
+
+    def __init__(self, now):
+        self.turns = []  # (rôle interné, texte, tokens estimés)
+        self.summary = ""  # résumé glissant des tours sortis de la fenêtre
+        self.last_seen = now
+        self.size = CONVERSATION_OVERHEAD
+
+
+# Estimation mémoire : objet Conversation + liste, puis tuple + slot de liste par tour
+CONVERSATION_OVERHEAD = 250
+TURN_OVERHEAD = 64 + 8
+# Tokens ajoutés par OpenAI autour de chaque message (rôle, séparateurs)
+MESSAGE_TOKEN_OVERHEAD = 4
+
+
+class ConversationStore:
+    """Historique IA par user, borné.
+
+    Tours stockés en tuples (rôle interné, texte, tokens) plutôt qu'en dicts,
+    au plus `max_turns` par user : les plus anciens sont repliés dans un
+    résumé glissant (summarize_turns), comme ceux qui ne tiennent plus dans
+    le budget tokens du prompt (prompt_window). Ordre LRU : l'user le moins récent est oublié
+    quand le plafond `max_bytes` est dépassé, et sweep() oublie ceux inactifs
+    depuis plus de `idle_ttl` secondes. `on_evict(user_id)` est appelé pour
+    chaque user oublié (suppression côté persistance).
+    """
+
+    def __init__(self, max_turns, idle_ttl, max_bytes, on_evict=None):
+        self.max_turns = max_turns
+        self.idle_ttl = idle_ttl
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._users)
+
+    def length(self, user_id):
+        conversation = self._users.get(user_id)
+        return len(conversation.turns) if conversation else 0
+
+    def has_summary(self, user_id):
+        """True si des tours anciens ont été repliés dans le résumé (contexte hors fenêtre)."""
+        conversation = self._users.get(user_id)
+        return bool(conversation and conversation.summary)
+
+    def messages(self, user_id):
+        """Historique au format OpenAI (copie)."""
+        with self._lock:
+            conversation = self._users.get(user_id)
+            turns = list(conversation.turns) if conversation else []
+        return [{"role": role, "content": content} for role, content, _ in turns]
+
+    def snapshot(self, user_id):
+        """État persistable : {"summary", "messages"} ou None."""
+        with self._lock:
+            conversation = self._users.get(user_id)
+            if conversation is None:
+                return None
+            summary, turns = conversation.summary, list(conversation.turns)
+        return {
+            "summary": summary,
+            "messages": [{"role": role, "content": content} for role, content, _ in turns],
+        }
+
+    def prompt_window(self, user_id, budget):
+        """(résumé, [(rôle, texte, tokens)]) tenant dans `budget` tokens.
+
+        Les tours les plus récents sont gardés tant qu'ils tiennent (le dernier
+        toujours) ; les plus anciens sont repliés dans le résumé, qui a sa
+        réserve de SUMMARY_MAX_TOKENS.
+        """
+        with self._lock:
+            conversation = self._users.get(user_id)
+            if conversation is None:
+                return "", []
+            turns = conversation.turns
+            turn_budget = budget - SUMMARY_MAX_TOKENS
+            used = keep = 0
+            for _, _, tokens in reversed(turns):
+                cost = tokens + MESSAGE_TOKEN_OVERHEAD
+                if keep and used + cost > turn_budget:
+                    break
+                used += cost
+                keep += 1
+            if keep < len(turns):
+                self._collapse(conversation, len(turns) - keep)
+            return conversation.summary, list(conversation.turns)
+
+    def append(self, user_id, role, content):
+        now = time.monotonic()
+        with self._lock:
+            conversation = self._users.get(user_id)
+            if conversation is None:
+                conversation = self._users[user_id] = Conversation(now)
+                self.bytes += conversation.size
+            else:
+                self._users.move_to_end(user_id)
+                conversation.last_seen = now
+            self._add_turn(conversation, role, content)
+            evicted = self._evict_over_cap()
+        self._notify(evicted)
+
+    def set(self, user_id, messages, summary=""):
+        """Remplace l'historique (rechargement au démarrage)."""
+        self.reset(user_id)
+        for message in messages:
+            role = ROLE_ASSISTANT if message["role"] == ROLE_ASSISTANT else ROLE_USER
+            self.append(user_id, role, message["content"])
+        if summary:
+            with self._lock:
+                conversation = self._users.get(user_id)
+                if conversation:
+                    self._set_summary(conversation, summary)
+
+    def reset(self, user_id):
+        with self._lock:
+            conversation = self._users.pop(user_id, None)
+            if conversation:
+                self.bytes -= conversation.size
+
+    def sweep(self, now=None):
+        """Oublie les users inactifs ; renvoie leur nombre."""
+        deadline = (time.monotonic() if now is None else now) - self.idle_ttl
+        evicted = []
+        with self._lock:
+            while self._users:
+                user_id, conversation = next(iter(self._users.items()))
+                if conversation.last_seen >= deadline:
+                    break
+                self._drop(user_id)
+                evicted.append(user_id)
+        self._notify(evicted)
+        return len(evicted)
+
+    def _add_turn(self, conversation, role, content):
+        conversation.turns.append((role, content, estimate_tokens(content)))
+        added = TURN_OVERHEAD + sys.getsizeof(content)
+        conversation.size += added
+        self.bytes += added
+        if len(conversation.turns) > self.max_turns:
+            self._collapse(conversation, len(conversation.turns) - self.max_turns)
+
+    def _collapse(self, conversation, count):
+        """Replie les `count` tours les plus anciens dans le résumé."""
+        dropped = conversation.turns[:count]
+        del conversation.turns[:count]
+        freed = sum(TURN_OVERHEAD + sys.getsizeof(content) for _, content, _ in dropped)
+        conversation.size -= freed
+        self.bytes -= freed
+        self._set_summary(conversation, summarize_turns(conversation.summary, dropped))
+
+    def _set_summary(self, conversation, summary):
+        delta = sys.getsizeof(summary) - sys.getsizeof(conversation.summary)
+        conversation.summary = summary
+        conversation.size += delta
+        self.bytes += delta
+
+    def _evict_over_cap(self):
+        evicted = []
+        while self.bytes > self.max_bytes and len(self._users) > 1:
+            user_id = next(iter(self._users))
+            self._drop(user_id)
+            evicted.append(user_id)
+        return evicted
+
+    def _drop(self, user_id):
+        self.bytes -= self._users.pop(user_id).size
+        self.evicted += 1
+
+    def _notify(self, evicted):
+        if self.on_evict:
+            for user_id in evicted:
+                self.on_evict(user_id)
+
+
 MAX_HISTORY = 5
+user_conversations = ConversationStore(
+    MAX_HISTORY * 2,
+    CONVERSATION_IDLE_TTL,
+    CONVERSATION_MAX_BYTES,
+    on_evict=lambda user_id: STATE.mark("conversations", user_id),
+)
 
-user_last_messages = defaultdict(list)
 RATE_LIMIT_MESSAGES = 5
 RATE_LIMIT_WINDOW = 60
 
-# Anti-spam présentations : évite de répondre 2x au même user
-users_welcomed_presentation = set()
+class SortedIdSet:
+    """Ensemble exact d'ids : array('q') trié, 8 octets par membre (~60+ dans un set).
+
+    Peut lire directement un buffer (mmap du fichier) : recopié en array au 1er ajout.
+    """
+
+    KIND = 0
+
+    def __init__(self, ids=()):
+        self._ids = array("q", sorted(set(ids)))
+
+    @classmethod
+    def from_buffer(cls, buffer):
+        seen = cls.__new__(cls)
+        seen._ids = buffer.cast("q")
+        return seen
+
+    def __contains__(self, member):
+        i = bisect_left(self._ids, member)
+        return i < len(self._ids) and self._ids[i] == member
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, member):
+        """True si le membre est nouveau."""
+        i = bisect_left(self._ids, member)
+        if i < len(self._ids) and self._ids[i] == member:
+            return False
+        if not isinstance(self._ids, array):
+            self._ids = array("q", self._ids)
+        self._ids.insert(i, member)
+        return True
+
+    def merge(self, other):
+        return SortedIdSet(itertools.chain(self, other))
+
+    @property
+    def nbytes(self):
+        return len(self._ids) * 8
+
+    def to_bytes(self):
+        return bytes(self._ids)
+
+
+def _splitmix64(x):
+    x = (x + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return x ^ (x >> 31)
+
+
+class BloomFilter:
+    """Filtre de Bloom extensible : ~2 octets par membre à 0,1 % de faux positifs.
+
+    Couche pleine : nouvelle couche de capacité double et de taux moitié, le
+    taux global reste sous `fp_rate`. `in` peut répondre vrai à tort, jamais faux.
+    """
+
+    KIND = 1
+    HEADER = struct.Struct("<QdI")  # capacité initiale, taux, nb de couches
+    LAYER = struct.Struct("<QQIQ")  # bits, capacité, k, membres
+
+    def __init__(self, capacity, fp_rate):
+        self.capacity = capacity
+        self.fp_rate = fp_rate
+        self._layers = []  # [bits, nbits, k, capacité, membres]
+        self._add_layer()
+
+    def _add_layer(self):
+        capacity = self.capacity << len(self._layers)
+        fp_rate = self.fp_rate / 2 ** (len(self._layers) + 1)
+        nbits = max(64, math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+        nbits = (nbits + 63) // 64 * 64
+        k = max(1, round(nbits / capacity * math.log(2)))
+        self._layers.append([bytearray(nbits // 8), nbits, k, capacity, 0])
+
+    @staticmethod
+    def _positions(member, nbits, k):
+        h1 = _splitmix64(member)
+        h2 = _splitmix64(h1) | 1
+        return [(h1 + i * h2) % nbits for i in range(k)]
+
+    def __contains__(self, member):
+        for bits, nbits, k, _, _ in self._layers:
+            if all(bits[pos >> 3] >> (pos & 7) & 1 for pos in self._positions(member, nbits, k)):
+                return True
+        return False
+
+    def __len__(self):
+        return sum(layer[4] for layer in self._layers)
+
+    def add(self, member):
+        """True si le membre est nouveau (ou pas encore couvert par un faux positif)."""
+        if member in self:
+            return False
+        layer = self._layers[-1]
+        if layer[4] >= layer[3]:
+            self._add_layer()
+            layer = self._layers[-1]
+        if not isinstance(layer[0], bytearray):
+            layer[0] = bytearray(layer[0])
+        bits = layer[0]
+        for pos in self._positions(member, layer[1], layer[2]):
+            bits[pos >> 3] |= 1 << (pos & 7)
+        layer[4] += 1
+        return True
+
+    def merge(self, other):
+        """Union : les couches de `other` s'ajoutent (pleines, on n'y écrit plus)."""
+        self._layers[-1:-1] = other._layers
+        return self
+
+    @property
+    def nbytes(self):
+        return sum(len(layer[0]) for layer in self._layers)
+
+    def to_bytes(self):
+        parts = [self.HEADER.pack(self.capacity, self.fp_rate, len(self._layers))]
+        for bits, nbits, k, capacity, count in self._layers:
+            parts += [self.LAYER.pack(nbits, capacity, k, count), bytes(bits)]
+        return b"".join(parts)
+
+    @classmethod
+    def from_buffer(cls, buffer):
+        seen = cls.__new__(cls)
+        seen.capacity, seen.fp_rate, layers = cls.HEADER.unpack_from(buffer)
+        seen._layers = []
+        offset = cls.HEADER.size
+        for _ in range(layers):
+            nbits, capacity, k, count = cls.LAYER.unpack_from(buffer, offset)
+            offset += cls.LAYER.size
+            seen._layers.append([buffer[offset:offset + nbits // 8], nbits, k, capacity, count])
+            offset += nbits // 8
+        return seen
+
+
+class SeenRegistry:
+    """Membres déjà vus, un ensemble compact par scope (groupe).
+
+    `factory()` crée l'ensemble d'un nouveau scope (SortedIdSet ou BloomFilter).
+    Le scope 0 (ancien état global, sans groupe) vaut pour tous les groupes.
+    Un seul fichier : en-tête, index (scope, type, offset, taille), blobs alignés
+    sur 8 octets, lus par mmap sans copie jusqu'au premier ajout.
+    """
+
+    MAGIC = b"M2MSEEN1"
+    HEADER = struct.Struct("<8sI")
+    ENTRY = struct.Struct("<qBQQ")
+    KINDS = {SortedIdSet.KIND: SortedIdSet.from_buffer, BloomFilter.KIND: BloomFilter.from_buffer}
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._scopes = {}
+        self._lock = threading.Lock()
+        self._mmaps = []  # fichiers chargés, gardés ouverts tant que leurs ensembles en dépendent
+        self._dirty = set()  # scopes modifiés depuis la dernière écriture
+        self._written_at = float("-inf")
+
+    def seen(self, scope, member):
+        for key in (0, scope):
+            seen = self._scopes.get(key)
+            if seen is not None and member in seen:
+                return True
+        return False
+
+    def add(self, scope, member):
+        """True si le membre n'était pas encore vu dans ce scope (ni globalement)."""
+        with self._lock:
+            if self.seen(scope, member):
+                return False
+            seen = self._scopes.get(scope)
+            if seen is None:
+                seen = self._scopes[scope] = self.factory()
+            seen.add(member)
+            self._dirty.add(scope)
+            return True
+
+    @property
+    def dirty(self):
+        return bool(self._dirty)
+
+    def __len__(self):
+        return sum(len(seen) for seen in self._scopes.values())
+
+    @property
+    def scopes(self):
+        return len(self._scopes)
+
+    @property
+    def nbytes(self):
+        return sum(seen.nbytes for seen in self._scopes.values())
+
+    def _absorb(self, scope, seen):
+        current = self._scopes.get(scope)
+        if current is None:
+            self._scopes[scope] = seen
+        elif isinstance(seen, SortedIdSet) and isinstance(current, SortedIdSet):
+            self._scopes[scope] = current.merge(seen)
+        elif isinstance(seen, SortedIdSet) or isinstance(current, SortedIdSet):
+            exact, other = (seen, current) if isinstance(seen, SortedIdSet) else (current, seen)
+            for member in exact:
+                other.add(member)
+            self._scopes[scope] = other
+        else:
+            self._scopes[scope] = current.merge(seen)
+
+    def dump(self, path, min_interval=0):
+        """Réécrit le fichier (tmp + rename) s'il y a eu des ajouts ; True si écrit.
+
+        Pas plus d'une réécriture par `min_interval` s : les scopes modifiés
+        entre-temps restent sales et partent dans l'écriture suivante.
+        """
+        with self._lock:
+            if not self._dirty or time.monotonic() - self._written_at < min_interval:
+                return False
+            blobs = [(scope, seen.KIND, seen.to_bytes()) for scope, seen in self._scopes.items()]
+            changed, self._dirty = len(self._dirty), set()
+            self._written_at = time.monotonic()
+        offset = self.HEADER.size + self.ENTRY.size * len(blobs)
+        index, data = [], []
+        for scope, kind, blob in blobs:
+            padding = -offset % 8
+            data += [b"\0" * padding, blob]
+            offset += padding
+            index.append(self.ENTRY.pack(scope, kind, offset, len(blob)))
+            offset += len(blob)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(self.HEADER.pack(self.MAGIC, len(blobs)))
+            f.writelines(index)
+            f.writelines(data)
+        os.replace(tmp_path, path)
+        logger.debug("💾 %s réécrit: %d scopes modifiés sur %d", path, changed, len(blobs))
+        return True
+
+    def load(self, path, owns=None):
+        """Ajoute les scopes du fichier (mmap) ; `owns(scope)` filtre les groupes d'un shard."""
+        with open(path, "rb") as f:
+            if not os.fstat(f.fileno()).st_size:
+                return 0
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapped)
+        magic, count = self.HEADER.unpack_from(view)
+        if magic != self.MAGIC:
+            raise ValueError(f"format inconnu: {magic!r}")
+        loaded = 0
+        with self._lock:
+            for i in range(count):
+                scope, kind, offset, size = self.ENTRY.unpack_from(view, self.HEADER.size + i * self.ENTRY.size)
+                if scope and owns and not owns(scope):
+                    continue
+                self._absorb(scope, self.KINDS[kind](view[offset:offset + size]))
+                loaded += 1
+        self._mmaps.append(mapped)
+        return loaded
+
+
+def make_seen():
+    if WELCOMED_FILTER == "bloom":
+        return BloomFilter(WELCOMED_BLOOM_CAPACITY, WELCOMED_FP_RATE)
+    return SortedIdSet()
+
+
+# Anti-spam présentations : évite de répondre 2x au même user dans un groupe
+users_welcomed_presentation = SeenRegistry(make_seen)
+
+
+
+class Ring:
+    """Anneau de `size` seaux consécutifs (minutes ou heures epoch) ; taille fixe."""
+
+    __slots__ = ("values", "last")
+
+    def __init__(self, size):
+        self.values = [0] * size
+        self.last = 0  # dernier seau écrit (epoch)
+
+    def add(self, at, n):
+        size = len(self.values)
+        if at > self.last:
+            if at - self.last >= size:
+                self.values = [0] * size
+            else:
+                for bucket in range(self.last + 1, at + 1):
+                    self.values[bucket % size] = 0
+            self.last = at
+        elif at <= self.last - size:
+            return  # trop ancien pour l'anneau
+        self.values[at % size] += n
+
+    def sum(self, start, end):
+        """Total des seaux start..end (inclus) encore présents."""
+        size = len(self.values)
+        return sum(self.values[bucket % size] for bucket in range(max(start, self.last - size + 1), min(end, self.last) + 1))
+
+    def merge(self, other):
+        size = len(other.values)
+        for bucket in range(other.last - size + 1, other.last + 1):
+            if other.values[bucket % size]:
+                self.add(bucket, other.values[bucket % size])
+
+    def export(self):
+        size = len(self.values)
+        return {bucket: self.values[bucket % size] for bucket in range(self.last - size + 1, self.last + 1)
+                if self.values[bucket % size]}
+
+
+STATS_MINUTES = 120  # 2 h par minute : dernière heure vs la précédente
+STATS_HOURS = 48     # 2 jours par heure : dernières 24 h vs les 24 h d'avant
+
+
+class RollingCount:
+    """Total depuis le boot + anneaux par minute et par heure."""
+
+    __slots__ = ("total", "minutes", "hours")
+
+    def __init__(self):
+        self.total = 0
+        self.minutes = Ring(STATS_MINUTES)
+        self.hours = Ring(STATS_HOURS)
+
+    def add(self, n, minute):
+        self.total += n
+        minutes, hours, hour = self.minutes, self.hours, minute // 60
+        # Cas courant : même minute / même heure que l'écriture précédente
+        if minute == minutes.last:
+            minutes.values[minute % STATS_MINUTES] += n
+        else:
+            minutes.add(minute, n)
+        if hour == hours.last:
+            hours.values[hour % STATS_HOURS] += n
+        else:
+            hours.add(hour, n)
+
+    def merge(self, other):
+        self.total += other.total
+        self.minutes.merge(other.minutes)
+        self.hours.merge(other.hours)
+
+
+class StatsCounters:
+    """Compteurs métier sans course entre threads, avec historique à taille fixe.
+
+    inc() n'écrit que dans les compteurs du thread appelant (threading.local) :
+    pas de verrou ni de += perdu. Les lectures additionnent les threads ; ceux
+    qui sont morts sont repliés dans la base. Chaque compteur garde 120 seaux
+    d'une minute et 48 seaux d'une heure : mémoire constante quel que soit
+    l'uptime. Les clics sont des compteurs "click:<étape UTM>". En mode shards,
+    le process d'ingestion y ajoute les compteurs remontés (absorb).
+    """
+
+    CLICK = "click:"
+
+    def __init__(self):
+        self._local = threading.local()
+        self._threads = []  # (thread, {nom: RollingCount})
+        self._base = {}     # threads terminés + état rechargé
+        self._remote = {}   # shard → {nom: RollingCount}, dernière remontée
+        self._lock = threading.Lock()
+
+    def inc(self, name, n=1):
+        counts = getattr(self._local, "counts", None)
+        if counts is None:
+            counts = self._local.counts = {}
+            with self._lock:
+                self._threads.append((threading.current_thread(), counts))
+        series = counts.get(name)
+        if series is None:
+            series = counts[name] = RollingCount()
+        series.add(n, int(time.time() // 60))
+
+    def click(self, step):
+        self.inc(self.CLICK + step)
+
+    def _sources(self):
+        """Base + compteurs des threads vivants (verrou pris)."""
+        alive = []
+        for thread, counts in self._threads:
+            if thread.is_alive():
+                alive.append((thread, counts))
+            else:
+                for name, series in list(counts.items()):
+                    self._base.setdefault(name, RollingCount()).merge(series)
+        self._threads = alive
+        return [self._base, *self._remote.values()] + [counts for _, counts in alive]
+
+    def totals(self):
+        """{nom: total} de tous les compteurs (clics compris)."""
+        totals = defaultdict(int)
+        with self._lock:
+            for counts in self._sources():
+                for name, series in list(counts.items()):
+                    totals[name] += series.total
+        return totals
+
+    def total(self, name):
+        with self._lock:
+            return sum(counts[name].total for counts in self._sources() if name in counts)
+
+    def window(self, name, minutes=0, hours=0, offset=0):
+        """Total sur les `minutes` (ou `hours`) écoulées, décalées de `offset` périodes."""
+        now = int(time.time() // 60)
+        with self._lock:
+            sources = [counts[name] for counts in self._sources() if name in counts]
+        if minutes:
+            end = now - offset * minutes
+            return sum(series.minutes.sum(end - minutes + 1, end) for series in sources)
+        end = now // 60 - offset * hours
+        return sum(series.hours.sum(end - hours + 1, end) for series in sources)
+
+    def export(self):
+        """Totaux au format persisté : {nom: n, "button_clicks": {étape: n}}."""
+        saved = {"button_clicks": {}}
+        for name, value in self.totals().items():
+            if name.startswith(self.CLICK):
+                saved["button_clicks"][name[len(self.CLICK):]] = value
+            else:
+                saved[name] = value
+        return saved
+
+    def restore(self, saved):
+        """Totaux persistés (au démarrage) ; repartent en base, sans historique."""
+        with self._lock:
+            for name, value in saved.items():
+                if name == "button_clicks":
+                    for step, clicks in value.items():
+                        self._base.setdefault(self.CLICK + step, RollingCount()).total += clicks
+                elif isinstance(value, int):
+                    self._base.setdefault(name, RollingCount()).total += value
+
+    def merged(self):
+        """{nom: RollingCount} tous threads confondus (copie picklable)."""
+        merged = {}
+        with self._lock:
+            for counts in self._sources():
+                for name, series in list(counts.items()):
+                    merged.setdefault(name, RollingCount()).merge(series)
+        return merged
+
+    def absorb(self, source, counts):
+        """Compteurs d'un autre process (merged()), remplacent sa remontée précédente."""
+        with self._lock:
+            self._remote[source] = counts
+
+    def export_series(self):
+        """Historiques par minute / heure (snapshot d'arrêt)."""
+        return {name: (series.minutes.export(), series.hours.export()) for name, series in self.merged().items()}
+
+    def restore_series(self, exported):
+        with self._lock:
+            for name, (minutes, hours) in exported.items():
+                series = self._base.setdefault(name, RollingCount())
+                for minute, n in sorted(minutes.items()):
+                    series.minutes.add(minute, n)
+                for hour, n in sorted(hours.items()):
+                    series.hours.add(hour, n)
+
+
+STATS = StatsCounters()
+STATS_COUNTERS = (
+    "total_private_messages", "total_ai_responses", "total_new_members", "total_presentations",
+    "total_ai_busy", "total_ai_fallback", "total_welcomes_saved", "total_keyword_replies", "total_keyword_suppressed",
+    "total_updates_dropped",
+)
+
+# Compteurs affichés par /stats (tendances)
+STATS_TRENDS = (
+    ("total_new_members", "👥 Nouveaux membres"),
+    ("total_presentations", "📝 Présentations"),
+    ("total_private_messages", "💬 DM"),
+    ("total_ai_responses", "🤖 Réponses IA"),
+)
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# PERSISTANCE (write-behind)
+# ═══════════════════════════════════════════════════════════════════════════════
+
+
+class MemoryStore:
+    """Pas de persistance disque : l'état vit avec le process.
+
+    Avec `keep`, les lignes écrites sont gardées (JSON) pour le snapshot
+    d'arrêt, qui les rend au démarrage suivant.
+    """
+
+    def __init__(self, keep=False):
+        self.keep = keep
+        self._rows = {}  # (namespace, clé) → valeur JSON
+
+    def load(self):
+        data = defaultdict(dict)
+        for (namespace, key), value in self._rows.items():
+            data[namespace][key] = json.loads(value)
+        return data
+
+    def write(self, rows):
+        if not self.keep:
+            return
+        for namespace, key, value in rows:
+            if value is None:
+                self._rows.pop((namespace, key), None)
+            else:
+                self._rows[(namespace, key)] = value
+
+    def export(self):
+        return dict(self._rows)
+
+    def restore(self, rows):
+        self._rows.update(rows)
+
+    def close(self):
+        pass
+
+
+class SQLiteStore:
+    """Table clé/valeur JSON par namespace, en mode WAL."""
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS state ("
+            " namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+            " PRIMARY KEY (namespace, key))"
+        )
+        self._conn.commit()
+
+    def load(self):
+        data = defaultdict(dict)
+        for namespace, key, value in self._conn.execute("SELECT namespace, key, value FROM state"):
+            data[namespace][key] = json.loads(value)
+        return data
+
+    def write(self, rows):
+        """rows : (namespace, key, valeur JSON ou None pour supprimer)."""
+        upserts = [row for row in rows if row[2] is not None]
+        deletes = [row[:2] for row in rows if row[2] is None]
+        with self._conn:
+            self._conn.executemany(
+                "INSERT INTO state (namespace, key, value) VALUES (?, ?, ?) "
+                "ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value",
+                upserts,
+            )
+            self._conn.executemany("DELETE FROM state WHERE namespace = ? AND key = ?", deletes)
+
+    def close(self):
+        self._conn.close()
+
+
+class WriteBehind:
+    """Écritures différées vers un store.
+
+    Les handlers ne font que marquer une clé sale (mark) ; un thread de fond
+    relit la valeur courante via le getter du namespace et écrit le lot en
+    une transaction toutes les `interval` secondes. Plusieurs modifications
+    d'une même clé entre deux flush ne coûtent qu'une écriture.
+    `snapshots` : valeurs globales (stats) réécrites à chaque flush si elles ont changé.
+    `files` : callables appelés à chaque flush avec `final` (True à l'arrêt) : fichiers hors
+    store, réécrits s'ils ont changé, à leur propre rythme sauf au dernier flush.
+    `open_backend` : ouvre le store au premier usage (un simple import ne crée pas de fichier).
+    """
+
+    def __init__(self, open_backend, interval, getters, snapshots=None, files=()):
+        self._open_backend = open_backend
+        self._backend = None
+        self.interval = interval
+        self._getters = getters
+        self._snapshots = snapshots or {}
+        self._files = files
+        self._last_snapshots = {}
+        self.snapshot_key = None  # clé des snapshots (un par shard), le namespace par défaut
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.flushed_rows = 0
+
+    @property
+    def backend(self):
+        with self._lock:
+            if self._backend is None:
+                self._backend = self._open_backend()
+            return self._backend
+
+    def mark(self, namespace, key):
+        with self._lock:
+            self._dirty.add((namespace, key))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="state-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("[state] ERREUR flush: %s", e)
+
+    def flush(self, final=False):
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        rows = []
+        for namespace, key in dirty:
+            value = self._getters[namespace](key)
+            rows.append((namespace, str(key), json.dumps(value) if value else None))
+        for namespace, getter in self._snapshots.items():
+            value = json.dumps(getter())
+            if value != self._last_snapshots.get(namespace):
+                self._last_snapshots[namespace] = value
+                rows.append((namespace, self.snapshot_key or namespace, value))
+        if rows:
+            self.backend.write(rows)
+            self.flushed_rows += len(rows)
+        for save in self._files:
+            save(final)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self.flush(final=True)
+        if self._backend is not None:
+            self._backend.close()
+
+
+def make_state_backend():
+    if STATE_BACKEND == "sqlite":
+        return SQLiteStore(STATE_DB_PATH)
+    return MemoryStore(keep=bool(SNAPSHOT_PATH))
+
+
+STATE = WriteBehind(
+    make_state_backend,
+    STATE_FLUSH_INTERVAL,
+    getters={
+        "conversations": lambda user_id: user_conversations.snapshot(user_id),
+        "rate": lambda user_id: USER_LIMITER.snapshot(user_id),
+        "followups": lambda user_id: FOLLOWUPS.pending_for(user_id),
+    },
+    snapshots={
+        "stats": lambda: STATS.export(),
+    },
+    files=(lambda final: save_welcomed(final),),
+)
+
+
+def welcomed_path():
+    """Fichier des users accueillis de ce process (un par shard)."""
+    return f"{WELCOMED_PATH}.{STATE.snapshot_key}" if STATE.snapshot_key else WELCOMED_PATH
+
+
+def save_welcomed(final=False):
+    """Réécrit le fichier des accueillis, au plus toutes les WELCOMED_SAVE_INTERVAL s (sauf à l'arrêt)."""
+    if WELCOMED_PATH:
+        users_welcomed_presentation.dump(welcomed_path(), 0 if final else WELCOMED_SAVE_INTERVAL)
+
+
+def load_welcomed(owns=None):
+    """Recharge les fichiers de tous les shards (le découpage a pu changer) ; scopes filtrés par `owns`."""
+    directory, prefix = os.path.split(WELCOMED_PATH)
+    for name in sorted(os.listdir(directory or ".")):
+        if name.startswith(prefix) and not name.endswith(".tmp"):
+            try:
+                users_welcomed_presentation.load(os.path.join(directory, name), owns)
+            except (OSError, ValueError, struct.error) as e:
+                logger.error("💾 %s illisible, ignoré: %s", name, e)
+
+
+def write_snapshot(path=SNAPSHOT_PATH):
+    """Snapshot pickle de l'état chaud, écrit à l'arrêt (SIGTERM) après le flush du store.
+
+    Cache IA (TTL restants), métriques cumulées et, en STATE_BACKEND=memory,
+    tout l'état write-behind. Écriture atomique (fichier temporaire + rename).
+    """
+    snapshot = {
+        "version": SNAPSHOT_VERSION,
+        "saved_at": time.time(),
+        "answer_cache": AI_ANSWER_CACHE.export(),
+        "metrics": {metric.name: metric.export(merged=True) for metric in SNAPSHOT_METRICS},
+        "stats_series": STATS.export_series(),
+        "state": STATE.backend.export() if isinstance(STATE.backend, MemoryStore) else None,
+    }
+    started = time.monotonic()
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    logger.info("💾 Snapshot écrit: %d réponses en cache, %d lignes d'état (%.0f ms, %d Ko)",
+                len(snapshot["answer_cache"]), len(snapshot["state"] or ()),
+                (time.monotonic() - started) * 1000, os.path.getsize(path) // 1024)
+
+
+def restore_snapshot(path=SNAPSHOT_PATH):
+    """Recharge le snapshot d'arrêt avant load_state ; il est supprimé une fois lu.
+
+    Ignoré s'il est trop vieux (SNAPSHOT_MAX_AGE), d'une autre version ou illisible.
+    """
+    if not path or not os.path.exists(path):
+        return False
+    started = time.monotonic()
+    try:
+        with open(path, "rb") as f:
+            snapshot = pickle.load(f)
+    except Exception as e:
+        logger.error("💾 Snapshot illisible, ignoré: %s", e)
+        return False
+    finally:
+        os.remove(path)  # jamais rejoué deux fois (crash sans snapshot suivant)
+
+    age = time.time() - snapshot.get("saved_at", 0)
+    if snapshot.get("version") != SNAPSHOT_VERSION or not 0 <= age <= SNAPSHOT_MAX_AGE:
+        logger.warning("💾 Snapshot ignoré (version %s, âge %.0fs)", snapshot.get("version"), age)
+        return False
+    if snapshot["state"] and isinstance(STATE.backend, MemoryStore):
+        STATE.backend.restore(snapshot["state"])
+    AI_ANSWER_CACHE.restore(snapshot["answer_cache"], age)
+    STATS.restore_series(snapshot["stats_series"])
+    for metric in SNAPSHOT_METRICS:
+        series = snapshot["metrics"].get(metric.name)
+        if series:
+            metric.absorb("snapshot", series)
+    logger.info("💾 Snapshot restauré (âge %.0fs, %.0f ms): %d réponses en cache, %d lignes d'état",
+                age, (time.monotonic() - started) * 1000, len(AI_ANSWER_CACHE), len(snapshot["state"] or ()))
+    return True
+
+
+def load_state(owns=None):
+    """Recharge l'état persisté (au démarrage).
+
+    `owns(id)` : ne garde que les users / groupes de ce shard (conversations, rate limit, relances, accueillis).
+    """
+    data = STATE.backend.load()
+    owns = owns or (lambda user_id: True)
+    for key, saved in data.get("conversations", {}).items():
+        if not owns(int(key)):
+            continue
+        if isinstance(saved, list):  # ancien format : liste de messages
+            saved = {"messages": saved}
+        user_conversations.set(int(key), saved["messages"], saved.get("summary", ""))
+    for key, saved in data.get("rate", {}).items():
+        if isinstance(saved, dict) and owns(int(key)):  # ancien format (timestamps) ignoré
+            USER_LIMITER.restore(int(key), saved)
+    if WELCOMED_PATH:
+        load_welcomed(owns)
+    for key in data.get("welcomed", {}):  # ancien format : users accueillis tous groupes confondus
+        users_welcomed_presentation.add(0, int(key))
+    for key, dues in data.get("followups", {}).items():
+        if owns(int(key)):
+            FOLLOWUPS.restore(int(key), dues)
+    STATS.restore(data.get("stats", {}).get(STATE.snapshot_key or "stats", {}))
+    logger.info(
+        "💾 État rechargé: %d conversations, %d présentés, %d relances",
+        len(user_conversations), len(users_welcomed_presentation), len(FOLLOWUPS),
+    )
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# ANALYTICS (journal d'événements)
+# ═══════════════════════════════════════════════════════════════════════════════
+
+
+class EventLog:
+    """Journal d'événements append-only pour l'analyse de conversion (analytics.py).
+
+    Les handlers ne font qu'ajouter un tuple (ts, kind, chat, user, step) au
+    buffer ; un thread de fond l'écrit par lots, un membre gzip par flush, en
+    fin du segment courant. Nouveau segment au-delà de `segment_bytes` ou de
+    `segment_seconds` : un segment fermé n'est plus jamais modifié.
+    Buffer plein (disque lent) : les événements suivants sont perdus et comptés.
+    """
+
+    def __init__(self, directory, interval, max_buffer, segment_bytes, segment_seconds):
+        self.directory = directory
+        self.interval = interval
+        self.max_buffer = max_buffer
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.tag = "main"  # suffixe des segments (un writer par process)
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._segment = None
+        self._segment_started = 0.0
+        self.written = 0
+        self.dropped = 0
+        self.segments = 0
+
+    def record(self, kind, chat_id, user_id, step=""):
+        if not self.directory:
+            return
+        event = (round(time.time(), 3), kind, chat_id, user_id, step)
+        with self._lock:
+            if len(self._buffer) >= self.max_buffer:
+                self.dropped += 1
+                return
+            self._buffer.append(event)
+
+    def start(self):
+        if not self.directory:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="analytics-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("[analytics] ERREUR flush: %s", e)
+
+    def _segment_path(self, now):
+        """Segment courant ; en ouvre un nouveau si le précédent est plein ou trop vieux."""
+        if (self._segment is None or now - self._segment_started >= self.segment_seconds
+                or os.path.getsize(self._segment) >= self.segment_bytes):
+            self.segments += 1
+            name = f"events-{time.strftime('%Y%m%d-%H%M%S', time.gmtime(now))}-{self.tag}-{os.getpid()}-{self.segments}"
+            self._segment = os.path.join(self.directory, f"{name}.jsonl.gz")
+            self._segment_started = now
+        return self._segment
+
+    def flush(self):
+        with self._lock:
+            batch, self._buffer = self._buffer, []
+        if not batch:
+            return
+        data = "".join(json.dumps(event, separators=(",", ":")) + "\n" for event in batch)
+        with open(self._segment_path(time.time()), "ab") as f:
+            f.write(gzip.compress(data.encode()))
+        self.written += len(batch)
+
+    def stop(self):
+        if not self._thread:
+            return
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+
+
+EVENTS = EventLog(
+    ANALYTICS_DIR, ANALYTICS_FLUSH_INTERVAL, ANALYTICS_BUFFER,
+    ANALYTICS_SEGMENT_BYTES, ANALYTICS_SEGMENT_SECONDS,
+)
 
-stats = {
-    "total_private_messages": 0,
-    "total_ai_responses": 0,
-    "total_new_members": 0,
-    "total_presentations": 0,
-    "button_clicks": defaultdict(int),
-}
 
 # ═══════════════════════════════════════════════════════════════════════════════
 # KEYWORDS
@@ -85,6 +1375,47 @@ KEYWORDS_PRESENTATION = [
     "j'ai", "ans", "région", "département",
 ]
 
+# Intents FAQ des DM : motifs regex (texte replié sans accents) → poids.
+# Un intent n'est retenu que si ses motifs couvrent les mots utiles du message.
+INTENT_RULES = {
+    "inscription": [
+        (r"(?:s')?inscri\w*", 1.0),
+        (r"(?:creer|faire|ouvrir) (?:un |mon )?(?:profil|compte)", 1.0),
+        (r"rejoindre", 0.6),
+        (r"(?:le |un )?lien", 0.6),
+        (r"(?:l')?adresse (?:du site)?|url", 0.6),
+        (r"(?:le )?site", 0.4),
+        (r"comment (?:on )?(?:fait|faire)", 0.4),
+    ],
+    "gratuit": [
+        (r"gratuite?s?|gratos", 1.0),
+        (r"payante?s?|payer|paye", 0.9),
+        (r"(?:le )?prix|tarifs?|abonnements?", 0.9),
+        (r"combien", 0.7),
+        (r"(?:ca )?coute?", 0.7),
+        (r"cher", 0.5),
+    ],
+    "about": [
+        (r"mad ?2 ?moi|madtomoi", 0.6),
+        (r"c'? ?est quoi|qu'est[ -]ce que c'? ?est|kesako", 0.6),
+        (r"(?:quel |ce )(?:genre de )?site", 0.5),
+        (r"comment (?:ca )?(?:marche|fonctionne)|(?:ca )?(?:marche|fonctionne) comment", 0.8),
+        (r"(?:vous etes|t'es|tu es) qui|qui (?:etes[ -]vous|es[ -]tu)", 0.8),
+    ],
+    "salut": [
+        (r"salut|bonjour|bonsoir|coucou|hello|hey|slt|bjr|cc|yo", 1.0),
+        (r"(?:ca|comment) va(?:s|[ -]tu)?|la forme", 0.5),
+    ],
+}
+
+# Mots sans poids pour le routeur d'intents (politesse, articles, pronoms)
+INTENT_STOPWORDS = frozenset("""
+    a au aux c ca ce d de des du en est et il j je l la le les m ma me mes moi mon
+    n ne nous on ou pas pour qu que s sa se ses si sur t ta te tes toi ton tu un une
+    vous y bien bon donc alors oui ok merci svp stp plait please euh hein ici
+    comment veux voudrais aimerais peux faut fais fait faire exactement vraiment juste
+""".split())
+
 # ═══════════════════════════════════════════════════════════════════════════════
 # PROMPT IA
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -127,6 +1458,16 @@ Tu es ici pour rencontrer des gens libres et éveillés.
 
 Présente-toi quand tu veux ✨"""
 
+# Message PUBLIC groupe - plusieurs arrivées regroupées
+WELCOME_PUBLIC_GROUPED = """👋 Bienvenue {names} !
+
+Vous êtes ici pour rencontrer des gens libres et éveillés.
+
+🔥 Créez votre profil (bouton ci-dessous)
+💬 Besoin d'aide ? @mad2moi_helper_bot
+
+Présentez-vous quand vous voulez ✨"""
+
 # Réponse quand quelqu'un se présente
 WELCOME_PRESENTATION = """🙌 Bienvenue {name} !
 
@@ -165,6 +1506,24 @@ Peut-être que ton match t'attend ? 👇""",
 
 RATE_LIMIT_MSG = """⏳ Doucement ! Attends une minute avant de continuer 😊"""
 
+AI_BUSY_MSG = """😅 Beaucoup de monde en ce moment, réessaie dans un instant !
+
+En attendant : https://www.mad2moi.com/"""
+
+# Réponse immédiate quand OpenAI est en panne (disjoncteur ouvert)
+AI_FALLBACK_MSG = """Souci technique…
+
+Mad2Moi : https://www.mad2moi.com/"""
+
+# Réponses locales du routeur d'intents (sans OpenAI)
+INTENT_INSCRIPTION = """🚀 Pour t'inscrire, c'est par ici 👇
+
+Gratuit, rapide, sécurisé ✅"""
+
+INTENT_GRATUIT = """✅ Oui, l'inscription sur Mad2Moi est gratuite !
+
+Crée ton profil et découvre les membres près de chez toi 👇"""
+
 MEDIA_RESPONSE = """📸 Je ne lis que le texte pour l'instant.
 
 Dis-moi ce que tu recherches ! En attendant : https://www.mad2moi.com/"""
@@ -193,6 +1552,321 @@ HELP_TEXT = """🤖 **Commandes**
 
 Écris-moi librement, je réponds 💬"""
 
+# ═══════════════════════════════════════════════════════════════════════════════
+# MÉTRIQUES
+# ═══════════════════════════════════════════════════════════════════════════════
+
+
+class _Metric(abc.ABC):
+    """Métrique à labels au format Prometheus.
+
+    Le chemin chaud ne fait qu'un deque.append (atomique) : ni verrou ni
+    formatage ; les mesures sont agrégées à la lecture (ou par paquets).
+    Une sous-classe fournit le cumul d'une mesure, la copie et la somme de deux
+    séries, et leur rendu texte.
+    """
+
+    kind = ""
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._series = {}
+        self._remote = {}  # shard → séries remontées par ce process
+
+    def _record(self, entry):
+        self._pending.append(entry)
+        if len(self._pending) > METRICS_FOLD_AT:
+            self._fold()
+
+    def _fold(self):
+        with self._lock:
+            pending = self._pending
+            while pending:
+                self._merge(*pending.popleft())
+
+    @abc.abstractmethod
+    def _merge(self, labels, value):
+        """Cumule une mesure dans la série `labels` (appelé verrou pris)."""
+
+    @staticmethod
+    @abc.abstractmethod
+    def _copy(value):
+        """Copie indépendante d'une série."""
+
+    @staticmethod
+    @abc.abstractmethod
+    def _combine(a, b):
+        """Nouvelle série, somme de deux séries."""
+
+    @abc.abstractmethod
+    def _render_series(self, labels, value):
+        """Lignes d'exposition Prometheus d'une série."""
+
+    def export(self, merged=False):
+        """Copie picklable des séries locales (remontée d'un shard), ou de tout (snapshot)."""
+        self._fold()
+        with self._lock:
+            series = self._all() if merged else self._series
+            return {labels: self._copy(value) for labels, value in series.items()}
+
+    def absorb(self, source, series):
+        """Séries d'un autre process, cumulées aux locales à la lecture."""
+        with self._lock:
+            self._remote[source] = series
+
+    def _all(self):
+        """Séries locales + distantes (appelé verrou pris)."""
+        if not self._remote:
+            return self._series
+        merged = {labels: self._copy(value) for labels, value in self._series.items()}
+        for series in self._remote.values():
+            for labels, value in series.items():
+                merged[labels] = self._combine(merged[labels], value) if labels in merged else self._copy(value)
+        return merged
+
+    def _labels(self, labels, extra=""):
+        pairs = [f'{k}="{v}"' for k, v in zip(self.labelnames, labels)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self):
+        self._fold()
+        with self._lock:
+            lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+            series = self._all()
+            for labels in sorted(series):
+                lines += self._render_series(labels, series[labels])
+        return lines
+
+
+class CounterVec(_Metric):
+    """Compteurs par labels (ex. source + type d'exception)."""
+
+    kind = "counter"
+
+    def inc(self, labels=(), amount=1):
+        self._record((labels, amount))
+
+    def _merge(self, labels, value):
+        self._series[labels] = self._series.get(labels, 0) + value
+
+    @staticmethod
+    def _copy(value):
+        return value
+
+    @staticmethod
+    def _combine(a, b):
+        return a + b
+
+    def values(self):
+        self._fold()
+        with self._lock:
+            return dict(self._all())
+
+    def _render_series(self, labels, value):
+        return [f"{self.name}{self._labels(labels)} {value}"]
+
+
+class Histogram(_Metric):
+    """Histogramme de latences (secondes) par labels."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = buckets
+
+    def observe(self, seconds, labels=()):
+        self._record((labels, seconds))
+
+    def _merge(self, labels, seconds):
+        series = self._series.get(labels)
+        if series is None:
+            # [compte par borne (+Inf en dernier), somme]
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, seconds)] += 1
+        series[1] += seconds
+
+    @staticmethod
+    def _copy(series):
+        return [list(series[0]), series[1]]
+
+    @staticmethod
+    def _combine(a, b):
+        return [[x + y for x, y in zip(a[0], b[0])], a[1] + b[1]]
+
+    def _render_series(self, labels, series):
+        counts, total = series
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += count
+            le = f'le="{bound}"'
+            lines.append(f"{self.name}_bucket{self._labels(labels, le)} {cumulative}")
+        lines.append(f"{self.name}_sum{self._labels(labels)} {total:.6f}")
+        lines.append(f"{self.name}_count{self._labels(labels)} {cumulative}")
+        return lines
+
+    def counts(self, labels=None):
+        """Comptes par borne, pour un jeu de labels ou tous confondus."""
+        self._fold()
+        with self._lock:
+            merged = [0] * (len(self.buckets) + 1)
+            for key, (counts, _) in self._all().items():
+                if labels is None or key == labels:
+                    merged = [a + b for a, b in zip(merged, counts)]
+        return merged
+
+    def labels(self):
+        self._fold()
+        with self._lock:
+            return sorted(self._all())
+
+    def quantile(self, q, labels=None):
+        """Quantile estimé par interpolation dans la borne concernée."""
+        counts = self.counts(labels)
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for index, count in enumerate(counts):
+            if seen + count >= rank and count:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def summary(self, labels=None):
+        total = sum(self.counts(labels))
+        if not total:
+            return "—"
+        return (f"p50 {self.quantile(0.5, labels) * 1000:.0f} ms, "
+                f"p99 {self.quantile(0.99, labels) * 1000:.0f} ms ({total})")
+
+
+HANDLER_LATENCY = Histogram("mad2moi_handler_seconds", "Durée des handlers Telegram", ("handler",))
+OPENAI_LATENCY = Histogram("mad2moi_openai_seconds", "Durée des appels OpenAI", ("mode",))
+OPENAI_TTFT = Histogram("mad2moi_openai_ttft_seconds", "Délai du 1er token OpenAI", ("mode",))
+STREAM_LABELS = ("stream",)
+BLOCKING_LABELS = ("blocking",)
+SEND_LATENCY = Histogram("mad2moi_telegram_send_seconds", "Durée des appels Bot API sortants", ("lane",))
+MAILBOX_WAIT = Histogram("mad2moi_mailbox_wait_seconds", "Attente en mailbox avant exécution", ("pool",))
+MAILBOX_DEPTH = Histogram("mad2moi_mailbox_depth", "Tâches déjà en attente dans la mailbox à l'arrivée", ("pool",),
+                          buckets=DEPTH_BUCKETS)
+ERRORS = CounterVec("mad2moi_errors_total", "Exceptions par source et par type", ("source", "type"))
+INTENT_ROUTES = CounterVec("mad2moi_intent_routes_total", "Tours DM par intent local (llm : envoyés à OpenAI)", ("intent",))
+INTENT_SAVED = CounterVec("mad2moi_intent_saved_seconds_total", "Latence OpenAI évitée par les intents (p50 estimé)")
+LLM_ROUTE = ("llm",)
+SHARED_METRICS = (HANDLER_LATENCY, OPENAI_LATENCY, OPENAI_TTFT, MAILBOX_WAIT, MAILBOX_DEPTH, ERRORS, INTENT_ROUTES,
+                  INTENT_SAVED)  # remontées par les shards
+STARTED_AT = time.monotonic()
+SNAPSHOT_METRICS = SHARED_METRICS + (SEND_LATENCY,)  # cumulées d'un process au suivant
+
+
+class BootClock:
+    """Jalons du démarrage à froid, en secondes depuis le lancement du process.
+
+    imports : modules chargés ; ready : handlers prêts, polling / webhook
+    lancé ; first_update : 1re update traitée. openai : durée de son import
+    différé (1er DM IA).
+    """
+
+    def __init__(self, started):
+        self.started = started
+        self.marks = {}
+
+    def mark(self, phase, seconds=None):
+        """Enregistre le jalon une seule fois ; True au premier appel."""
+        if phase in self.marks:
+            return False
+        self.marks[phase] = time.monotonic() - self.started if seconds is None else seconds
+        return True
+
+    def summary(self):
+        labels = (("imports", "imports"), ("ready", "prêt"), ("first_update", "1re update"), ("openai", "openai"))
+        parts = [f"{label} {self.marks[phase] * 1000:.0f} ms" for phase, label in labels if phase in self.marks]
+        return ", ".join(parts) or "—"
+
+
+BOOT = BootClock(BOOT_STARTED)
+BOOT.mark("imports", IMPORTS_SECONDS)
+
+
+def render_metrics():
+    """Texte Prometheus : histogrammes, erreurs, compteurs métier et files (tous shards)."""
+    lines = []
+    for metric in (HANDLER_LATENCY, OPENAI_LATENCY, OPENAI_TTFT, SEND_LATENCY, MAILBOX_WAIT, MAILBOX_DEPTH, ERRORS,
+                   INTENT_ROUTES, INTENT_SAVED):
+        lines += metric.render()
+    lines += ["# HELP mad2moi_events_total Compteurs métier", "# TYPE mad2moi_events_total counter"]
+    counters = STATS.export()
+    clicks = counters.pop("button_clicks")
+    lines += [f'mad2moi_events_total{{event="{name}"}} {counters.get(name, 0)}'
+              for name in sorted(set(STATS_COUNTERS) | set(counters))]
+    lines += ["# HELP mad2moi_clicks_total Clics par étape UTM", "# TYPE mad2moi_clicks_total counter"]
+    lines += [f'mad2moi_clicks_total{{step="{step}"}} {value}' for step, value in sorted(clicks.items())]
+    lines += ["# HELP mad2moi_outbound_total Envois par issue", "# TYPE mad2moi_outbound_total counter"]
+    lines += [f'mad2moi_outbound_total{{result="{name}"}} {getattr(OUTBOX, name)}'
+              for name in ("sent", "retried", "dropped", "failed")]
+    lines += ["# HELP mad2moi_outbound_queue Envois en attente par lane", "# TYPE mad2moi_outbound_queue gauge"]
+    lines += [f'mad2moi_outbound_queue{{lane="{lane}"}} {depth}' for lane, depth in OUTBOX.depths().items()]
+    gauges = stats_gauges()
+    lines += ["# HELP mad2moi_ai_in_flight Réponses IA en cours", "# TYPE mad2moi_ai_in_flight gauge",
+              f"mad2moi_ai_in_flight {gauges['ai_in_flight']}"]
+    pools = (CHAT_MAILBOXES.name, AI_POOL.name)
+    lines += ["# HELP mad2moi_mailbox_queued Tâches en attente ou en cours par pool", "# TYPE mad2moi_mailbox_queued gauge"]
+    lines += [f'mad2moi_mailbox_queued{{pool="{pool}"}} {gauges[f"{pool}_in_flight"]}' for pool in pools]
+    lines += ["# HELP mad2moi_mailbox_active Mailboxes non vides par pool", "# TYPE mad2moi_mailbox_active gauge"]
+    lines += [f'mad2moi_mailbox_active{{pool="{pool}"}} {gauges[f"{pool}_active"]}' for pool in pools]
+    lines += ["# HELP mad2moi_mailbox_rejected_total Tâches refusées (mailbox ou pool plein)",
+              "# TYPE mad2moi_mailbox_rejected_total counter"]
+    lines += [f'mad2moi_mailbox_rejected_total{{pool="{pool}"}} {gauges[f"{pool}_rejected"]}' for pool in pools]
+    lines += ["# HELP mad2moi_boot_seconds Jalons du démarrage (secondes depuis le lancement)",
+              "# TYPE mad2moi_boot_seconds gauge"]
+    lines += [f'mad2moi_boot_seconds{{phase="{phase}"}} {seconds:.3f}' for phase, seconds in BOOT.marks.items()]
+    lines += ["# HELP mad2moi_uptime_seconds Temps depuis le démarrage", "# TYPE mad2moi_uptime_seconds gauge",
+              f"mad2moi_uptime_seconds {time.monotonic() - STARTED_AT:.0f}"]
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """GET /metrics (scrape Prometheus)."""
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = render_metrics().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server():
+    """Serveur /metrics local (thread daemon) ; None si désactivé."""
+    if not METRICS_PORT:
+        return None
+    server = ThreadingHTTPServer((METRICS_LISTEN, METRICS_PORT), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
 # ═══════════════════════════════════════════════════════════════════════════════
 # UTILITAIRES
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -230,52 +1904,1469 @@ def menu_keyboard():
     ])
 
 
-def is_rate_limited(user_id):
-    """Rate limiting."""
-    now = time.time()
-    user_last_messages[user_id] = [
-        t for t in user_last_messages[user_id]
-        if now - t < RATE_LIMIT_WINDOW
-    ]
-    if len(user_last_messages[user_id]) >= RATE_LIMIT_MESSAGES:
-        return True
-    user_last_messages[user_id].append(now)
-    return False
+class ChatMailboxes:
+    """Une mailbox série par clé (chat / user), exécutées par un pool de threads partagé.
+
+    Deux tâches d'une même clé ne tournent jamais en même temps et partent dans
+    l'ordre d'arrivée ; des clés différentes tournent en parallèle. Bornes :
+    `mailbox_size` tâches en attente par clé et `workers + queue_size` au total ;
+    submit() renvoie None au-delà (refuse au lieu de bloquer). put() ne refuse
+    jamais : hors borne par clé, il attend de la place dans le pool (backpressure).
+    Un worker traite au plus `batch` tâches d'une mailbox puis la remet en fin
+    de file : un chat bavard ne monopolise pas un thread.
+    """
+
+    def __init__(self, workers, queue_size, mailbox_size, name, batch=8):
+        self.name = name
+        self.labels = (name,)
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self._mailboxes = {}  # clé → deque de (Future, fn, args, kwargs, arrivée) ; présente tant qu'un worker la vide
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._space = threading.Condition(self._lock)
+        self.capacity = workers + queue_size
+        self.mailbox_size = mailbox_size
+        self.batch = batch
+        self.in_flight = 0  # tâches acceptées et pas encore terminées
+        self.rejected = 0
+
+    def __len__(self):
+        return len(self._mailboxes)
+
+    def submit(self, key, fn, /, *args, **kwargs):
+        return self._submit(key, fn, args, kwargs, wait=False)
+
+    def put(self, key, fn, /, *args, **kwargs):
+        return self._submit(key, fn, args, kwargs, wait=True)
+
+    def _submit(self, key, fn, args, kwargs, wait):
+        future = Future()
+        with self._lock:
+            if wait:
+                self._space.wait_for(lambda: self.in_flight < self.capacity)
+            mailbox = self._mailboxes.get(key)
+            depth = len(mailbox) if mailbox is not None else 0
+            if not wait and (self.in_flight >= self.capacity or depth >= self.mailbox_size):
+                self.rejected += 1
+                return None
+            self.in_flight += 1
+            idle = mailbox is None
+            if idle:
+                mailbox = self._mailboxes[key] = deque()
+            mailbox.append((future, fn, args, kwargs, time.monotonic()))
+        MAILBOX_DEPTH.observe(depth, self.labels)
+        if idle:
+            self._pool.submit(self._drain, key)
+        return future
+
+    def _drain(self, key):
+        for _ in range(self.batch):
+            with self._lock:
+                mailbox = self._mailboxes[key]
+                if not mailbox:
+                    del self._mailboxes[key]
+                    return
+                future, fn, args, kwargs, queued_at = mailbox.popleft()
+            MAILBOX_WAIT.observe(time.monotonic() - queued_at, self.labels)
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except Exception as e:
+                    logger.error("[%s] ERREUR: %s", self.name, e)
+                    future.set_exception(e)
+            with self._lock:
+                self.in_flight -= 1
+                self._space.notify()
+                if not self.in_flight:
+                    self._idle.notify_all()
+        with self._lock:
+            if not self._mailboxes[key]:
+                del self._mailboxes[key]
+                return
+        self._pool.submit(self._drain, key)
+
+    def shutdown(self, wait=True):
+        """Vide toutes les mailboxes (si `wait`) puis arrête les workers."""
+        if wait:
+            with self._lock:
+                self._idle.wait_for(lambda: not self.in_flight)
+        self._pool.shutdown(wait=wait)
+
+
+AI_POOL = ChatMailboxes(AI_WORKERS, AI_QUEUE_SIZE, AI_MAILBOX_SIZE, "ai")  # tours IA en série par user
+CHAT_MAILBOXES = ChatMailboxes(max(CHAT_WORKERS, 1), CHAT_QUEUE_SIZE, CHAT_MAILBOX_SIZE, "chat")
+
+SENTENCE_END = re.compile(r"[.!?…]\s|\n")
+
+
+class StreamingReply:
+    """Réponse Telegram affichée au fil du stream.
+
+    Le premier message part dès qu'une phrase est complète, les suivants sont
+    des edits du même message espacés d'au moins STREAM_EDIT_INTERVAL.
+    `alive()` faux coupe le stream (Superseded) : la réponse est périmée.
+    """
+
+    def __init__(self, message, alive=None):
+        self.message = message
+        self.alive = alive
+        self.sent = None
+        self.shown = ""
+        self._last_edit = 0.0
+
+    def push(self, text):
+        """Texte cumulé reçu jusqu'ici."""
+        if self.alive and not self.alive():
+            raise Superseded()
+        now = time.monotonic()
+        if self.sent is None:
+            # Premier message coupé à la dernière fin de phrase
+            cut = max((m.end() for m in SENTENCE_END.finditer(text)), default=0)
+            if cut:
+                self._show(text[:cut], now)
+        elif now - self._last_edit >= STREAM_EDIT_INTERVAL:
+            self._show(text, now)
+
+    def finish(self, text):
+        """Texte final : envoi ou dernier edit."""
+        self._show(text, time.monotonic())
+
+    def retract(self):
+        """Réponse périmée : supprime le début déjà affiché (le tour suivant répond à tout)."""
+        if self.sent is not None:
+            OUTBOX.submit(None, "retrait stream", PRIORITY_DM, self.sent.delete)
+            self.sent = None
+            self.shown = ""
+
+    def _show(self, text, now):
+        text = text.strip()
+        if not text or text == self.shown:
+            return
+        try:
+            if self.sent is None:
+                # Le message envoyé sert aux edits suivants : on attend sa création
+                self.sent = reply(self.message, text, "envoi stream").result(timeout=AI_TIMEOUT)
+            else:
+                OUTBOX.submit(self.message.chat.id, "edit stream", PRIORITY_DM, self.sent.edit_text, text)
+            self.shown = text
+        except Exception as e:
+            logger.warning("Erreur envoi stream: %s", e)
+        self._last_edit = now
+
+
+TOKEN_PIECES = re.compile(r"\w+|[^\w\s]")
+
+
+def estimate_tokens(text):
+    """Estimation locale des tokens : 1 par mot / ponctuation, +1 par tranche de 6 lettres."""
+    return sum(1 + len(piece) // 6 for piece in TOKEN_PIECES.findall(text))
+
+
+SYSTEM_PROMPT_TOKENS = estimate_tokens(AI_SYSTEM_PROMPT) + MESSAGE_TOKEN_OVERHEAD
+
+
+def summarize_turns(summary, turns):
+    """Résumé glissant : ajoute des tours anciens (extraits), garde les plus récents."""
+    lines = summary.split("\n") if summary else []
+    for role, content, _ in turns:
+        text = " ".join(content.split())
+        if role == ROLE_USER:
+            lines.append(f"• Utilisateur : {text[:160]}")
+        else:
+            first_sentence = re.split(r"(?<=[.!?…])\s", text, maxsplit=1)[0]
+            lines.append(f"• Conseillère : {first_sentence[:120]}")
+    while len(lines) > 1 and estimate_tokens("\n".join(lines)) > SUMMARY_MAX_TOKENS:
+        lines.pop(0)
+    return "\n".join(lines)
+
+
+def build_prompt(user_id):
+    """Messages OpenAI dans le budget PROMPT_TOKEN_BUDGET ; renvoie (messages, tokens)."""
+    budget = PROMPT_TOKEN_BUDGET - SYSTEM_PROMPT_TOKENS
+    summary, turns = user_conversations.prompt_window(user_id, budget)
+
+    messages = [{"role": "system", "content": AI_SYSTEM_PROMPT}]
+    tokens = SYSTEM_PROMPT_TOKENS
+    if summary:
+        messages.append({"role": "system", "content": f"Échanges précédents (résumé) :\n{summary}"})
+        tokens += estimate_tokens(summary) + MESSAGE_TOKEN_OVERHEAD
+
+    turn_budget = budget - SUMMARY_MAX_TOKENS
+    for role, content, turn_tokens in turns:
+        if turn_tokens > turn_budget:
+            # Message seul plus gros que le budget : tronqué pour le prompt uniquement
+            content = content[:len(content) * turn_budget // turn_tokens]
+            turn_tokens = turn_budget
+        messages.append({"role": role, "content": content})
+        tokens += turn_tokens + MESSAGE_TOKEN_OVERHEAD
+    return messages, tokens
+
+
+def normalize_question(text):
+    """Clé de cache : sans casse, accents, ponctuation ni espaces multiples."""
+    return " ".join(re.sub(r"[^\w\s]", " ", fold_text(text)).split())
+
+
+class AnswerCache:
+    """Cache LRU + TTL des réponses IA, borné en entrées et en octets."""
+
+    def __init__(self, max_entries, max_bytes, ttl):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # clé → (expire_at, réponse)
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._drop(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, answer, ttl=None):
+        size = len(key) + len(answer.encode())
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), answer)
+            self.bytes += size
+            while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+
+    def _drop(self, key):
+        _, answer = self._entries.pop(key)
+        self.bytes -= len(key) + len(answer.encode())
+
+    def export(self):
+        """[(clé, TTL restant, réponse)] du moins au plus récemment utilisé."""
+        now = time.monotonic()
+        with self._lock:
+            return [(key, expire_at - now, answer) for key, (expire_at, answer) in self._entries.items()
+                    if expire_at > now]
+
+    def restore(self, entries, elapsed=0.0):
+        """Recharge un export, vieilli de `elapsed` secondes."""
+        for key, ttl, answer in entries:
+            if ttl > elapsed:
+                self.put(key, answer, ttl - elapsed)
+
+
+AI_ANSWER_CACHE = AnswerCache(AI_CACHE_SIZE, AI_CACHE_MAX_BYTES, AI_CACHE_TTL)
+
+
+class FollowupScheduler:
+    """Relances DM : un tas (échéance, user, étape) + les échéances actives par user.
+
+    Une seule relance active par (user, étape) : reprogrammer remplace,
+    annuler efface. Les entrées périmées du tas sont ignorées au dépilage et
+    le tas est reconstruit quand elles dominent.
+    Échéances en secondes epoch (int), persistées via STATE ("followups").
+    """
+
+    def __init__(self, delays):
+        self.delays = delays
+        self._pending = {}  # user_id → [échéance par étape, 0 = faite / annulée]
+        self._heap = []
+        self._active = 0    # échéances non nulles de _pending (entrées valides du tas)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _replace(self, user_id, dues):
+        """Remplace les échéances d'un user (lock tenu) en tenant _active à jour."""
+        previous = self._pending.pop(user_id, None)
+        if previous:
+            self._active -= sum(1 for due in previous if due)
+        if dues is not None:
+            self._pending[user_id] = dues
+            self._active += sum(1 for due in dues if due)
+        return previous
+
+    def schedule(self, user_id, now=None):
+        now = int(time.time() if now is None else now)
+        dues = [now + delay for delay in self.delays]
+        with self._lock:
+            self._replace(user_id, dues)
+            for step, due in enumerate(dues):
+                heapq.heappush(self._heap, (due, user_id, step))
+            self._compact()
+        STATE.mark("followups", user_id)
+
+    def cancel(self, user_id):
+        with self._lock:
+            cancelled = self._replace(user_id, None)
+        if cancelled:
+            STATE.mark("followups", user_id)
+        return bool(cancelled)
+
+    def restore(self, user_id, dues):
+        with self._lock:
+            self._replace(user_id, list(dues))
+            for step, due in enumerate(dues):
+                if due:
+                    heapq.heappush(self._heap, (due, user_id, step))
+
+    def pending_for(self, user_id):
+        return self._pending.get(user_id)
+
+    def pop_due(self, now, limit):
+        """Jusqu'à `limit` relances échues : [(user_id, étape), ...].
+
+        Après une longue coupure, plusieurs étapes d'un même user peuvent être
+        échues : seule la plus récente est envoyée.
+        """
+        due = {}
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now and len(due) < limit:
+                when, user_id, step = heapq.heappop(self._heap)
+                dues = self._pending.get(user_id)
+                if not dues or dues[step] != when:
+                    continue  # reprogrammée ou annulée entre-temps
+                dues[step] = 0
+                self._active -= 1
+                if not any(dues):
+                    del self._pending[user_id]
+                due[user_id] = step
+        for user_id in due:
+            STATE.mark("followups", user_id)
+        return list(due.items())
+
+    def _compact(self):
+        if len(self._heap) > 2 * self._active + 100:
+            self._heap = [
+                (due, user_id, step)
+                for user_id, dues in self._pending.items()
+                for step, due in enumerate(dues) if due
+            ]
+            heapq.heapify(self._heap)
+
+
+FOLLOWUPS = FollowupScheduler(FOLLOWUP_DELAYS)
+
+
+class WelcomeCoalescer:
+    """Fenêtres d'arrivées par chat.
+
+    Le premier welcome part tout de suite et ouvre une fenêtre ; les arrivées
+    suivantes s'accumulent et sont accueillies ensemble à la fin de la
+    fenêtre (qui se prolonge tant que la vague continue). Si le welcome
+    précédent est remplacé, le suivant reprend aussi ses arrivées.
+    """
+
+    def __init__(self):
+        self._windows = {}        # chat_id → arrivées en attente [(user_id, prénom)]
+        self._covered = {}        # chat_id → arrivées citées par le dernier welcome
+        self._last_welcome = {}   # chat_id → message_id du dernier welcome de la vague
+        self._lock = threading.Lock()
+
+    def add(self, chat_id, members):
+        """True si la fenêtre était fermée : le welcome part maintenant."""
+        with self._lock:
+            if chat_id in self._windows:
+                self._windows[chat_id].extend(members)
+                return False
+            self._windows[chat_id] = []
+            self._covered[chat_id] = list(members)
+            return True
+
+    def take(self, chat_id):
+        """(arrivées à citer, nb de nouvelles) ; ferme la fenêtre s'il n'y en a pas."""
+        with self._lock:
+            members = self._windows.get(chat_id, [])
+            if not members:
+                self._windows.pop(chat_id, None)
+                self._covered.pop(chat_id, None)
+                self._last_welcome.pop(chat_id, None)
+                return [], 0
+            self._windows[chat_id] = []
+            if WELCOME_REPLACE_PREVIOUS:
+                self._covered[chat_id] = self._covered.get(chat_id, []) + members
+            else:
+                self._covered[chat_id] = members
+            return self._covered[chat_id], len(members)
+
+    def replace_last(self, chat_id, message_id):
+        """Enregistre le nouveau welcome ; renvoie l'id du précédent."""
+        with self._lock:
+            if chat_id not in self._windows:
+                return None
+            previous = self._last_welcome.get(chat_id)
+            self._last_welcome[chat_id] = message_id
+            return previous
+
+
+WELCOMES = WelcomeCoalescer()
+
+
+class ReplyCooldown:
+    """Anti-répétition des réponses automatiques : une par chat et une par (chat, user) par fenêtre.
+
+    Chaque entrée expire après sa fenêtre (TTL) ; les dicts sont ordonnés par
+    dernière réponse, l'éviction ne parcourt que la tête des entrées expirées.
+    `max_entries` plafonne la mémoire (les plus anciennes partent d'abord).
+    """
+
+    def __init__(self, chat_window, user_window, max_entries):
+        self.chat_window = chat_window
+        self.user_window = user_window
+        self.max_entries = max_entries
+        self._chats = OrderedDict()  # chat_id → dernière réponse (monotonic)
+        self._users = OrderedDict()  # (chat_id, user_id) → dernière réponse
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.suppressed = defaultdict(int)  # raison (chat / user) → réponses évitées
+
+    def __len__(self):
+        return len(self._chats) + len(self._users)
+
+    @staticmethod
+    def _evict(entries, window, now, max_entries):
+        while entries:
+            key, last = next(iter(entries.items()))
+            if now - last < window and len(entries) < max_entries:
+                return
+            del entries[key]
+
+    def allow(self, chat_id, user_id, now=None):
+        """True si la réponse peut partir (et l'enregistre) ; False = supprimée et comptée."""
+        now = time.monotonic() if now is None else now
+        user_key = (chat_id, user_id)
+        with self._lock:
+            self._evict(self._chats, self.chat_window, now, self.max_entries)
+            self._evict(self._users, self.user_window, now, self.max_entries)
+            if user_key in self._users:
+                reason = "user"
+            elif chat_id in self._chats:
+                reason = "chat"
+            else:
+                if self.chat_window > 0:
+                    self._chats[chat_id] = now
+                if self.user_window > 0:
+                    self._users[user_key] = now
+                self.allowed += 1
+                return True
+            self.suppressed[reason] += 1
+            return False
+
+
+KEYWORD_COOLDOWN = ReplyCooldown(KEYWORD_CHAT_COOLDOWN, KEYWORD_USER_COOLDOWN, KEYWORD_COOLDOWN_MAX_ENTRIES)
+
+
+class DMBurst:
+    """Rafale de DM en attente d'un user."""
+
+    __slots__ = ("texts", "message", "due", "deadline")
+
+    def __init__(self, texts, message, due, deadline):
+        self.texts = texts
+        self.message = message
+        self.due = due
+        self.deadline = deadline
+
+
+class DMDebouncer:
+    """Regroupe les DM rapprochés d'un user en un seul tour IA.
+
+    Chaque message repousse la fin de la rafale de `window` s (au plus
+    `max_wait` après le premier, `max_messages` messages au plus). Un
+    nouveau message rend périmé le tour en cours du même user : sa réponse
+    n'est pas envoyée et, si l'appel OpenAI n'a pas commencé, ses messages
+    rejoignent la rafale suivante.
+    """
+
+    def __init__(self, window, max_wait, max_messages):
+        self.window = window
+        self.max_wait = max_wait
+        self.max_messages = max_messages
+        self._bursts = {}       # user_id → DMBurst en attente
+        self._inflight = {}     # user_id → [génération, textes, appel commencé]
+        self._generations = {}  # user_id → génération du dernier message
+        self._seq = itertools.count(1)
+        self._lock = threading.Lock()
+        self.merged = 0         # messages ajoutés à une rafale existante
+        self.superseded = 0     # tours remplacés par un message plus récent
+
+    def add(self, user_id, text, message, now=None):
+        """Délai avant le flush si un job doit être programmé, sinon None."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._generations[user_id] = next(self._seq)
+            carried = []
+            inflight = self._inflight.pop(user_id, None)
+            if inflight is not None:
+                self.superseded += 1
+                if not inflight[2]:
+                    carried = inflight[1]
+
+            burst = self._bursts.get(user_id)
+            if burst is None:
+                self._bursts[user_id] = DMBurst(carried + [text], message, now + self.window, now + self.max_wait)
+                return self.window
+            burst.texts.extend(carried)
+            burst.texts.append(text)
+            burst.message = message
+            self.merged += 1
+            if len(burst.texts) >= self.max_messages:
+                burst.due = now
+                return 0
+            burst.due = min(now + self.window, burst.deadline)
+            return None
+
+    def due_in(self, user_id, now=None):
+        """Secondes avant la fin de la rafale (0 : prête, None : aucune)."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            burst = self._bursts.get(user_id)
+            return None if burst is None else max(burst.due - now, 0)
+
+    def take(self, user_id):
+        """(textes, dernier message, génération) de la rafale ; le tour devient en cours."""
+        with self._lock:
+            burst = self._bursts.pop(user_id, None)
+            if burst is None:
+                return None
+            generation = self._generations[user_id]
+            self._inflight[user_id] = [generation, burst.texts, False]
+            return burst.texts, burst.message, generation
+
+    def start(self, user_id, generation):
+        """L'appel OpenAI du tour commence ; False si le tour a été remplacé."""
+        with self._lock:
+            inflight = self._inflight.get(user_id)
+            if inflight is None or inflight[0] != generation:
+                return False
+            inflight[2] = True
+            return True
+
+    def is_current(self, user_id, generation):
+        return self._generations.get(user_id) == generation
+
+    def finish(self, user_id, generation):
+        """Fin du tour : oublie l'user s'il n'a rien envoyé depuis."""
+        with self._lock:
+            inflight = self._inflight.get(user_id)
+            if inflight is not None and inflight[0] == generation:
+                del self._inflight[user_id]
+            if user_id not in self._bursts and user_id not in self._inflight:
+                self._generations.pop(user_id, None)
+
+    def pending(self):
+        """Users dont une rafale attend son flush."""
+        with self._lock:
+            return list(self._bursts)
+
+    def __len__(self):
+        return len(self._bursts)
+
+
+class Superseded(Exception):
+    """Réponse IA périmée : l'user a écrit depuis."""
+
+
+DM_DEBOUNCER = DMDebouncer(DM_DEBOUNCE_WINDOW, DM_DEBOUNCE_MAX_WAIT, DM_DEBOUNCE_MAX_MESSAGES)
+
+
+def sweep_memory(context):
+    """Job périodique : oublie conversations et compteurs de rate limit inactifs."""
+    forgotten = user_conversations.sweep()
+    idle = USER_LIMITER.sweep()
+    if forgotten or idle:
+        logger.info("🧹 Mémoire: %d conversations, %d rate limits oubliés", forgotten, idle)
 
 
 def send_typing(context, chat_id):
-    """Indicateur 'écrit...'"""
-    try:
-        context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-    except Exception:
-        pass
+    """Indicateur 'écrit...' (via la file sortante, comme les messages)"""
+    OUTBOX.submit(None, "typing", PRIORITY_DM, context.bot.send_chat_action, chat_id=chat_id, action=ChatAction.TYPING)
 
 
 def log_handler(func):
-    """Décorateur logging."""
+    """Décorateur logging + métriques (durée du handler, erreurs par type)."""
+    handler_name = func.__name__
+    labels = (handler_name,)
+
     @wraps(func)
     def wrapper(update, context, *args, **kwargs):
+        started = time.monotonic()
         user = update.effective_user
         chat = update.effective_chat
-        handler_name = func.__name__
-        logger.info(f"[{handler_name}] user={user.id if user else '?'} chat={chat.type if chat else '?'}")
+        ingest_latency = INGEST_CLOCK.observe(update.update_id)
+        if ingest_latency is None:
+            logger.info("[%s] user=%s chat=%s", handler_name, user.id if user else "?", chat.type if chat else "?",
+                        extra=LOG_HANDLER_EVENT)
+        else:
+            logger.info("[%s] user=%s chat=%s ingest=%.1fms", handler_name,
+                        user.id if user else "?", chat.type if chat else "?", ingest_latency * 1000,
+                        extra=LOG_HANDLER_EVENT)
         try:
             return func(update, context, *args, **kwargs)
         except Exception as e:
-            logger.error(f"[{handler_name}] ERREUR: {e}")
+            ERRORS.inc(("handler", type(e).__name__))
+            logger.error("[%s] ERREUR: %s", handler_name, e)
             raise
+        finally:
+            HANDLER_LATENCY.observe(time.monotonic() - started, labels)
+            if "first_update" not in BOOT.marks and BOOT.mark("first_update"):
+                logger.info("🚀 1re update traitée %.2fs après le lancement", BOOT.marks["first_update"])
     return wrapper
 
 
-def is_presentation(text):
+def serial(handler, keep=False):
+    """Handler exécuté dans la mailbox de son chat : en ordre par chat, chats en parallèle.
+
+    Le dispatcher ne fait que poster l'update ; mailbox pleine = update ignorée.
+    `keep` (joins, commandes) : jamais ignorée, le dispatcher attend si le pool est plein.
+    """
+    if not CHAT_WORKERS:
+        return handler
+
+    @wraps(handler)
+    def wrapper(update, context):
+        key = shard_key(update)
+        if keep:
+            CHAT_MAILBOXES.put(key, handler, update, context)
+        elif CHAT_MAILBOXES.submit(key, handler, update, context) is None:
+            STATS.inc("total_updates_dropped")
+            logger.warning("📬 Mailbox pleine, update %s ignorée (%s)", update.update_id, key)
+    return wrapper
+
+
+# Apostrophes typographiques (claviers mobiles) et ligatures
+APOSTROPHES = "’‘ʼ"
+FOLD_REPLACEMENTS = tuple((a, "'") for a in APOSTROPHES) + (("œ", "oe"), ("æ", "ae"))
+
+
+def fold_text(text):
+    """Minuscules ASCII sans accents (é → e, ’ → ', œ → oe)."""
+    text = text.lower()
+    if text.isascii():
+        return text
+    for src, dst in FOLD_REPLACEMENTS:
+        text = text.replace(src, dst)
+    return unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode("ascii")
+
+
+class KeywordMatcher:
+    """Automate compilé une fois : cherche les keywords de plusieurs listes en une passe.
+
+    Le trie des keywords est compilé en une seule regex, appliquée au texte en
+    minuscules. Les caractères accentués / typographiques des keywords
+    deviennent des classes ("célibataire" → c[eé]libataire, "j'ai" → j['’]ai) :
+    un message sans accents matche quand même, sans replier tout le texte.
+    Chaque fin de keyword porte un groupe vide, dont l'index donne un masque de
+    bits : le keyword trouvé + ses préfixes qui sont aussi des keywords. On
+    relance la recherche juste après le début de chaque hit pour couvrir les
+    chevauchements ("envie de rencontrer" → "rencontrer", "rencontre").
+
+    count(text) renvoie, pour chaque liste, le nombre de keywords DISTINCTS
+    présents — même sémantique que `sum(1 for k in liste if k in text.lower())`.
+    """
+
+    def __init__(self, *keyword_lists):
+        self._list_masks = [0] * len(keyword_lists)
+        trie = {}
+        bits = {}
+        for list_idx, keywords in enumerate(keyword_lists):
+            for keyword in keywords:
+                keyword = keyword.lower()
+                folded = fold_text(keyword)
+                bit = bits.setdefault(folded, len(bits))
+                self._list_masks[list_idx] |= 1 << bit
+                node = trie
+                for char in keyword:
+                    node = node.setdefault(fold_text(char), {})
+                    node.setdefault("variants", set()).add(char)
+                node[""] = bit
+
+        self._group_masks = [0]
+        self._search = re.compile(self._compile_root(trie)).search
+        self._no_hits = (0,) * len(keyword_lists)
+
+    @staticmethod
+    def _compile_edge(folded, variants):
+        """Classe regex acceptant la forme repliée et les formes du keyword."""
+        options = {folded} | variants
+        if folded == "'":
+            options.update(APOSTROPHES)
+        if len(options) == 1:
+            return re.escape(folded)
+        if all(len(o) == 1 for o in options):
+            return "[" + "".join(re.escape(o) for o in sorted(options)) + "]"
+        return "(?:" + "|".join(re.escape(o) for o in sorted(options, key=len, reverse=True)) + ")"
+
+    def _compile_root(self, trie):
+        """Racine : une branche par forme du 1er caractère, chacune ouverte par un littéral.
+
+        re en déduit l'ensemble des 1ers caractères possibles et saute en C les
+        positions qui ne peuvent pas démarrer un keyword (l'essentiel du bavardage).
+        """
+        branches = []
+        for char, child in sorted(trie.items()):
+            options = {char} | child["variants"]
+            if char == "'":
+                options.update(APOSTROPHES)
+            for option in sorted(options):
+                branches.append(re.escape(option) + self._compile_node(child, 0))
+        return "|".join(branches)
+
+    def _compile_node(self, node, prefix_mask):
+        """Trie → regex ; les enfants passent avant la fin de mot (match le plus long)."""
+        mask = prefix_mask
+        if "" in node:
+            mask |= 1 << node[""]
+        branches = [
+            self._compile_edge(char, child["variants"]) + self._compile_node(child, mask)
+            for char, child in sorted(node.items()) if char and char != "variants"
+        ]
+        if "" in node:
+            self._group_masks.append(mask)
+            branches.append("()")
+        if len(branches) == 1:
+            return branches[0]
+        return "(?:" + "|".join(branches) + ")"
+
+    def count(self, text):
+        """Nombre de keywords distincts trouvés, par liste (tuple)."""
+        search = self._search
+        text_lower = text.lower()
+        match = search(text_lower)
+        if match is None:
+            return self._no_hits
+        hits = 0
+        while match:
+            hits |= self._group_masks[match.lastindex]
+            match = search(text_lower, match.start() + 1)
+        return tuple([(hits & mask).bit_count() for mask in self._list_masks])
+
+
+KEYWORD_MATCHER = KeywordMatcher(KEYWORDS_PRESENTATION, KEYWORDS_RENCONTRE)
+
+
+def is_presentation(text, keyword_count=None):
     """Détecte si un message est une présentation."""
-    text_lower = text.lower()
-    keyword_count = sum(1 for k in KEYWORDS_PRESENTATION if k in text_lower)
-    
+    if keyword_count is None:
+        keyword_count = KEYWORD_MATCHER.count(text)[0]
+
     # Présentation si : 2+ keywords OU (1 keyword ET message long)
     return keyword_count >= 2 or (keyword_count >= 1 and len(text) > 80)
 
 
+class IntentRouter:
+    """Classifieur local des DM FAQ (inscription, gratuit, about, salut).
+
+    Une regex compilée par intent, un groupe par motif pondéré. Score d'un
+    intent = somme des poids des motifs distincts trouvés (plafonnée à 1),
+    multipliée par la part des mots utiles (hors INTENT_STOPWORDS) couverte
+    par ces motifs : "c'est gratuit ?" → 1.0, "je suis seul, c'est gratuit ?"
+    → 0.5. Les formules de politesse (intent `courtesy`) comptent comme
+    couvertes pour les autres intents : "bonjour, c'est gratuit ?" → gratuit.
+    classify() renvoie (intent, confiance) ou (None, meilleur score) sous le
+    seuil.
+    """
+
+    WORD = re.compile(r"\w+")
+
+    def __init__(self, rules, stopwords, threshold, courtesy=None):
+        self.threshold = threshold
+        self.stopwords = stopwords
+        self.courtesy = courtesy
+        self._intents = []
+        for name, patterns in rules.items():
+            regex = re.compile(r"\b(?:" + "|".join(f"({p})" for p, _ in patterns) + r")\b")
+            self._intents.append((name, regex, [0.0] + [w for _, w in patterns]))
+
+    def score(self, text):
+        """Scores de tous les intents, triés du plus confiant au moins confiant."""
+        text = fold_text(text)
+        words = [m.span() for m in self.WORD.finditer(text) if m.group() not in self.stopwords]
+        if not words:
+            return []
+        matches = {}
+        for name, regex, weights in self._intents:
+            found = set()
+            spans = []
+            for match in regex.finditer(text):
+                found.add(match.lastindex)
+                spans.append(match.span())
+            if found:
+                matches[name] = (sum(weights[i] for i in found), spans)
+        polite = matches.get(self.courtesy, (0, []))[1]
+
+        scores = []
+        for name, (weight, spans) in matches.items():
+            if name != self.courtesy:
+                spans = spans + polite
+            covered = sum(1 for start, end in words if any(a <= start and end <= b for a, b in spans))
+            confidence = min(weight, 1.0) * covered / len(words)
+            scores.append((confidence, name))
+        scores.sort(reverse=True)
+        return scores
+
+    def classify(self, text):
+        scores = self.score(text)
+        if not scores:
+            return None, 0.0
+        confidence, name = scores[0]
+        return (name if confidence >= self.threshold else None), confidence
+
+
+INTENT_ROUTER = IntentRouter(INTENT_RULES, INTENT_STOPWORDS, INTENT_THRESHOLD, courtesy="salut")
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# RATE LIMITING
+# ═══════════════════════════════════════════════════════════════════════════════
+
+
+class TokenBucket:
+    """Seau à jetons : `rate` jetons/s, au plus `capacity` en réserve."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated", "paused_until")
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+        self.paused_until = 0.0
+
+    def wait_time(self, now):
+        """Secondes avant qu'un jeton soit disponible (0 = tout de suite)."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.paused_until - now)
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds, now):
+        self.paused_until = max(self.paused_until, now + seconds)
+
+    def is_idle(self, now):
+        return self.wait_time(now) == 0 and self.tokens >= self.capacity
+
+
+class UserRateLimiter:
+    """Rate limit par user : un seau à jetons chacun, O(1) par message.
+
+    `messages` par `window` secondes en régime continu, rafale de `messages`
+    au plus. Horloge murale (time.time) pour survivre aux redémarrages via
+    la persistance. Un seau plein est équivalent à pas de seau : sweep() les
+    oublie.
+    """
+
+    def __init__(self, messages, window):
+        self.messages = messages
+        self.rate = messages / window
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def allow(self, user_id, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            bucket = self._buckets.get(user_id)
+            if bucket is None:
+                bucket = self._buckets[user_id] = TokenBucket(self.rate, self.messages, now)
+            if bucket.wait_time(now) > 0:
+                return False
+            bucket.take()
+        STATE.mark("rate", user_id)
+        return True
+
+    def sweep(self, now=None):
+        """Oublie les users dont le seau est de nouveau plein ; renvoie leur nombre."""
+        now = time.time() if now is None else now
+        with self._lock:
+            idle = [user_id for user_id, bucket in self._buckets.items() if bucket.is_idle(now)]
+            for user_id in idle:
+                del self._buckets[user_id]
+        for user_id in idle:
+            STATE.mark("rate", user_id)
+        return len(idle)
+
+    def snapshot(self, user_id):
+        bucket = self._buckets.get(user_id)
+        return {"tokens": bucket.tokens, "updated": bucket.updated} if bucket else None
+
+    def restore(self, user_id, saved):
+        bucket = TokenBucket(self.rate, self.messages, saved["updated"])
+        bucket.tokens = saved["tokens"]
+        self._buckets[user_id] = bucket
+
+
+class LLMBudget:
+    """Budget global OpenAI : appels simultanés max + requêtes par minute."""
+
+    def __init__(self, rpm, max_concurrency):
+        self.max_concurrency = max_concurrency
+        self._rpm = TokenBucket(rpm / 60, max(1, rpm // 6), time.monotonic())
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.rejected = 0
+
+    def try_start(self):
+        """True si l'appel peut partir (à terminer par done())."""
+        with self._lock:
+            if self.in_flight >= self.max_concurrency or self._rpm.wait_time(time.monotonic()) > 0:
+                self.rejected += 1
+                return False
+            self._rpm.take()
+            self.in_flight += 1
+            return True
+
+    def done(self):
+        with self._lock:
+            self.in_flight -= 1
+
+
+USER_LIMITER = UserRateLimiter(RATE_LIMIT_MESSAGES, RATE_LIMIT_WINDOW)
+LLM_BUDGET = LLMBudget(AI_RPM, AI_MAX_CONCURRENCY)
+
+
+def is_rate_limited(user_id):
+    """Rate limiting."""
+    return not USER_LIMITER.allow(user_id)
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# CLIENT LLM
+# ═══════════════════════════════════════════════════════════════════════════════
+
+# Erreurs de l'upstream (réessayables, comptent pour le disjoncteur), remplies par load_openai
+RETRYABLE_ERRORS = ()
+
+
+class CircuitOpen(Exception):
+    """Disjoncteur ouvert : pas d'appel OpenAI."""
+
+
+class CircuitBreaker:
+    """Ouvert après `threshold` échecs consécutifs ; un seul essai après `cooldown` s."""
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+        self.opened = 0
+
+    def available(self, now=None):
+        """False tant qu'il est ouvert (l'essai de réouverture compris)."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            return self._opened_at is None or (not self._probing and now - self._opened_at >= self.cooldown)
+
+    def allow(self, now=None):
+        """Réserve un appel ; après le cooldown, un seul essai à la fois."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._probing or now - self._opened_at < self.cooldown:
+                return False
+            self._probing = True
+            return True
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def failure(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._failures += 1
+            if self._probing or (self._opened_at is None and self._failures >= self.threshold):
+                if self._opened_at is None:
+                    self.opened += 1
+                    logger.error("🔌 Disjoncteur OpenAI ouvert (%d échecs)", self._failures)
+                self._opened_at = now
+                self._probing = False
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return "fermé"
+        return "essai" if self._probing else "ouvert"
+
+
+class SharedSession(requests.Session):
+    """Session HTTP commune à tous les threads IA.
+
+    openai 0.28 ferme la session de chaque thread toutes les 180 s puis la
+    redemande : close() ne fait rien, le pool de connexions reste ouvert.
+    """
+
+    def close(self):
+        pass
+
+
+class LLMClient:
+    """Client OpenAI du chat privé.
+
+    Session HTTP partagée (keep-alive, pas de retry caché), timeouts connect
+    et read, retries à backoff exponentiel + jitter (au moins Retry-After),
+    doublement de la requête si le 1er token dépasse le p95 observé (AI_HEDGE),
+    disjoncteur qui coupe les appels tant que l'upstream échoue.
+    """
+
+    def __init__(self, workers):
+        # Connexions simultanées : un stream lu par worker IA + une requête en cours par thread de hedging
+        hedgers = workers * 2
+        self.session = SharedSession()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers + hedgers, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.breaker = CircuitBreaker(AI_BREAKER_THRESHOLD, AI_BREAKER_COOLDOWN)
+        self._hedge_pool = ThreadPoolExecutor(max_workers=hedgers, thread_name_prefix="llm")
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.short_circuits = 0
+
+    def complete(self, messages, deadline, on_text=None):
+        """Texte de la réponse ; `on_text(texte cumulé)` suit le stream s'il est fourni.
+
+        Lève CircuitOpen si le disjoncteur est ouvert, sinon la dernière erreur OpenAI.
+        """
+        if not self.breaker.allow():
+            self.short_circuits += 1
+            raise CircuitOpen()
+        labels = STREAM_LABELS if on_text else BLOCKING_LABELS
+        for attempt in itertools.count():
+            started = time.monotonic()
+            try:
+                text, rest = self._first_token(messages, deadline, on_text is not None, labels)
+                break
+            except RETRYABLE_ERRORS as e:
+                delay = self._backoff(attempt, e)
+                if attempt >= AI_MAX_RETRIES or time.monotonic() + delay >= deadline:
+                    self.breaker.failure()
+                    raise
+                self.retries += 1
+                logger.warning("🔁 OpenAI %s, nouvel essai dans %.1fs", type(e).__name__, delay)
+                time.sleep(delay)
+            except Exception:
+                self.breaker.success()  # requête refusée, l'upstream répond
+                raise
+        ttft = time.monotonic() - started
+        OPENAI_TTFT.observe(ttft, labels)
+        logger.info("⏱️ TTFT %s: %.0f ms", labels[0], ttft * 1000, extra=LOG_AI_EVENT)
+
+        # Stream entamé : une coupure ici n'est plus rejouable
+        try:
+            if on_text and text:
+                on_text(text)
+            for delta in rest:
+                if delta:
+                    text += delta
+                    on_text(text)
+        except RETRYABLE_ERRORS:
+            self.breaker.failure()
+            raise
+        except Exception:
+            self._close(rest)  # stream abandonné (réponse périmée) : l'upstream a répondu
+            self.breaker.success()
+            raise
+        self.breaker.success()
+        return text.strip()
+
+    def _first_token(self, messages, deadline, stream, labels):
+        """(1er texte, suite du stream), doublé par une 2e requête si le 1er token tarde."""
+        hedge_after = self._hedge_after(labels)
+        if hedge_after is None:
+            return self._open(messages, deadline, stream)
+        primary = self._hedge_pool.submit(self._open, messages, deadline, stream)
+        done, _ = wait([primary], timeout=hedge_after)
+        if done or not LLM_BUDGET.try_start():
+            return primary.result()
+
+        self.hedges += 1
+        hedge = self._hedge_pool.submit(self._open, messages, deadline, stream)
+        hedge.add_done_callback(lambda _: LLM_BUDGET.done())  # slot rendu au 1er token du doublon
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        self.hedge_wins += 1
+                    for loser in pending:
+                        loser.add_done_callback(self._drop_stream)
+                    return future.result()
+                error = error or future.exception()
+        raise error
+
+    def _hedge_after(self, labels):
+        """p95 du 1er token (s), ou None : hedging désactivé ou trop peu de mesures."""
+        if not AI_HEDGE or sum(OPENAI_TTFT.counts(labels)) < AI_HEDGE_MIN_SAMPLES:
+            return None
+        return OPENAI_TTFT.quantile(0.95, labels)
+
+    @staticmethod
+    def _open(messages, deadline, stream):
+        """Lance la requête et attend le 1er texte."""
+        completion = openai.ChatCompletion.create(
+            messages=messages,
+            request_timeout=(AI_CONNECT_TIMEOUT, max(deadline - time.monotonic(), 1)),
+            stream=stream,
+            **AI_COMPLETION_PARAMS,
+        )
+        if not stream:
+            return completion.choices[0].message["content"], iter(())
+        deltas = (chunk.choices[0].delta.get("content") or "" for chunk in completion)
+        for delta in deltas:
+            if delta:
+                return delta, deltas
+        return "", deltas
+
+    @staticmethod
+    def _drop_stream(future):
+        """Requête perdante du hedging : on ferme son stream."""
+        if future.exception() is None:
+            LLMClient._close(future.result()[1])
+
+    @staticmethod
+    def _close(rest):
+        if hasattr(rest, "close"):
+            rest.close()
+
+    @staticmethod
+    def _backoff(attempt, error):
+        """Backoff exponentiel à jitter complet, jamais sous le Retry-After de l'erreur."""
+        delay = random.uniform(0, min(AI_BACKOFF_MAX, AI_BACKOFF_BASE * 2 ** attempt))
+        headers = getattr(error, "headers", None) or {}
+        try:
+            retry_after = float(headers.get("retry-after") or headers.get("Retry-After") or 0)
+        except ValueError:
+            retry_after = 0.0
+        return max(delay, retry_after)
+
+
+LLM_CLIENT = LLMClient(AI_WORKERS)
+OPENAI_IMPORT_LOCK = threading.Lock()
+
+
+def load_openai():
+    """Importe et configure openai au premier appel IA (clé, session partagée, erreurs)."""
+    global openai, RETRYABLE_ERRORS
+    if openai is not None:
+        return openai
+    with OPENAI_IMPORT_LOCK:
+        if openai is None:
+            started = time.monotonic()
+            import openai as module
+
+            module.api_key = OPENAI_API_KEY
+            module.requestssession = LLM_CLIENT.session
+            RETRYABLE_ERRORS = (
+                module.error.RateLimitError,
+                module.error.Timeout,
+                module.error.APIConnectionError,
+                module.error.ServiceUnavailableError,
+                module.error.TryAgain,
+                module.error.APIError,
+            )
+            openai = module
+            BOOT.mark("openai", time.monotonic() - started)
+            logger.info("📦 openai importé en %.0f ms", BOOT.marks["openai"] * 1000)
+    return openai
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# ENVOIS (file sortante)
+# ═══════════════════════════════════════════════════════════════════════════════
+
+# Lanes : la plus petite valeur part en premier
+PRIORITY_DM = 0
+PRIORITY_GROUP = 1
+PRIORITY_FOLLOWUP = 2
+PRIORITY_NAMES = {PRIORITY_DM: "dm", PRIORITY_GROUP: "groupe", PRIORITY_FOLLOWUP: "relances"}
+LANE_LABELS = {priority: (name,) for priority, name in PRIORITY_NAMES.items()}
+
+
+class OutboundItem:
+    __slots__ = ("chat_id", "label", "priority", "func", "args", "kwargs", "future", "retries", "seq")
+
+    def __init__(self, chat_id, label, priority, func, args, kwargs):
+        self.chat_id = chat_id
+        self.label = label
+        self.priority = priority
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.retries = 0
+        self.seq = 0  # ordre d'arrivée, gardé aux remises en file (attente de jeton, RetryAfter)
+
+
+class OutboundSender:
+    """File d'envoi centrale vers Telegram.
+
+    Un thread d'ordonnancement prend le prochain envoi de la lane la plus
+    prioritaire dont le chat a un jeton (seau par chat) et, tant que le seau
+    global en a, le confie à un worker libre : un envoi reste dans la file (et
+    dans depths()) jusqu'à ce qu'un worker le prenne. Un chat à court de jetons est mis
+    en attente sans bloquer les autres. RetryAfter met le chat en pause le
+    temps demandé puis renvoie le message (OUTBOUND_MAX_RETRIES fois max).
+    Un seul envoi à la fois par chat : les suivants sont garés jusqu'à la fin
+    du précédent, les messages d'un chat partent dans l'ordre.
+    """
+
+    def __init__(self):
+        now = time.monotonic()
+        self._global = TokenBucket(OUTBOUND_GLOBAL_RATE, OUTBOUND_GLOBAL_RATE, now)
+        self._chats = {}
+        self._ready = []    # (priorité, seq, item)
+        self._delayed = []  # (prêt_à, priorité, seq, item)
+        self._owners = {}   # chat_id → envoi en cours de ce chat (en vol ou en attente de jeton)
+        self._parked = {}   # chat_id → deque des envois suivants de ce chat
+        self._parked_count = 0
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._pool = ThreadPoolExecutor(max_workers=OUTBOUND_WORKERS, thread_name_prefix="send")
+        self._thread = None
+        self._stopped = False
+        self._closed = False  # stop() : plus rien n'est confié au pool
+        self._active = 0      # envois confiés aux workers, pas encore terminés
+        self._last_gc = now
+        self.sent = 0
+        self.retried = 0
+        self.dropped = 0
+        self.failed = 0
+        self.abandoned = 0    # encore en file au-delà du délai de stop()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="outbound", daemon=True)
+        self._thread.start()
+
+    def submit(self, chat_id, label, priority, func, /, *args, **kwargs):
+        """Met un appel d'envoi en file ; renvoie un Future (résultat de l'appel).
+
+        `chat_id` None : appel hors message (typing, réponse de bouton, suppression),
+        hors seaux : les limites Telegram portent sur les messages.
+        """
+        if priority is None:
+            priority = PRIORITY_DM if chat_id > 0 else PRIORITY_GROUP
+        item = OutboundItem(chat_id, label, priority, func, args, kwargs)
+        with self._cond:
+            if len(self._ready) + len(self._delayed) + self._parked_count >= OUTBOUND_MAX_QUEUE:
+                self.dropped += 1
+                logger.warning("Erreur %s: file d'envoi pleine (%d)", label, OUTBOUND_MAX_QUEUE)
+                item.future.set_exception(RuntimeError("file d'envoi pleine"))
+                return item.future
+            self._push(item)
+        return item.future
+
+    def _push(self, item, ready_at=0.0):
+        if not item.seq:
+            self._seq += 1
+            item.seq = self._seq
+        if ready_at:
+            heapq.heappush(self._delayed, (ready_at, item.priority, item.seq, item))
+        else:
+            heapq.heappush(self._ready, (item.priority, item.seq, item))
+        self._cond.notify()
+
+    def _release(self, item):
+        """Envoi terminé (lock tenu) : le chat passe à son prochain envoi garé."""
+        if item.chat_id is None or self._owners.get(item.chat_id) is not item or not item.future.done():
+            return  # hors message, ou remis en file après RetryAfter : le chat reste à lui
+        del self._owners[item.chat_id]
+        parked = self._parked.get(item.chat_id)
+        if parked:
+            self._parked_count -= 1
+            self._push(parked.popleft())
+            if not parked:
+                del self._parked[item.chat_id]
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if chat_id > 0:
+                bucket = TokenBucket(OUTBOUND_PRIVATE_RATE, OUTBOUND_PRIVATE_BURST, now)
+            else:
+                bucket = TokenBucket(OUTBOUND_GROUP_RATE, OUTBOUND_GROUP_BURST, now)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def _run(self):
+        with self._cond:
+            while not self._closed and not (self._stopped and not self._ready and not self._delayed
+                                            and not self._parked_count):
+                item = self._next_item()
+                if item is not None:
+                    self._active += 1
+                    self._pool.submit(self._deliver, item)
+
+    def _next_item(self):
+        """Prochain envoi autorisé, ou None après avoir attendu (lock tenu)."""
+        now = time.monotonic()
+        while self._delayed and self._delayed[0][0] <= now:
+            _, priority, seq, item = heapq.heappop(self._delayed)
+            heapq.heappush(self._ready, (priority, seq, item))
+        if now - self._last_gc > 60:
+            self._gc(now)
+
+        if not self._ready:
+            self._cond.wait(self._delayed[0][0] - now if self._delayed else 1.0)
+            return None
+        if self._active >= OUTBOUND_WORKERS:
+            self._cond.wait(1.0)  # réveillé par la fin d'un envoi
+            return None
+        if self._ready[0][-1].chat_id is None:
+            return heapq.heappop(self._ready)[-1]  # hors message : pas de seau
+        wait = self._global.wait_time(now)
+        if wait > 0:
+            self._cond.wait(wait)
+            return None
+
+        _, _, item = heapq.heappop(self._ready)
+        owner = self._owners.get(item.chat_id)
+        if owner is not None and owner is not item:
+            # Envoi précédent du chat pas terminé : garé, repris par _release
+            self._parked.setdefault(item.chat_id, deque()).append(item)
+            self._parked_count += 1
+            return None
+        self._owners[item.chat_id] = item
+        bucket = self._chat_bucket(item.chat_id, now)
+        wait = bucket.wait_time(now)
+        if wait > 0:
+            self._push(item, now + wait)
+            return None
+        bucket.take()
+        self._global.take()
+        return item
+
+    def _gc(self, now):
+        """Oublie les seaux pleins et inactifs (un seau neuf est plein)."""
+        self._last_gc = now
+        for chat_id in [c for c, b in self._chats.items() if b.is_idle(now)]:
+            del self._chats[chat_id]
+
+    @staticmethod
+    def _call(item):
+        """Appel Bot API chronométré."""
+        started = time.monotonic()
+        try:
+            return item.func(*item.args, **item.kwargs)
+        finally:
+            SEND_LATENCY.observe(time.monotonic() - started, LANE_LABELS[item.priority])
+
+    def _deliver(self, item):
+        try:
+            self._send(item)
+        finally:
+            with self._cond:
+                self._active -= 1
+                self._release(item)
+                self._cond.notify()
+
+    def _send(self, item):
+        try:
+            result = self._call(item)
+        except RetryAfter as e:
+            ERRORS.inc(("telegram", "RetryAfter"))
+            with self._cond:
+                now = time.monotonic()
+                if item.chat_id is not None:
+                    self._chat_bucket(item.chat_id, now).pause(e.retry_after, now)
+                if item.retries < OUTBOUND_MAX_RETRIES and not self._closed:
+                    item.retries += 1
+                    self.retried += 1
+                    logger.warning("⏳ RetryAfter %ss (%s → %s)", e.retry_after, item.label, item.chat_id)
+                    self._push(item, 0.0 if item.chat_id is not None else now + e.retry_after)
+                    return
+                self.dropped += 1
+            logger.warning("Erreur %s: %s", item.label, e)
+            item.future.set_exception(e)
+        except Exception as e:
+            ERRORS.inc(("telegram", type(e).__name__))
+            with self._cond:
+                self.failed += 1
+            logger.warning("Erreur %s: %s", item.label, e)
+            item.future.set_exception(e)
+        else:
+            with self._cond:
+                self.sent += 1
+            item.future.set_result(result)
+
+    def depths(self):
+        """Profondeur de file par lane (envois pas encore pris par un worker, garés compris)."""
+        with self._cond:
+            depths = {name: 0 for name in PRIORITY_NAMES.values()}
+            for entry in self._ready + self._delayed:
+                depths[PRIORITY_NAMES[entry[-1].priority]] += 1
+            for parked in self._parked.values():
+                for item in parked:
+                    depths[PRIORITY_NAMES[item.priority]] += 1
+            return depths
+
+    def stop(self, timeout=10):
+        """Vide la file (au plus `timeout` s) puis arrête les threads ; le reste est abandonné."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join(timeout)
+        with self._cond:
+            self._closed = True
+            abandoned = [entry[-1] for entry in self._ready + self._delayed]
+            abandoned += [item for parked in self._parked.values() for item in parked]
+            self._ready, self._delayed, self._parked, self._parked_count = [], [], {}, 0
+            self.abandoned += len(abandoned)
+            self._cond.notify()
+        if abandoned:
+            logger.warning("📤 %d envois abandonnés à l'arrêt", len(abandoned))
+        for item in abandoned:
+            item.future.set_exception(RuntimeError("file d'envoi arrêtée"))
+        self._pool.shutdown(wait=True)
+
+
+OUTBOX = OutboundSender()
+
+
+def send_message(context, chat_id, text, label, priority=None, **kwargs):
+    """bot.send_message via la file sortante (renvoie un Future)."""
+    return OUTBOX.submit(chat_id, label, priority, context.bot.send_message, chat_id=chat_id, text=text, **kwargs)
+
+
+def reply(message, text, label, priority=None, **kwargs):
+    """message.reply_text via la file sortante (renvoie un Future)."""
+    return OUTBOX.submit(message.chat.id, label, priority, message.reply_text, text, **kwargs)
+
+
+def record_shown(future, chat_id, user_id, step):
+    """Événement "shown" une fois le message accepté par Telegram (rien si l'envoi échoue)."""
+    def on_sent(done):
+        if not done.exception():
+            EVENTS.record("shown", chat_id, user_id, step)
+
+    future.add_done_callback(on_sent)
+
+
 # ═══════════════════════════════════════════════════════════════════════════════
 # HANDLERS TELEGRAM
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -283,58 +3374,98 @@ def is_presentation(text):
 
 @log_handler
 def welcome_new_members(update, context):
-    """Message PUBLIC quand quelqu'un rejoint."""
+    """Message PUBLIC quand quelqu'un rejoint (regroupé pendant les vagues)."""
     message = update.message
     chat = message.chat
 
+    members = []
     for new_member in message.new_chat_members:
         if new_member.is_bot:
             continue
 
-        stats["total_new_members"] += 1
-        logger.info(f"📥 Nouveau: {new_member.first_name} (total: {stats['total_new_members']})")
+        STATS.inc("total_new_members")
+        logger.info("📥 Nouveau: %s", new_member.first_name)
+        members.append((new_member.id, new_member.first_name))
 
-        try:
-            context.bot.send_message(
-                chat_id=chat.id,
-                text=WELCOME_PUBLIC,
-                reply_markup=m2m_keyboard_main("welcome"),
-            )
-        except Exception as e:
-            logger.warning(f"Erreur welcome: {e}")
+    if not members:
+        return
 
+    if WELCOMES.add(chat.id, members):
+        send_welcome(context, chat.id, members, len(members))
+        context.job_queue.run_once(flush_welcomes, WELCOME_COALESCE_WINDOW, context=chat.id)
 
-def schedule_followups(context, user_id):
-    """Programme les relances DM."""
-    delays = [
-        (24 * 60 * 60, 0),
-        (72 * 60 * 60, 1),
-        (7 * 24 * 60 * 60, 2),
-    ]
-    for delay, idx in delays:
-        try:
-            context.job_queue.run_once(
-                lambda ctx, i=idx: send_followup(ctx, i),
-                when=delay,
-                context=user_id,
-                name=f"followup_{user_id}_{idx}",
-            )
-        except Exception as e:
-            logger.warning(f"Erreur schedule followup {idx}: {e}")
 
+def flush_welcomes(context):
+    """Fin de fenêtre : un seul welcome pour toutes les arrivées accumulées."""
+    chat_id = context.job.context
+    members, new_count = WELCOMES.take(chat_id)
+    if not new_count:
+        return
+
+    logger.info("📥 Vague: %d arrivées regroupées (%s)", new_count, chat_id)
+    send_welcome(context, chat_id, members, new_count)
+    context.job_queue.run_once(flush_welcomes, WELCOME_COALESCE_WINDOW, context=chat_id)
 
-def send_followup(context, msg_index):
-    """Envoie une relance."""
-    user_id = context.job.context
-    try:
-        context.bot.send_message(
-            chat_id=user_id,
-            text=FOLLOWUP_MESSAGES[msg_index],
-            reply_markup=m2m_keyboard_simple(f"followup_{msg_index}"),
+
+def send_welcome(context, chat_id, members, new_count):
+    """Welcome public ; remplace le welcome précédent de la même vague."""
+    STATS.inc("total_welcomes_saved", new_count - 1)
+
+    if len(members) == 1:
+        future = send_message(
+            context, chat_id, WELCOME_PUBLIC, "welcome",
+            reply_markup=m2m_keyboard_main("welcome"),
         )
-        logger.info(f"📤 Follow-up {msg_index} → {user_id}")
-    except Exception as e:
-        logger.warning(f"Erreur followup {msg_index}: {e}")
+    else:
+        mentions = [
+            f'<a href="tg://user?id={user_id}">{html.escape(name or "toi")}</a>'
+            for user_id, name in members[:WELCOME_MAX_NAMES]
+        ]
+        if len(members) > WELCOME_MAX_NAMES:
+            mentions.append(f"{len(members) - WELCOME_MAX_NAMES} autres")
+        names = ", ".join(mentions[:-1]) + " et " + mentions[-1]
+        future = send_message(
+            context, chat_id, WELCOME_PUBLIC_GROUPED.format(names=names), "welcome",
+            parse_mode="HTML",
+            reply_markup=m2m_keyboard_main("welcome"),
+        )
+
+    def on_sent(done):
+        if done.exception():
+            return
+        previous = WELCOMES.replace_last(chat_id, done.result().message_id)
+        if previous and WELCOME_REPLACE_PREVIOUS:
+            OUTBOX.submit(None, "suppression welcome", PRIORITY_GROUP, context.bot.delete_message,
+                          chat_id=chat_id, message_id=previous)
+
+    future.add_done_callback(on_sent)
+    for user_id, _ in members[-new_count:]:
+        record_shown(future, chat_id, user_id, "welcome")
+
+
+def drain_followups(context):
+    """Job périodique : envoie les relances échues, par lots."""
+    due = FOLLOWUPS.pop_due(time.time(), FOLLOWUP_BATCH)
+    for user_id, msg_index in due:
+        send_followup(context, user_id, msg_index)
+    if len(due) == FOLLOWUP_BATCH:
+        logger.info("📤 Lot de relances plein (%d), suite au prochain passage", FOLLOWUP_BATCH)
+
+
+def send_followup(context, user_id, msg_index):
+    """Envoie une relance (lane la moins prioritaire)."""
+    future = send_message(
+        context, user_id, FOLLOWUP_MESSAGES[msg_index], f"followup {msg_index}",
+        priority=PRIORITY_FOLLOWUP,
+        reply_markup=m2m_keyboard_simple(f"followup_{msg_index}"),
+    )
+
+    def on_sent(done):
+        if not done.exception():
+            logger.info("📤 Follow-up %d → %s", msg_index, user_id)
+            EVENTS.record("followup", user_id, user_id, str(msg_index))
+
+    future.add_done_callback(on_sent)
 
 
 @log_handler
@@ -344,55 +3475,42 @@ def cmd_start(update, context):
     user = update.effective_user
 
     if chat.type in ("group", "supergroup"):
-        try:
-            context.bot.send_message(
-                chat_id=chat.id,
-                text="📩 En privé → https://t.me/mad2moi_helper_bot?start=go",
-            )
-        except Exception as e:
-            logger.warning(f"Erreur /start groupe: {e}")
+        send_message(context, chat.id, "📩 En privé → https://t.me/mad2moi_helper_bot?start=go", "/start groupe")
         return
 
     send_typing(context, chat.id)
-    user_conversations[user.id] = []
+    user_conversations.reset(user.id)
+    STATE.mark("conversations", user.id)
 
-    try:
-        context.bot.send_message(
-            chat_id=chat.id,
-            text=WELCOME_DM,
-            reply_markup=m2m_keyboard_simple("dm_start"),
-        )
-        context.bot.send_message(
-            chat_id=chat.id,
-            text="Qu'est-ce qui t'amène ? 👇",
-            reply_markup=menu_keyboard(),
-        )
-    except Exception as e:
-        logger.warning(f"Erreur /start DM: {e}")
+    future = send_message(context, chat.id, WELCOME_DM, "/start DM", reply_markup=m2m_keyboard_simple("dm_start"))
+    record_shown(future, chat.id, user.id, "dm_start")
+    send_message(context, chat.id, "Qu'est-ce qui t'amène ? 👇", "/start DM", reply_markup=menu_keyboard())
 
-    schedule_followups(context, user.id)
+    FOLLOWUPS.schedule(user.id)
 
 
 @log_handler
 def cmd_help(update, context):
     """/help"""
     chat = update.effective_chat
-    try:
-        context.bot.send_message(
-            chat_id=chat.id,
-            text=HELP_TEXT,
-            parse_mode="Markdown",
-            reply_markup=m2m_keyboard_simple("help"),
-        )
-    except Exception as e:
-        logger.warning(f"Erreur /help: {e}")
+    future = send_message(
+        context, chat.id, HELP_TEXT, "/help",
+        parse_mode="Markdown",
+        reply_markup=m2m_keyboard_simple("help"),
+    )
+    record_shown(future, chat.id, update.effective_user.id, "help")
 
 
 @log_handler
 def cmd_inscription(update, context):
     """/inscription"""
     chat = update.effective_chat
-    stats["button_clicks"]["cmd_inscription"] += 1
+    STATS.click("cmd_inscription")
+    EVENTS.record("click", chat.id, update.effective_user.id, "cmd_inscription")
+
+    # Demande du lien d'inscription = conversion : plus de relances
+    if chat.type == "private":
+        FOLLOWUPS.cancel(update.effective_user.id)
 
     text = f"""🚀 **Inscris-toi maintenant !**
 
@@ -400,30 +3518,23 @@ def cmd_inscription(update, context):
 
 Gratuit, rapide, sécurisé ✅"""
 
-    try:
-        context.bot.send_message(
-            chat_id=chat.id,
-            text=text,
-            parse_mode="Markdown",
-            reply_markup=m2m_keyboard_simple("cmd_inscription"),
-        )
-    except Exception as e:
-        logger.warning(f"Erreur /inscription: {e}")
+    send_message(
+        context, chat.id, text, "/inscription",
+        parse_mode="Markdown",
+        reply_markup=m2m_keyboard_simple("cmd_inscription"),
+    )
 
 
 @log_handler
 def cmd_about(update, context):
     """/about"""
     chat = update.effective_chat
-    try:
-        context.bot.send_message(
-            chat_id=chat.id,
-            text=ABOUT_TEXT,
-            parse_mode="Markdown",
-            reply_markup=m2m_keyboard_simple("about"),
-        )
-    except Exception as e:
-        logger.warning(f"Erreur /about: {e}")
+    future = send_message(
+        context, chat.id, ABOUT_TEXT, "/about",
+        parse_mode="Markdown",
+        reply_markup=m2m_keyboard_simple("about"),
+    )
+    record_shown(future, chat.id, update.effective_user.id, "about")
 
 
 @log_handler
@@ -431,16 +3542,11 @@ def cmd_reset(update, context):
     """/reset"""
     user = update.effective_user
     chat = update.effective_chat
-    user_conversations[user.id] = []
+    user_conversations.reset(user.id)
+    STATE.mark("conversations", user.id)
+    FOLLOWUPS.cancel(user.id)
 
-    try:
-        context.bot.send_message(
-            chat_id=chat.id,
-            text=RESET_CONFIRM,
-            reply_markup=menu_keyboard(),
-        )
-    except Exception as e:
-        logger.warning(f"Erreur /reset: {e}")
+    send_message(context, chat.id, RESET_CONFIRM, "/reset", reply_markup=menu_keyboard())
 
 
 @log_handler
@@ -450,8 +3556,9 @@ def menu_callback(update, context):
     data = query.data
     user_id = query.from_user.id
 
-    query.answer()
-    stats["button_clicks"][data] += 1
+    OUTBOX.submit(None, "réponse bouton", PRIORITY_DM, context.bot.answer_callback_query, query.id)
+    STATS.click(data)
+    EVENTS.record("click", query.message.chat.id if query.message else user_id, user_id, data)
 
     responses = {
         "menu_rencontres": "💘 Parfait ! Pour les rencontres, c'est par ici :",
@@ -462,14 +3569,8 @@ def menu_callback(update, context):
     txt = responses.get(data, responses["menu_decouverte"])
     step = data.replace("menu_", "")
 
-    try:
-        context.bot.send_message(
-            chat_id=user_id,
-            text=txt,
-            reply_markup=m2m_keyboard_simple(step),
-        )
-    except Exception as e:
-        logger.warning(f"Erreur callback: {e}")
+    future = send_message(context, user_id, txt, "callback", reply_markup=m2m_keyboard_simple(step))
+    record_shown(future, user_id, user_id, step)
 
 
 @log_handler
@@ -485,35 +3586,36 @@ def group_message_handler(update, context):
     if not text:
         return
     
-    text_lower = text.lower()
+    # Une seule passe pour les deux listes de keywords
+    presentation_hits, rencontre_hits = KEYWORD_MATCHER.count(text)
     
     # 1. Vérifier si c'est une PRÉSENTATION (prioritaire)
-    if is_presentation(text) and user.id not in users_welcomed_presentation:
-        users_welcomed_presentation.add(user.id)
-        stats["total_presentations"] += 1
+    if is_presentation(text, presentation_hits) and users_welcomed_presentation.add(message.chat.id, user.id):
+        STATS.inc("total_presentations")
         
         name = user.first_name or "toi"
-        logger.info(f"📝 Présentation: {name} (total: {stats['total_presentations']})")
+        logger.info("📝 Présentation: %s", name, extra=LOG_KEYWORD_EVENT)
         
-        try:
-            message.reply_text(
-                WELCOME_PRESENTATION.format(name=name),
-                reply_markup=m2m_keyboard_simple("presentation"),
-            )
-        except Exception as e:
-            logger.warning(f"Erreur reply présentation: {e}")
+        future = reply(
+            message, WELCOME_PRESENTATION.format(name=name), "reply présentation",
+            reply_markup=m2m_keyboard_simple("presentation"),
+        )
+        record_shown(future, message.chat.id, user.id, "presentation")
         return
     
     # 2. Sinon, vérifier les KEYWORDS rencontre
-    if any(k in text_lower for k in KEYWORDS_RENCONTRE):
-        logger.info(f"🔑 Keyword: '{text[:30]}...'")
-        try:
-            message.reply_text(
-                "💡 Pour de vraies rencontres →",
-                reply_markup=m2m_keyboard_simple("keyword"),
-            )
-        except Exception as e:
-            logger.warning(f"Erreur keyword reply: {e}")
+    if rencontre_hits:
+        # Cooldown avant tout envoi : pas de rafale de réponses identiques dans le groupe
+        if not KEYWORD_COOLDOWN.allow(message.chat.id, user.id):
+            STATS.inc("total_keyword_suppressed")
+            return
+        STATS.inc("total_keyword_replies")
+        logger.info("🔑 Keyword: '%.30s...'", text, extra=LOG_KEYWORD_EVENT)
+        future = reply(
+            message, "💡 Pour de vraies rencontres →", "keyword reply",
+            reply_markup=m2m_keyboard_simple("keyword"),
+        )
+        record_shown(future, message.chat.id, user.id, "keyword")
 
 
 @log_handler
@@ -523,86 +3625,301 @@ def handle_media(update, context):
     if chat.type != "private":
         return
 
-    try:
-        context.bot.send_message(chat_id=chat.id, text=MEDIA_RESPONSE)
-    except Exception as e:
-        logger.warning(f"Erreur média: {e}")
+    send_message(context, chat.id, MEDIA_RESPONSE, "média")
 
 
 @log_handler
 def private_ai_chat(update, context):
     """IA en DM."""
     message = update.message
-    chat = message.chat
     user = message.from_user
 
     user_text = (message.text or "").strip()
     if not user_text:
         return
 
-    stats["total_private_messages"] += 1
+    STATS.inc("total_private_messages")
 
-    if is_rate_limited(user.id):
-        logger.warning(f"⚠️ Rate limit: {user.id}")
-        try:
-            message.reply_text(RATE_LIMIT_MSG)
-        except Exception:
-            pass
+    # Rafale : on attend la fin avant de répondre une seule fois à l'ensemble
+    if DM_DEBOUNCE_WINDOW > 0:
+        delay = DM_DEBOUNCER.add(user.id, user_text, message)
+        if delay is not None:
+            context.job_queue.run_once(flush_dm_burst, delay, context=user.id)
         return
 
-    send_typing(context, chat.id)
+    start_ai_turn(context, message, user.id, user_text)
 
-    if not OPENAI_API_KEY:
-        try:
-            message.reply_text(
-                "Je ne peux pas utiliser l'IA maintenant.\n\n"
-                "Découvre Mad2Moi : https://www.mad2moi.com/"
-            )
-        except Exception as e:
-            logger.warning(f"Erreur fallback: {e}")
+
+def flush_dm_burst(context):
+    """Fin de rafale DM : un seul tour IA pour tous les messages regroupés."""
+    user_id = context.job.context
+    delay = DM_DEBOUNCER.due_in(user_id)
+    if delay is None:
         return
+    if delay > 0:
+        # Rafale prolongée par un message arrivé entre-temps
+        context.job_queue.run_once(flush_dm_burst, delay, context=user_id)
+        return
+    run_dm_burst(context, user_id)
 
-    user_conversations[user.id].append({"role": "user", "content": user_text})
 
-    if len(user_conversations[user.id]) > MAX_HISTORY * 2:
-        user_conversations[user.id] = user_conversations[user.id][-MAX_HISTORY * 2:]
+def flush_dm_bursts(dispatcher):
+    """Arrêt : lance tout de suite les rafales en attente (leurs jobs ne tourneront plus).
+
+    Appelé une fois les mailboxes vidées : plus aucun handler ne peut ouvrir de rafale.
+    """
+    pending = DM_DEBOUNCER.pending()
+    if pending:
+        logger.info("🧵 %d rafales DM lancées à l'arrêt", len(pending))
+    context = CallbackContext(dispatcher)
+    for user_id in pending:
+        run_dm_burst(context, user_id)
 
-    messages = [{"role": "system", "content": AI_SYSTEM_PROMPT}]
-    messages.extend(user_conversations[user.id])
 
+def run_dm_burst(context, user_id):
+    """Un seul tour IA pour tous les messages regroupés de la rafale."""
+    burst = DM_DEBOUNCER.take(user_id)
+    if burst is None:
+        return
+    texts, message, generation = burst
+    if len(texts) > 1:
+        logger.info("🧵 Rafale DM: %d messages regroupés (%s)", len(texts), user_id)
+    submitted = False
     try:
-        completion = openai.ChatCompletion.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            temperature=0.7,
-            max_tokens=400,
-            presence_penalty=0.3,
-            frequency_penalty=0.3,
+        submitted = start_ai_turn(context, message, user_id, "\n".join(texts), generation)
+    finally:
+        if not submitted:
+            DM_DEBOUNCER.finish(user_id, generation)
+
+
+def start_ai_turn(context, message, user_id, user_text, generation=None):
+    """Un tour IA (message seul ou rafale) ; True si la réponse part dans le pool IA."""
+    if is_rate_limited(user_id):
+        logger.warning("⚠️ Rate limit: %s", user_id)
+        reply(message, RATE_LIMIT_MSG, "rate limit")
+        return False
+
+    # Question FAQ reconnue : réponse toute faite, sans OpenAI
+    if INTENT_ROUTING and route_intent(message, user_id, user_text):
+        return False
+
+    if not OPENAI_API_KEY:
+        reply(
+            message,
+            "Je ne peux pas utiliser l'IA maintenant.\n\n"
+            "Découvre Mad2Moi : https://www.mad2moi.com/",
+            "fallback",
         )
-        answer = completion.choices[0].message["content"].strip()
-        stats["total_ai_responses"] += 1
-        user_conversations[user.id].append({"role": "assistant", "content": answer})
-        logger.info(f"✅ IA ({len(answer)} chars) - Total: {stats['total_ai_responses']}")
+        return False
+
+    # Question fréquente déjà répondue : pas d'appel OpenAI (lecture seule si historique court,
+    # écriture seulement depuis un historique vide, cf. generate_answer)
+    cache_key = None
+    if user_conversations.length(user_id) <= AI_CACHE_MAX_HISTORY and not user_conversations.has_summary(user_id):
+        cache_key = normalize_question(user_text) or None
+    if cache_key:
+        answer = AI_ANSWER_CACHE.get(cache_key)
+        if answer is not None:
+            user_conversations.append(user_id, ROLE_USER, user_text)
+            user_conversations.append(user_id, ROLE_ASSISTANT, answer)
+            STATE.mark("conversations", user_id)
+            logger.info("⚡ IA cache (%d chars)", len(answer), extra=LOG_AI_EVENT)
+            reply(message, answer, "envoi")
+            return False
+
+    # OpenAI en panne : réponse de secours tout de suite, sans passer par le pool
+    if not LLM_CLIENT.breaker.available():
+        STATS.inc("total_ai_fallback")
+        reply(message, AI_FALLBACK_MSG, "fallback")
+        return False
+
+    # L'appel OpenAI part dans le pool IA : le dispatcher est libéré tout de suite
+    if AI_POOL.submit(user_id, answer_ai, context, message, user_id, user_text, time.monotonic(), cache_key,
+                      generation) is None:
+        STATS.inc("total_ai_busy")
+        logger.warning("⚠️ Pool IA plein (%d): %s", AI_POOL.capacity, user_id)
+        reply(message, AI_BUSY_MSG, "busy")
+        return False
+
+    send_typing(context, message.chat_id)
+    return True
+
+
+def intent_answer(intent):
+    """(texte, options d'envoi) de la réponse toute faite d'un intent."""
+    if intent == "inscription":
+        return INTENT_INSCRIPTION, {"reply_markup": m2m_keyboard_simple("intent_inscription")}
+    if intent == "gratuit":
+        return INTENT_GRATUIT, {"reply_markup": m2m_keyboard_simple("intent_gratuit")}
+    if intent == "about":
+        return ABOUT_TEXT, {"parse_mode": "Markdown", "reply_markup": m2m_keyboard_simple("intent_about")}
+    return WELCOME_DM, {"reply_markup": m2m_keyboard_main("intent_salut")}
+
+
+def route_intent(message, user_id, user_text):
+    """Réponse locale si le DM est une FAQ reconnue ; True si elle est envoyée."""
+    intent, confidence = INTENT_ROUTER.classify(user_text)
+    # Salut en pleine conversation : l'IA enchaîne mieux qu'un accueil figé
+    if intent == "salut" and user_conversations.length(user_id):
+        intent = None
+    if intent is None:
+        INTENT_ROUTES.inc(LLM_ROUTE)
+        return False
+
+    INTENT_ROUTES.inc((intent,))
+    saved = OPENAI_LATENCY.quantile(0.5)
+    if saved:
+        INTENT_SAVED.inc(amount=saved)
+    # Demande du lien d'inscription = conversion : plus de relances
+    if intent == "inscription":
+        FOLLOWUPS.cancel(user_id)
+
+    text, options = intent_answer(intent)
+    user_conversations.append(user_id, ROLE_USER, user_text)
+    user_conversations.append(user_id, ROLE_ASSISTANT, text)
+    STATE.mark("conversations", user_id)
+    logger.info("🎯 Intent %s (%.2f): %s", intent, confidence, user_id, extra=LOG_AI_EVENT)
+    record_shown(reply(message, text, f"intent {intent}", **options), message.chat.id, user_id, f"intent_{intent}")
+    return True
+
+
+def answer_ai(context, message, user_id, user_text, submitted_at, cache_key=None, generation=None):
+    """Génère et envoie la réponse IA (thread du pool IA)."""
+    if generation is None:
+        return generate_answer(message, user_id, user_text, submitted_at, cache_key)
+    try:
+        # Rafale remplacée avant l'appel : ses messages sont repris par la suivante
+        if not DM_DEBOUNCER.start(user_id, generation):
+            logger.info("⏭️ Tour IA remplacé avant l'appel: %s", user_id)
+            return
+        generate_answer(message, user_id, user_text, submitted_at, cache_key, generation)
+    finally:
+        DM_DEBOUNCER.finish(user_id, generation)
+
+
+def generate_answer(message, user_id, user_text, submitted_at, cache_key=None, generation=None):
+    """Appel OpenAI puis envoi ; rien n'est envoyé si l'user a écrit entre-temps."""
+    waited = time.monotonic() - submitted_at
+    if waited > AI_TIMEOUT:
+        STATS.inc("total_ai_busy")
+        logger.warning("⚠️ Requête IA expirée en file (%.1fs): %s", waited, user_id)
+        reply(message, AI_BUSY_MSG, "busy")
+        return
+
+    # 1er appel IA du process : import d'openai, différé pour accélérer le boot
+    load_openai()
+
+    def current():
+        return generation is None or DM_DEBOUNCER.is_current(user_id, generation)
+
+    streaming = StreamingReply(message, current) if AI_STREAMING else None
+    timeout = max(AI_TIMEOUT - waited, 1)
 
+    # Budget global OpenAI dépassé : réponse fixe, pas d'appel
+    if not LLM_BUDGET.try_start():
+        STATS.inc("total_ai_busy")
+        logger.warning("⚠️ Budget OpenAI atteint (%d/min, %d simultanés): %s", AI_RPM, AI_MAX_CONCURRENCY, user_id)
+        reply(message, AI_BUSY_MSG, "busy")
+        return
+
+    # Slot du budget rendu dans le finally, quoi qu'il arrive (préparation du prompt comprise)
+    try:
+        # Réponse mise en cache seulement si elle ne dépend d'aucun contexte de l'user
+        if user_conversations.length(user_id) or user_conversations.has_summary(user_id):
+            cache_key = None
+        user_conversations.append(user_id, ROLE_USER, user_text)
+        messages, prompt_tokens = build_prompt(user_id)
+        STATE.mark("conversations", user_id)
+        logger.info("🧮 Prompt: ~%d tokens (%d messages)", prompt_tokens, len(messages) - 1, extra=LOG_AI_EVENT)
+
+        answer = run_completion(messages, timeout, streaming)
+        if not current():
+            raise Superseded()
+        STATS.inc("total_ai_responses")
+        user_conversations.append(user_id, ROLE_ASSISTANT, answer)
+        STATE.mark("conversations", user_id)
+        if cache_key and answer:
+            AI_ANSWER_CACHE.put(cache_key, answer)
+        logger.info("✅ IA (%d chars)", len(answer), extra=LOG_AI_EVENT)
+
+    except Superseded:
+        # Le message suivant de l'user relance un tour avec tout le contexte
+        if streaming:
+            streaming.retract()
+        logger.info("⏭️ Réponse IA périmée, non envoyée: %s", user_id)
+        return
+    except CircuitOpen:
+        STATS.inc("total_ai_fallback")
+        logger.warning("🔌 Disjoncteur OpenAI ouvert: %s", user_id)
+        answer = AI_FALLBACK_MSG
     except openai.error.RateLimitError:
         logger.error("❌ OpenAI rate limit")
         answer = "Je suis débordée 😅\n\nDécouvre Mad2Moi : https://www.mad2moi.com/"
+    except openai.error.Timeout:
+        logger.error("❌ OpenAI timeout (%ss)", AI_TIMEOUT)
+        answer = "Je suis un peu lente là 😅\n\nMad2Moi : https://www.mad2moi.com/"
     except openai.error.APIError as e:
-        logger.error(f"❌ OpenAI API: {e}")
+        logger.error("❌ OpenAI API: %s", e)
         answer = "Souci technique…\n\nMad2Moi : https://www.mad2moi.com/"
     except Exception as e:
-        logger.error(f"❌ Erreur: {e}")
+        logger.error("❌ Erreur: %s", e)
         answer = "Je n'arrive pas à répondre.\n\nMad2Moi : https://www.mad2moi.com/"
+    finally:
+        LLM_BUDGET.done()
 
+    if not current():
+        if streaming:
+            streaming.retract()
+        return
+    if streaming:
+        streaming.finish(answer)
+        return
+
+    reply(message, answer, "envoi")
+
+
+AI_COMPLETION_PARAMS = {
+    "model": "gpt-4o-mini",
+    "temperature": 0.7,
+    "max_tokens": 400,
+    "presence_penalty": 0.3,
+    "frequency_penalty": 0.3,
+}
+
+
+def run_completion(messages, timeout, streaming):
+    """Appel OpenAI (stream ou bloquant), chronométré ; le slot du budget est rendu par l'appelant."""
+    started = time.monotonic()
     try:
-        message.reply_text(answer)
+        return LLM_CLIENT.complete(messages, started + timeout, streaming.push if streaming else None)
+    except Superseded:
+        raise
     except Exception as e:
-        logger.warning(f"Erreur envoi: {e}")
+        ERRORS.inc(("openai", type(e).__name__))
+        raise
+    finally:
+        OPENAI_LATENCY.observe(time.monotonic() - started, STREAM_LABELS if streaming else BLOCKING_LABELS)
+
+
+def trend(current, previous):
+    """Évolution vs la période précédente (+12 %, -40 %, nouveau)."""
+    if not previous:
+        return "nouveau" if current else "="
+    return f"{(current - previous) / previous:+.0%}"
+
+
+def stats_trend(name, label):
+    """Ligne /stats d'un compteur : débit récent, dernière heure, dernières 24 h."""
+    last_hour = STATS.window(name, minutes=60)
+    last_day = STATS.window(name, hours=24)
+    return (f"   • {label}: {STATS.window(name, minutes=5) / 5:.1f}/min | "
+            f"{last_hour} ({trend(last_hour, STATS.window(name, minutes=60, offset=1))}) | "
+            f"{last_day} ({trend(last_day, STATS.window(name, hours=24, offset=1))})")
 
 
 @log_handler
 def cmd_stats(update, context):
-    """/stats (admin)"""
+    """/stats (admin) ; en mode shards, répondu par le process d'ingestion (tous shards)"""
     user = update.effective_user
     chat = update.effective_chat
 
@@ -612,25 +3929,509 @@ def cmd_stats(update, context):
     if user.id not in ADMIN_IDS:
         return
 
+    handler_rate = sum(HANDLER_LATENCY.counts()) / max(time.monotonic() - STARTED_AT, 1)
+    handler_lines = "\n".join(
+        f"   • {escape_markdown(name)}: {HANDLER_LATENCY.summary((name,))}" for (name,) in HANDLER_LATENCY.labels()
+    )
+    errors = ", ".join(f"{source}/{kind}: {count}" for (source, kind), count in sorted(ERRORS.values().items()))
+    routes = INTENT_ROUTES.values()
+    routed = sum(routes.values())
+    deflected = routed - routes.get(LLM_ROUTE, 0)
+    intents = ", ".join(f"{name}: {count}" for (name,), count in sorted(routes.items()) if (name,) != LLM_ROUTE)
+    counters = STATS.export()
+    clicks = ", ".join(
+        f"{escape_markdown(step)}: {count} ({STATS.window(STATS.CLICK + step, minutes=60)}/h)"
+        for step, count in sorted(counters["button_clicks"].items())
+    )
+    trend_lines = "\n".join(stats_trend(name, label) for name, label in STATS_TRENDS)
+    g = stats_gauges()
+    mailbox_lines = ", ".join(
+        f"{pool.name} {g[f'{pool.name}_in_flight']} en attente / {g[f'{pool.name}_active']} actives "
+        f"(refus: {g[f'{pool.name}_rejected']}, attente {MAILBOX_WAIT.summary(pool.labels)}, "
+        f"profondeur p99 {MAILBOX_DEPTH.quantile(0.99, pool.labels) or 0:.0f})"
+        for pool in (CHAT_MAILBOXES, AI_POOL)
+    )
+
     stats_text = f"""📊 **Stats Mad2Moi Bot**
 
-👥 Nouveaux membres: {stats['total_new_members']}
-📝 Présentations: {stats['total_presentations']}
-💬 Messages privés: {stats['total_private_messages']}
-🤖 Réponses IA: {stats['total_ai_responses']}
-👆 Clics: {dict(stats['button_clicks'])}
+👥 Nouveaux membres: {counters.get('total_new_members', 0)}
+👋 Welcomes évités (vagues): {counters.get('total_welcomes_saved', 0)}
+🔑 Réponses keyword: {counters.get('total_keyword_replies', 0)} (évitées: {counters.get('total_keyword_suppressed', 0)}, dont {g['keyword_suppressed_chat']} par groupe / {g['keyword_suppressed_user']} par user ; {g['keyword_entries']} entrées)
+📝 Présentations: {counters.get('total_presentations', 0)}
+💬 Messages privés: {counters.get('total_private_messages', 0)}
+🤖 Réponses IA: {counters.get('total_ai_responses', 0)}
+⏳ IA en cours: {g['ai_in_flight']}/{g['ai_capacity']} (refus: {counters.get('total_ai_busy', 0)})
+📬 Mailboxes: {mailbox_lines} ; updates ignorées: {counters.get('total_updates_dropped', 0)}
+🧵 Rafales DM: {g['dm_merged']} messages regroupés, {g['dm_superseded']} réponses remplacées ({g['dm_pending']} en attente)
+🚦 Budget OpenAI: {g['budget_in_flight']}/{AI_MAX_CONCURRENCY} simultanés, {AI_RPM}/min (refus: {g['budget_rejected']})
+🎯 Intents locaux: {deflected}/{routed} DM ({deflected / max(routed, 1):.0%}), ~{INTENT_SAVED.values().get((), 0):.0f}s OpenAI évités ({intents or "—"})
+⚡ Cache IA: {g['cache_hits']} hits / {g['cache_misses']} miss ({g['cache_entries']} entrées, {g['cache_bytes'] // 1024} Ko)
+👆 Clics: {clicks or "—"}
+
+📈 Rythme (5 min | 1 h | 24 h, vs période précédente)
+{trend_lines}
+
+⏱️ Users rate limit: {g['rate_limited_users']}
+🧠 Users mémoire: {g['memory_users']} (~{g['memory_bytes'] // 1024} Ko, oubliés: {g['memory_evicted']})
+🎉 Users présentés: {g['welcomed_users']} ({g['welcomed_scopes']} groupes, {g['welcomed_bytes'] // 1024} Ko, {WELCOMED_FILTER})
+⏰ Relances en attente: {g['followups']} users
+
+📤 Envois: {OUTBOX.sent} (retry: {OUTBOX.retried}, perdus: {OUTBOX.dropped}, erreurs: {OUTBOX.failed})
+📥 File: {OUTBOX.depths()}
+🌐 Latence webhook → handler: {INGEST_CLOCK.summary()}
+🧩 Shards: {SUPERVISOR.count if SUPERVISOR else "—"}
+
+⏱️ Handlers ({handler_rate:.2f}/s): {HANDLER_LATENCY.summary()}
+{handler_lines}
+🤖 OpenAI: {OPENAI_LATENCY.summary()} (1er token: {OPENAI_TTFT.summary()})
+🔌 Client IA: disjoncteur {g['breaker_state']} (ouvert {g['breaker_opened']}x, secours: {counters.get('total_ai_fallback', 0)}), retries: {g['client_retries']}, hedging: {g['hedge_wins']}/{g['hedges']}
+📤 Bot API: {SEND_LATENCY.summary()}
+❗ Erreurs: {errors or "—"}
+🚀 Démarrage: {BOOT.summary()}
+🗂️ Analytics: {g['events_written']} événements écrits, {g['events_segments']} segments (perdus: {g['events_dropped']})
+📝 Logs: {LOG_SAMPLER.sampled_out} échantillonnés, {LOG_QUEUE_HANDLER.dropped} perdus (file pleine)"""
+
+    send_message(context, chat.id, stats_text, "/stats", parse_mode="Markdown")
 
-🧠 Users mémoire: {len(user_conversations)}
-🎉 Users présentés: {len(users_welcomed_presentation)}"""
 
-    try:
-        context.bot.send_message(
-            chat_id=chat.id,
-            text=stats_text,
-            parse_mode="Markdown",
+# ═══════════════════════════════════════════════════════════════════════════════
+# WEBHOOK
+# ═══════════════════════════════════════════════════════════════════════════════
+
+
+class IngestClock:
+    """Latence réception HTTP → début du handler, par update_id."""
+
+    def __init__(self, max_pending=10000):
+        self.max_pending = max_pending
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, update_id):
+        with self._lock:
+            self._pending[update_id] = time.monotonic()
+            if len(self._pending) > self.max_pending:
+                self._pending.popitem(last=False)  # update sans handler
+
+    def observe(self, update_id):
+        """Latence en secondes, ou None si l'update n'est pas passée par le webhook."""
+        if not self._pending:
+            return None
+        with self._lock:
+            received = self._pending.pop(update_id, None)
+            if received is None:
+                return None
+            latency = time.monotonic() - received
+            self.count += 1
+            self.total += latency
+            self.max = max(self.max, latency)
+        return latency
+
+    def summary(self):
+        if not self.count:
+            return "—"
+        return f"moy {self.total / self.count * 1000:.1f} ms, max {self.max * 1000:.1f} ms ({self.count} updates)"
+
+
+INGEST_CLOCK = IngestClock()
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """POST Telegram → vérifie le secret, parse, met en file du dispatcher, répond tout de suite."""
+
+    bot = None
+    update_queue = None
+
+    def do_POST(self):
+        if self.path != WEBHOOK_PATH:
+            return self._respond(404)
+        secret = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        # En bytes : compare_digest refuse les str non ASCII (en-tête arbitraire du client)
+        if not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()):
+            logger.warning("⚠️ Webhook: secret invalide (%s)", self.client_address[0])
+            return self._respond(403)
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            update = Update.de_json(json.loads(self.rfile.read(length)), self.bot)
+        except Exception as e:
+            logger.warning("Erreur webhook: %s", e)
+            return self._respond(400)
+        if update is None:
+            return self._respond(400)
+        INGEST_CLOCK.record(update.update_id)
+        self.update_queue.put(update)
+        self._respond(200)
+
+    def _respond(self, code):
+        self.send_response(code)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass  # une ligne par update : trop bavard
+
+
+def run_webhook(updater):
+    """Mode webhook : serveur HTTP + dispatcher + job queue, jusqu'à SIGINT/SIGTERM."""
+    WebhookHandler.bot = updater.bot
+    WebhookHandler.update_queue = updater.update_queue
+    server = ThreadingHTTPServer((WEBHOOK_LISTEN, WEBHOOK_PORT), WebhookHandler)
+    server.daemon_threads = True
+
+    updater.job_queue.start()
+    dispatcher_thread = threading.Thread(target=updater.dispatcher.start, name="dispatcher")
+    dispatcher_thread.start()
+    threading.Thread(target=server.serve_forever, name="webhook", daemon=True).start()
+
+    if WEBHOOK_URL:
+        updater.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
         )
+    logger.info("🌐 Webhook: %s:%d%s", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH)
+
+    stopping = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stopping.set())
+    stopping.wait()
+
+    logger.info("Arrêt du webhook...")
+    server.shutdown()
+    updater.job_queue.stop()
+    updater.dispatcher.stop()
+    dispatcher_thread.join()
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# SHARDING (multi-process)
+# ═══════════════════════════════════════════════════════════════════════════════
+
+
+class HashRing:
+    """Hachage cohérent : clé (chat / user id) → shard.
+
+    Chaque shard a SHARD_REPLICAS points sur l'anneau : passer de N à N+1
+    shards ne déplace qu'environ 1/(N+1) des clés.
+    """
+
+    def __init__(self, shards, replicas=SHARD_REPLICAS):
+        points = sorted(
+            (self._hash(f"{shard}:{replica}"), shard) for shard in range(shards) for replica in range(replicas)
+        )
+        self._points = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), "big")
+
+    def owner(self, key):
+        return self._shards[bisect_right(self._points, self._hash(key)) % len(self._points)]
+
+
+def shard_key(update):
+    """Clé de routage : le chat (DM = user) ; l'user pour les callbacks (réponses en DM)."""
+    if update.callback_query:
+        return update.callback_query.from_user.id
+    chat = update.effective_chat
+    if chat:
+        return chat.id
+    user = update.effective_user
+    return user.id if user else 0
+
+
+class RemoteOutbox:
+    """File sortante d'un shard : relaie chaque envoi au process d'ingestion.
+
+    Même interface que OutboundSender. La cible (Bot ou Message) voyage en
+    dict, le Message renvoyé est reconstruit avec le bot local.
+    """
+
+    def __init__(self, shard, requests, results):
+        self.shard = shard
+        self.bot = None
+        self._requests = requests
+        self._results = results
+        self._pending = {}  # request_id → (Future, priorité)
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.sent = 0
+        self.retried = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="outbound-relay", daemon=True)
+        self._thread.start()
+
+    def submit(self, chat_id, label, priority, func, /, *args, **kwargs):
+        if priority is None:
+            priority = PRIORITY_DM if chat_id > 0 else PRIORITY_GROUP
+        target = func.__self__
+        target = None if target is self.bot else target.to_dict()
+        future = Future()
+        with self._lock:
+            request_id = next(self._ids)
+            self._pending[request_id] = (future, priority)
+        self._requests.put(("send", self.shard, request_id, chat_id, label, priority,
+                            target, func.__name__, args, kwargs))
+        return future
+
+    def _run(self):
+        while True:
+            message = self._results.get()
+            if message is None:
+                return
+            request_id, ok, result = message
+            with self._lock:
+                future, _ = self._pending.pop(request_id)
+                if ok:
+                    self.sent += 1
+                else:
+                    self.failed += 1
+            if not ok:
+                future.set_exception(result)
+            elif isinstance(result, dict):
+                future.set_result(Message.de_json(result, self.bot))
+            else:
+                future.set_result(result)
+
+    def depths(self):
+        """Envois relayés en attente de réponse, par lane."""
+        with self._lock:
+            depths = {name: 0 for name in PRIORITY_NAMES.values()}
+            for _, priority in self._pending.values():
+                depths[PRIORITY_NAMES[priority]] += 1
+            return depths
+
+    def stop(self, timeout=10):
+        """Attend les réponses en cours (au plus `timeout` s)."""
+        deadline = time.monotonic() + timeout
+        while self._pending and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self._results.put(None)
+        if self._thread:
+            self._thread.join(timeout)
+
+
+def _shard_result(request_id, future):
+    """(id, ok, résultat) picklable pour le shard."""
+    try:
+        result = future.result()
     except Exception as e:
-        logger.warning(f"Erreur /stats: {e}")
+        try:
+            pickle.dumps(e)
+        except Exception:
+            e = TelegramError(str(e))
+        return request_id, False, e
+    return request_id, True, result.to_dict() if isinstance(result, Message) else result
+
+
+class ShardSupervisor:
+    """Process d'ingestion : route les updates vers N shards et envoie leurs réponses.
+
+    Chaque shard (process spawn) possède l'état des users que l'anneau lui
+    attribue : conversations, rate limit, relances. Ses envois repassent par
+    OUTBOX ici, les limites Telegram restent donc globales.
+    """
+
+    def __init__(self, count, updater_kwargs=None):
+        self.count = count
+        self.ring = HashRing(count)
+        self.routed = [0] * count
+        self.status = [{} for _ in range(count)]
+        self.bot = None
+        context = multiprocessing.get_context("spawn")
+        self._inboxes = [context.Queue() for _ in range(count)]
+        self._results = [context.Queue() for _ in range(count)]
+        self._requests = context.Queue()
+        self._processes = [
+            context.Process(
+                target=run_shard,
+                name=f"shard-{shard}",
+                args=(shard, count, self._inboxes[shard], self._requests, self._results[shard], updater_kwargs or {}),
+            )
+            for shard in range(count)
+        ]
+        self._relay = threading.Thread(target=self._run_relay, name="shard-relay", daemon=True)
+
+    def start(self, bot):
+        self.bot = bot
+        for process in self._processes:
+            process.start()
+        self._relay.start()
+
+    def route(self, update, context):
+        """Handler unique du process d'ingestion."""
+        shard = self.ring.owner(shard_key(update))
+        self.routed[shard] += 1
+        self._inboxes[shard].put(update.to_dict())
+
+    def _run_relay(self):
+        while True:
+            message = self._requests.get()
+            if message is None:
+                return
+            try:
+                if message[0] == "metrics":
+                    self._absorb(*message[1:])
+                else:
+                    self._send(*message[1:])
+            except Exception as e:
+                logger.error("[shards] ERREUR relais: %s", e)
+
+    def _send(self, shard, request_id, chat_id, label, priority, target, method, args, kwargs):
+        target = self.bot if target is None else Message.de_json(target, self.bot)
+        future = OUTBOX.submit(chat_id, label, priority, getattr(target, method), *args, **kwargs)
+        future.add_done_callback(lambda f: self._results[shard].put(_shard_result(request_id, f)))
+
+    def _absorb(self, shard, metrics, status):
+        for metric in SHARED_METRICS:
+            metric.absorb(shard, metrics[metric.name])
+        STATS.absorb(shard, status.pop("counters"))
+        self.status[shard] = status
+
+    def ready(self):
+        """True quand chaque shard a fait sa première remontée."""
+        return all(self.status)
+
+    def gauges(self):
+        """Jauges des shards : sommées (nombres), ou valeurs distinctes (texte)."""
+        totals, states = {}, {}
+        for status in self.status:
+            for name, value in status.get("gauges", {}).items():
+                if isinstance(value, str):
+                    states.setdefault(name, set()).add(value)
+                else:
+                    totals[name] = totals.get(name, 0) + value
+        totals.update((name, "/".join(sorted(values))) for name, values in states.items())
+        return totals
+
+    def ai_in_flight(self):
+        return self.gauges().get("ai_in_flight", 0)
+
+    def stop(self, timeout=30):
+        """Vide les shards (updates en cours, IA, envois) puis arrête le relais."""
+        for inbox in self._inboxes:
+            inbox.put(None)
+        for process in self._processes:
+            process.join(timeout)
+        self._requests.put(None)
+        self._relay.join(timeout)
+
+
+SUPERVISOR = None  # process d'ingestion en mode shards (build_router)
+
+
+def local_gauges():
+    """Jauges de l'état local (pools, users, client IA) affichées par /stats et /metrics."""
+    gauges = {
+        "ai_in_flight": AI_POOL.in_flight,
+        "ai_capacity": AI_POOL.capacity,
+        "dm_merged": DM_DEBOUNCER.merged,
+        "dm_superseded": DM_DEBOUNCER.superseded,
+        "dm_pending": len(DM_DEBOUNCER),
+        "budget_in_flight": LLM_BUDGET.in_flight,
+        "budget_rejected": LLM_BUDGET.rejected,
+        "keyword_suppressed_chat": KEYWORD_COOLDOWN.suppressed["chat"],
+        "keyword_suppressed_user": KEYWORD_COOLDOWN.suppressed["user"],
+        "keyword_entries": len(KEYWORD_COOLDOWN),
+        "cache_hits": AI_ANSWER_CACHE.hits,
+        "cache_misses": AI_ANSWER_CACHE.misses,
+        "cache_entries": len(AI_ANSWER_CACHE),
+        "cache_bytes": AI_ANSWER_CACHE.bytes,
+        "rate_limited_users": len(USER_LIMITER),
+        "memory_users": len(user_conversations),
+        "memory_bytes": user_conversations.bytes,
+        "memory_evicted": user_conversations.evicted,
+        "welcomed_users": len(users_welcomed_presentation),
+        "welcomed_scopes": users_welcomed_presentation.scopes,
+        "welcomed_bytes": users_welcomed_presentation.nbytes,
+        "followups": len(FOLLOWUPS),
+        "breaker_state": LLM_CLIENT.breaker.state,
+        "breaker_opened": LLM_CLIENT.breaker.opened,
+        "client_retries": LLM_CLIENT.retries,
+        "hedge_wins": LLM_CLIENT.hedge_wins,
+        "hedges": LLM_CLIENT.hedges,
+        "events_written": EVENTS.written,
+        "events_segments": EVENTS.segments,
+        "events_dropped": EVENTS.dropped,
+    }
+    for pool in (CHAT_MAILBOXES, AI_POOL):
+        gauges[f"{pool.name}_in_flight"] = pool.in_flight
+        gauges[f"{pool.name}_active"] = len(pool)
+        gauges[f"{pool.name}_rejected"] = pool.rejected
+    return gauges
+
+
+def stats_gauges():
+    """Jauges de ce process, ou la somme des shards côté ingestion."""
+    return SUPERVISOR.gauges() if SUPERVISOR and SUPERVISOR.ready() else local_gauges()
+
+
+def shard_report(shard, requests):
+    """Métriques, jauges et compteurs du shard, cumulés côté ingestion (/metrics, /stats)."""
+    requests.put(("metrics", shard, {metric.name: metric.export() for metric in SHARED_METRICS}, {
+        "gauges": local_gauges(),
+        "counters": STATS.merged(),
+    }))
+
+
+def run_shard(shard, count, inbox, requests, results, updater_kwargs):
+    """Process shard : handlers, IA et état des users que l'anneau lui attribue."""
+    global OUTBOX, LLM_BUDGET, SHARD_NAME
+    # L'arrêt est piloté par le process d'ingestion (None dans la file)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    SHARD_NAME = f"{shard + 1}/{count}"
+    OUTBOX = RemoteOutbox(shard, requests, results)
+    LLM_BUDGET = LLMBudget(AI_RPM / count, max(1, AI_MAX_CONCURRENCY // count))
+    STATE.snapshot_key = f"shard-{shard}"
+    ring = HashRing(count)
+    load_state(owns=lambda user_id: ring.owner(user_id) == shard)
+    STATE.start()
+    EVENTS.tag = f"shard{shard}"
+    EVENTS.start()
+
+    updater = build_updater(**updater_kwargs)
+    OUTBOX.bot = updater.bot
+    OUTBOX.start()
+    updater.job_queue.start()
+    updater.job_queue.run_repeating(lambda context: shard_report(shard, requests), interval=SHARD_REPORT_INTERVAL)
+    dispatcher_thread = threading.Thread(target=updater.dispatcher.start, name="dispatcher")
+    dispatcher_thread.start()
+    shard_report(shard, requests)  # 1re remontée = shard prêt
+    logger.info("🧩 Shard %s prêt", SHARD_NAME)
+
+    parent = multiprocessing.parent_process()
+    while True:
+        try:
+            data = inbox.get(timeout=1)
+        except queue.Empty:
+            if parent.is_alive():
+                continue
+            break
+        if data is None:
+            break
+        updater.update_queue.put(Update.de_json(data, updater.bot))
+
+    while not updater.update_queue.empty():
+        time.sleep(0.05)
+    updater.job_queue.stop()
+    updater.dispatcher.stop()
+    dispatcher_thread.join()
+    CHAT_MAILBOXES.shutdown()
+    flush_dm_bursts(updater.dispatcher)
+    AI_POOL.shutdown()
+    OUTBOX.stop()
+    STATE.stop()
+    EVENTS.stop()
+    shard_report(shard, requests)
+    logger.info("🧩 Shard %s arrêté", SHARD_NAME)
 
 
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -638,56 +4439,135 @@ def cmd_stats(update, context):
 # ═══════════════════════════════════════════════════════════════════════════════
 
 
-def main():
-    updater = Updater(TELEGRAM_TOKEN, use_context=True)
+def build_updater(**updater_kwargs):
+    """Updater avec jobs et handlers enregistrés (`base_url` etc. : banc de charge).
+
+    Les handlers tournent dans les mailboxes par chat (serial), pas dans le thread du dispatcher.
+    """
+    # Connexions Bot API : dispatcher, polling, jobs + threads qui appellent le bot (mailboxes, IA, envois)
+    updater_kwargs.setdefault("request_kwargs", {"con_pool_size": 4 + CHAT_WORKERS + AI_WORKERS + OUTBOUND_WORKERS})
+    updater = Updater(TELEGRAM_TOKEN, use_context=True, **updater_kwargs)
     dp = updater.dispatcher
 
+    # 0. Relances DM échues (premier passage rapide : rattrape le retard après redémarrage)
+    updater.job_queue.run_repeating(drain_followups, interval=FOLLOWUP_TICK, first=5)
+    updater.job_queue.run_repeating(sweep_memory, interval=MEMORY_SWEEP_INTERVAL)
+
     # 1. Nouveaux membres
     dp.add_handler(MessageHandler(
         Filters.status_update.new_chat_members,
-        welcome_new_members
+        serial(welcome_new_members, keep=True)
     ))
 
     # 2. Commandes
-    dp.add_handler(CommandHandler("start", cmd_start))
-    dp.add_handler(CommandHandler("help", cmd_help))
-    dp.add_handler(CommandHandler("inscription", cmd_inscription))
-    dp.add_handler(CommandHandler("about", cmd_about))
-    dp.add_handler(CommandHandler("reset", cmd_reset))
-    dp.add_handler(CommandHandler("stats", cmd_stats))
+    dp.add_handler(CommandHandler("start", serial(cmd_start, keep=True)))
+    dp.add_handler(CommandHandler("help", serial(cmd_help, keep=True)))
+    dp.add_handler(CommandHandler("inscription", serial(cmd_inscription, keep=True)))
+    dp.add_handler(CommandHandler("about", serial(cmd_about, keep=True)))
+    dp.add_handler(CommandHandler("reset", serial(cmd_reset, keep=True)))
+    dp.add_handler(CommandHandler("stats", serial(cmd_stats, keep=True)))
 
     # 3. Boutons callback
-    dp.add_handler(CallbackQueryHandler(menu_callback))
+    dp.add_handler(CallbackQueryHandler(serial(menu_callback)))
 
     # 4. Messages groupe (présentations + keywords)
     dp.add_handler(MessageHandler(
         Filters.text & ~Filters.command & Filters.chat_type.groups,
-        group_message_handler
+        serial(group_message_handler)
     ))
 
     # 5. Médias en privé
     dp.add_handler(MessageHandler(
         (Filters.photo | Filters.voice | Filters.video | Filters.document)
         & Filters.chat_type.private,
-        handle_media
+        serial(handle_media)
     ))
 
     # 6. IA en privé
     dp.add_handler(MessageHandler(
         Filters.text & ~Filters.command & Filters.chat_type.private,
-        private_ai_chat
+        serial(private_ai_chat)
     ))
+    return updater
+
+
+def build_router(count, **updater_kwargs):
+    """Updater d'ingestion seule : chaque update part vers le shard de son chat / user.
+
+    /stats est répondu ici : seul ce process voit les remontées de tous les shards.
+    """
+    global SUPERVISOR
+    updater = Updater(TELEGRAM_TOKEN, use_context=True, **updater_kwargs)
+    SUPERVISOR = ShardSupervisor(count, updater_kwargs)
+    updater.dispatcher.add_handler(CommandHandler("stats", cmd_stats))
+    updater.dispatcher.add_handler(TypeHandler(Update, SUPERVISOR.route))
+    SUPERVISOR.start(updater.bot)
+    return updater, SUPERVISOR
+
+
+def main():
+    # Procfile : chaque type de process annonce son mode, seul celui de BOT_MODE démarre
+    # (polling et webhook sur le même token se volent les updates : 409 Conflict)
+    process_mode = sys.argv[1] if len(sys.argv) > 1 else BOT_MODE
+    if process_mode != BOT_MODE:
+        logger.error("❌ Process %s refusé : BOT_MODE=%s (le mettre à 0, ex. heroku ps:scale %s=0)",
+                     process_mode, BOT_MODE, "web" if process_mode == "webhook" else "worker")
+        sys.exit(1)
+
+    restored = False
+    if not SHARD_WORKERS:
+        restored = restore_snapshot()
+        load_state()
+        STATE.start()
+        EVENTS.start()
+    OUTBOX.start()
+    start_metrics_server()
+
+    if SHARD_WORKERS:
+        updater, supervisor = build_router(SHARD_WORKERS)
+    else:
+        updater, supervisor = build_updater(), None
 
     logger.info("=" * 50)
     logger.info("🚀 Mad2Moi Bot v2.0 - Optimisé Conversion")
     logger.info(f"   OpenAI: {'✅' if OPENAI_API_KEY else '❌'}")
     logger.info(f"   Rate limit: {RATE_LIMIT_MESSAGES}/{RATE_LIMIT_WINDOW}s")
     logger.info(f"   Historique: {MAX_HISTORY} msg")
+    logger.info(f"   Pool IA: {AI_WORKERS} threads + {AI_QUEUE_SIZE} en file, timeout {AI_TIMEOUT:.0f}s")
+    logger.info(f"   Mailboxes: {f'{CHAT_WORKERS} threads, {CHAT_MAILBOX_SIZE}/chat, {CHAT_QUEUE_SIZE} en file' if CHAT_WORKERS else 'non (dispatcher)'}")
+    logger.info(f"   Streaming IA: {'✅' if AI_STREAMING else '❌'}")
+    logger.info(f"   État: {STATE_BACKEND} (flush {STATE_FLUSH_INTERVAL:.0f}s)")
     logger.info(f"   Keywords présentation: {len(KEYWORDS_PRESENTATION)}")
+    logger.info(f"   Fenêtre welcome: {WELCOME_COALESCE_WINDOW:.0f}s")
+    logger.info(f"   Cooldown keyword: {KEYWORD_CHAT_COOLDOWN:.0f}s/groupe, {KEYWORD_USER_COOLDOWN:.0f}s/user")
+    logger.info(f"   Snapshot: {'non' if SHARD_WORKERS or not SNAPSHOT_PATH else SNAPSHOT_PATH}"
+                f"{' (restauré)' if restored else ''}")
+    logger.info(f"   Analytics: {ANALYTICS_DIR or 'désactivé'} (flush {ANALYTICS_FLUSH_INTERVAL:.0f}s)")
+    logger.info(f"   Logs: {LOG_FORMAT}, file {LOG_QUEUE_SIZE}, échantillonnage {LOG_SAMPLING or 'non'}")
+    logger.info(f"   Mode: {BOT_MODE}")
+    logger.info(f"   Shards: {SHARD_WORKERS or 'non (1 process)'}")
+    logger.info(f"   Métriques: {f'http://{METRICS_LISTEN}:{METRICS_PORT}/metrics' if METRICS_PORT else 'désactivées'}")
     logger.info("=" * 50)
-
-    updater.start_polling()
-    updater.idle()
+    BOOT.mark("ready")
+    logger.info("🚀 Prêt en %.2fs (imports %.2fs)", BOOT.marks["ready"], BOOT.marks["imports"])
+
+    if BOT_MODE == "webhook":
+        run_webhook(updater)
+    else:
+        updater.start_polling()
+        updater.idle()
+    if supervisor:
+        supervisor.stop()
+        OUTBOX.stop()
+    else:
+        CHAT_MAILBOXES.shutdown()
+        flush_dm_bursts(updater.dispatcher)
+        AI_POOL.shutdown()
+        OUTBOX.stop()
+        STATE.stop()
+        EVENTS.stop()
+        if SNAPSHOT_PATH:
+            write_snapshot()
 
 
 if __name__ == "__main__":